@@ -0,0 +1,385 @@
+"""本地 OpenAI 兼容的流式模拟服务
+
+只实现 POST /chat/completions 的流式 (SSE) 回答，用来在不消耗真实接口额度的情况下测量流水线吞吐：
+- chunk_chars / chunk_delay: 每个分块的字符数和分块之间的延迟，模拟模型的生成速度
+- reasoning_chars: 回答前先输出多少字符的 reasoning_content，模拟 qvq-max 等推理模型
+- first_delay: 收到请求到第一个分块的延迟
+- error_rate / throttle_rate: 按概率返回 500 / 429（带 Retry-After），检验重试和限流
+- stall_rate / stall_seconds: 按概率在回答中途停顿，检验超时取消（utils/budget.py）
+- straggler_rate / straggler_seconds: 按概率在开始回答之前额外等待，模拟在思考过程中停留很久的请求，检验对冲（utils/hedge.py）
+- template / files: 每个文件块的模板和每次回答的文件块数，默认输出 FILENAME 块；
+  可用 {n}（全局请求序号）、{i}（回答内的文件序号）、{model}、{images}、{body} 占位
+- cache_block: 模拟接口侧的前缀缓存，按模型记住见过的请求前缀（以 cache_block 个字符为一块），
+  开头与之前请求相同的整块计为 usage.prompt_tokens_details.cached_tokens（与 prompt_tokens 一样按 4 字节一个 token 估算），
+  0 表示不模拟
+请求 stream_options.include_usage 时在末尾返回 usage。
+可以单独运行（python -m bench.mock_server --port 8000），也可以由 bench/run.py 在进程内启动。
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+DEFAULT_TEMPLATE = (
+    "FILENAME: 模拟笔记{n}-{i}.md\n"
+    "---\naliases: [模拟{n}-{i}]\n---\n"
+    "# 模拟笔记{n}-{i}\n\n"
+    "{body}\n"
+    "###-###-END-OF-FILE-###-###\n"
+)
+
+# 模拟前缀缓存最多记住的块数，超过后清空
+_MAX_PREFIXES = 1_000_000
+
+_FILLER = "细胞膜由磷脂双分子层构成，蛋白质镶嵌其中。The membrane potential is maintained by ion pumps. "
+
+
+@dataclass
+class MockSettings:
+    """模拟服务参数
+
+    Attributes:
+        chunk_chars (int): 每个回答分块的字符数
+        chunk_delay (float): 分块之间的延迟（秒）
+        first_delay (float): 第一个分块之前的延迟（秒）
+        reasoning_chars (int): reasoning_content 的字符数，0 表示不输出思考过程
+        body_chars (int): 模板中 {body} 的字符数
+        error_rate (float): 返回 500 的概率
+        throttle_rate (float): 返回 429 的概率
+        retry_after (float): 429 响应中的 Retry-After（秒）
+        stall_rate (float): 回答中途停顿的概率
+        stall_seconds (float): 停顿的秒数
+        template (str): 每个文件块的模板
+        files (int): 每次回答的文件块数
+        seed (Optional[int]): 随机数种子，固定后错误注入可复现
+        cache_block (int): 前缀缓存的块大小（请求体字节数），0 表示不模拟前缀缓存
+        straggler_rate (float): 开始回答之前额外等待的概率
+        straggler_seconds (float): 额外等待的秒数
+    """
+    chunk_chars: int = 16
+    chunk_delay: float = 0.01
+    first_delay: float = 0.05
+    reasoning_chars: int = 0
+    body_chars: int = 600
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: float = 0.2
+    stall_rate: float = 0.0
+    stall_seconds: float = 30.0
+    template: str = DEFAULT_TEMPLATE
+    files: int = 2
+    seed: Optional[int] = None
+    cache_block: int = 1024
+    straggler_rate: float = 0.0
+    straggler_seconds: float = 30.0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "MockSettings":
+        conf = conf or {}
+        return cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+
+
+class MockStats:
+    """模拟服务收到的请求统计"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.completed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.request_bytes = 0
+        self.images = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.by_model = {}
+
+    def begin(self, model: str, size: int, images: int):
+        with self._lock:
+            self.requests += 1
+            self.request_bytes += size
+            self.images += images
+            self.by_model[model] = self.by_model.get(model, 0) + 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return self.requests
+
+    def tokens(self, prompt_tokens: int, cached_tokens: int):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+
+    def end(self, outcome: str):
+        with self._lock:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.throttled += 1
+            elif outcome == "error":
+                self.errors += 1
+            elif outcome == "ok":
+                self.completed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "completed": self.completed,
+                "throttled": self.throttled,
+                "errors": self.errors,
+                "peak_in_flight": self.peak_in_flight,
+                "request_bytes": self.request_bytes,
+                "images": self.images,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "by_model": dict(self.by_model),
+            }
+
+
+def _count_images(messages: list) -> int:
+    count = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            count += sum(1 for part in content if part.get("type") == "image_url")
+    return count
+
+
+def _filler(chars: int) -> str:
+    repeat = chars // len(_FILLER) + 1
+    return (_FILLER * repeat)[:chars]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            body = json.loads(raw)
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+        settings = self.server.settings
+        model = body.get("model", "")
+        messages = body.get("messages", [])
+        images = _count_images(messages)
+        n = self.server.stats.begin(model, len(raw), images)
+        outcome = "aborted"
+        try:
+            roll = self.server.random()
+            if roll < settings.throttle_rate:
+                outcome = "throttled"
+                self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit"}},
+                                {"Retry-After": str(settings.retry_after)})
+                return
+            if roll < settings.throttle_rate + settings.error_rate:
+                outcome = "error"
+                self._send_json(500, {"error": {"message": "injected error", "type": "server_error"}})
+                return
+            body_text = _filler(settings.body_chars)
+            answer = "".join(settings.template.format(n=n, i=i, model=model, images=images, body=body_text)
+                             for i in range(1, max(1, settings.files) + 1))
+            prompt_tokens = len(raw) // 4
+            cached_tokens = self.server.prefix_cache(model, raw) // 4
+            self.server.stats.tokens(prompt_tokens, cached_tokens)
+            stall = self.server.random() < settings.stall_rate
+            straggler = self.server.random() < settings.straggler_rate
+            self._stream(body, model, answer, prompt_tokens, cached_tokens, stall, straggler)
+            outcome = "ok"
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了流式请求
+            pass
+        finally:
+            self.server.stats.end(outcome)
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _event(self, payload: dict):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def _stream(self, body: dict, model: str, answer: str, prompt_tokens: int, cached_tokens: int = 0,
+                stall: bool = False, straggler: bool = False):
+        settings = self.server.settings
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        step = max(1, settings.chunk_chars)
+        time.sleep(settings.first_delay)
+        reasoning = _filler(settings.reasoning_chars)
+        for i in range(0, len(reasoning), step):
+            self._event({**base, "choices": [{"index": 0, "delta": {"reasoning_content": reasoning[i:i + step]}}]})
+            time.sleep(settings.chunk_delay)
+        if straggler:
+            time.sleep(settings.straggler_seconds)
+        for i in range(0, len(answer), step):
+            self._event({**base, "choices": [{"index": 0, "delta": {"content": answer[i:i + step]}}]})
+            time.sleep(settings.chunk_delay)
+            if stall and i >= len(answer) // 2:
+                stall = False
+                time.sleep(settings.stall_seconds)
+        self._event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            reasoning_tokens = len(reasoning) // 2
+            completion_tokens = reasoning_tokens + len(answer) // 2
+            self._event({**base, "choices": [], "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            }})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    """在后台线程中运行的模拟服务
+
+    Attributes:
+        settings (MockSettings): 模拟参数
+        stats (MockStats): 请求统计
+    """
+    daemon_threads = True
+    # 基准测试会同时打开大量连接
+    request_queue_size = 1024
+
+    def __init__(self, settings: Optional[MockSettings] = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.settings = settings or MockSettings()
+        self.stats = MockStats()
+        self._random = random.Random(self.settings.seed)
+        self._random_lock = threading.Lock()
+        self._prefixes = set()
+        self._prefix_lock = threading.Lock()
+        self._thread = None
+
+    def random(self) -> float:
+        with self._random_lock:
+            return self._random.random()
+
+    def prefix_cache(self, model: str, raw: bytes) -> int:
+        """返回请求体开头与之前的请求（同一模型）相同的字节数，按整块计算，并记住本次请求的前缀"""
+        block = self.settings.cache_block
+        if block <= 0:
+            return 0
+        digest = hashlib.sha256(model.encode('utf-8'))
+        keys = []
+        for start in range(0, len(raw) - block + 1, block):
+            digest.update(raw[start:start + block])
+            keys.append(digest.copy().digest())
+        with self._prefix_lock:
+            cached = 0
+            while cached < len(keys) and keys[cached] in self._prefixes:
+                cached += 1
+            if len(self._prefixes) > _MAX_PREFIXES:
+                self._prefixes.clear()
+            self._prefixes.update(keys)
+        return cached * block
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """把模拟服务参数添加到命令行，bench/run.py 共用"""
+    defaults = MockSettings()
+    parser.add_argument("--chunk-chars", type=int, default=defaults.chunk_chars, help="每个分块的字符数")
+    parser.add_argument("--chunk-delay", type=float, default=defaults.chunk_delay, help="分块之间的延迟（秒）")
+    parser.add_argument("--first-delay", type=float, default=defaults.first_delay, help="第一个分块之前的延迟（秒）")
+    parser.add_argument("--reasoning-chars", type=int, default=defaults.reasoning_chars,
+                        help="回答前输出的 reasoning_content 字符数")
+    parser.add_argument("--body-chars", type=int, default=defaults.body_chars, help="模板中 {body} 的字符数")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="返回 500 的概率")
+    parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate, help="返回 429 的概率")
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after, help="429 的 Retry-After（秒）")
+    parser.add_argument("--stall-rate", type=float, default=defaults.stall_rate, help="回答中途停顿的概率")
+    parser.add_argument("--stall-seconds", type=float, default=defaults.stall_seconds, help="停顿的秒数")
+    parser.add_argument("--straggler-rate", type=float, default=defaults.straggler_rate,
+                        help="开始回答之前额外等待的概率")
+    parser.add_argument("--straggler-seconds", type=float, default=defaults.straggler_seconds,
+                        help="开始回答之前额外等待的秒数")
+    parser.add_argument("--template", metavar="FILE", help="文件块模板文件，可用 {n} {i} {model} {images} {body} 占位")
+    parser.add_argument("--files", type=int, default=defaults.files, help="每次回答的文件块数")
+    parser.add_argument("--seed", type=int, help="随机数种子")
+    parser.add_argument("--cache-block", type=int, default=defaults.cache_block,
+                        help="模拟前缀缓存的块大小（字节），0 表示不模拟")
+
+
+def settings_from_args(args) -> MockSettings:
+    template = DEFAULT_TEMPLATE
+    if args.template:
+        with open(args.template, 'r', encoding='utf-8') as f:
+            template = f.read()
+    return MockSettings(args.chunk_chars, args.chunk_delay, args.first_delay, args.reasoning_chars, args.body_chars,
+                        args.error_rate, args.throttle_rate, args.retry_after, args.stall_rate, args.stall_seconds,
+                        template, args.files, args.seed, args.cache_block, args.straggler_rate,
+                        args.straggler_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容的流式模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockServer(settings_from_args(args), args.host, args.port)
+    print(f"模拟服务已启动: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats.snapshot(), ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""流水线基准测试
+
+在本地启动 bench/mock_server.py 的模拟服务，用合成图片驱动完整的 main.py（v050 或 --engine async 的 v060），
+测量吞吐、端到端延迟、峰值内存和请求数，不消耗真实接口额度：
+- 每个规模（默认 10 / 100 / 1000 张图片）在一个临时目录中运行：复制 main.py、utils 和 Prompt，
+  写入指向模拟服务的配置，工作目录为合成图片所在目录，不会影响真实的配置、缓存、运行记录和笔记库
+- main.py 在子进程中运行，峰值内存取子进程（含图片预处理进程）的最大 RSS
+- 调用延迟分位数取自子进程写出的 log/metrics.jsonl 汇总
+结果保存为 JSON（默认 bench/results/），--compare 与之前的结果比较，用于发现 Ai.LLM 或 main.py 的性能回退。
+
+    python -m bench.run --sizes 10 100 --engine async --compare bench/results/旧结果.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from dataclasses import asdict
+from typing import List, Optional
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    from . import mock_server
+except ImportError:  # 直接运行 bench/run.py 时
+    import mock_server
+    sys.path.insert(0, APP_DIR)
+from utils import file
+DEFAULT_RESULTS_DIR = os.path.join(APP_DIR, 'bench', 'results')
+# 运行 main.py 需要复制的文件
+_APP_FILES = ("main.py", "keyexample.json", "master_prompt.txt", "vision.txt", "build.txt", "gen.txt", "merge.txt")
+# main.load_settings 中 file.Config("key-api.json", ..., True) 读取的配置文件名
+_CONFIG_NAME = os.path.basename(file.Config.path_for("key-api.json", True))
+
+
+def _png(width: int, height: int, rng: random.Random) -> bytes:
+    """生成一张随机色块的 PNG（只用标准库），每张图片内容不同，避免被去重或命中缓存"""
+    cells = 8
+    colors = [[bytes(rng.randrange(256) for _ in range(3)) for _ in range(cells)] for _ in range(cells)]
+    rows = []
+    for y in range(height):
+        row = colors[y * cells // height]
+        rows.append(b'\x00' + b''.join(row[x * cells // width] for x in range(width)))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(b''.join(rows))) + \
+        chunk(b'IEND', b'')
+
+
+def make_images(directory: str, count: int, edge: int, seed: int = 0) -> List[str]:
+    """在 directory 下生成 count 张合成图片，分散在若干子目录中（与按章节拍照的目录结构相似）"""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        sub = os.path.join(directory, f"chapter{i // 50:03d}")
+        os.makedirs(sub, exist_ok=True)
+        path = os.path.join(sub, f"page{i:05d}.png")
+        with open(path, 'wb') as f:
+            f.write(_png(edge, edge, rng))
+        paths.append(path)
+    return paths
+
+
+def _merge(base: dict, override: dict) -> dict:
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def bench_config(base_url: str, keep_rate_limits: bool = False, dedup: bool = False,
+                 override: Optional[dict] = None) -> dict:
+    """以 keyexample.json 为基础，把所有角色指向模拟服务"""
+    with open(os.path.join(APP_DIR, 'keyexample.json'), 'r', encoding='utf-8') as f:
+        conf = json.load(f)
+    for section in conf.values():
+        if isinstance(section, dict) and "base_url" in section:
+            section["base_url"] = base_url
+            section["api_key"] = "sk-bench"
+            if not keep_rate_limits:
+                # 默认测量流水线本身，不受真实接口的 rpm / tpm 配额限制
+                section.pop("rate_limit", None)
+    conf.setdefault("dedup", {})["enabled"] = dedup
+    # 模拟服务支持 stream_options，使用真实的 token 用量
+    conf.setdefault("metrics", {})["stream_usage"] = True
+    return _merge(conf, override or {})
+
+
+def prepare_app(root: str, conf: dict) -> str:
+    """把 main.py、utils 和 Prompt 复制到临时目录并写入配置，返回复制后的目录"""
+    app = os.path.join(root, "app")
+    shutil.copytree(os.path.join(APP_DIR, "utils"), os.path.join(app, "utils"),
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    for name in _APP_FILES:
+        shutil.copy2(os.path.join(APP_DIR, name), app)
+    with open(os.path.join(app, _CONFIG_NAME), 'w', encoding='utf-8') as f:
+        json.dump(conf, f, ensure_ascii=False, indent=2)
+    return app
+
+
+def read_summary(app: str) -> Optional[dict]:
+    """读取子进程写出的最后一条运行汇总"""
+    path = os.path.join(app, "log", "metrics.jsonl")
+    summary = None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("type") == "summary":
+                    summary = entry
+    except (OSError, json.JSONDecodeError):
+        return None
+    return summary
+
+
+def run_once(size: int, args, settings: mock_server.MockSettings, override: Optional[dict]) -> dict:
+    """在模拟服务上运行一次 main.py，返回测量结果"""
+    with mock_server.MockServer(settings) as server, tempfile.TemporaryDirectory(prefix="aibionote-bench-") as root:
+        conf = bench_config(server.base_url, args.keep_rate_limits, args.dedup, override)
+        app = prepare_app(root, conf)
+        images_dir = os.path.join(root, "images")
+        make_images(images_dir, size, args.image_edge, args.seed)
+        command = [sys.executable, os.path.join(app, "main.py"), "--no-cache", "--engine", args.engine]
+        stderr_path = os.path.join(root, "stderr.txt")
+        with open(stderr_path, 'wb') as stderr_file:
+            start = time.perf_counter()
+            proc = subprocess.Popen(command, cwd=images_dir, stdout=subprocess.DEVNULL, stderr=stderr_file)
+            # wait4 返回这一个子进程（及其已回收的子进程）的资源占用，多次运行互不影响
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            wall = time.perf_counter() - start
+        with open(stderr_path, 'r', encoding='utf-8', errors='replace') as f:
+            stderr = f.read()
+        notes_dir = os.path.join(app, "Obsidian-Notes")
+        notes = len(os.listdir(notes_dir)) if os.path.isdir(notes_dir) else 0
+        summary = read_summary(app)
+        remaining = sum(len(files) for _, _, files in os.walk(images_dir))
+        result = {
+            "images": size,
+            "returncode": proc.returncode,
+            "wall": round(wall, 3),
+            "throughput": round(size / wall, 3) if wall > 0 else None,
+            # Linux 上 ru_maxrss 的单位是 KB
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+            "notes": notes,
+            "images_left": remaining,
+            "server": server.stats.snapshot(),
+            "summary": summary,
+        }
+        if proc.returncode != 0:
+            result["stderr"] = stderr[-2000:]
+        return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict):
+    """打印与之前结果相比的吞吐和端到端延迟变化"""
+    old = {result["images"]: result for result in baseline.get("results", [])}
+    print(f"\n与 {baseline.get('commit') or '?'}（{baseline.get('engine')}）比较:")
+    for result in current["results"]:
+        before = old.get(result["images"])
+        if before is None or not before.get("throughput") or not result.get("throughput"):
+            continue
+        ratio = result["throughput"] / before["throughput"]
+        print(f"  {result['images']:>5} 张: 吞吐 {before['throughput']:.2f} -> {result['throughput']:.2f} 张/秒 "
+              f"({ratio - 1:+.1%})，耗时 {before['wall']:.1f} -> {result['wall']:.1f} 秒，"
+              f"峰值内存 {before['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="用本地模拟服务测量流水线吞吐")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="每次运行的图片数")
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread", help="传给 main.py 的 --engine")
+    parser.add_argument("--image-edge", type=int, default=256, help="合成图片的边长（像素）")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="保留 keyexample.json 中的 rate_limit 配置")
+    parser.add_argument("--dedup", action="store_true", help="保留图片去重（合成图片互不相同，只测量去重本身的开销）")
+    parser.add_argument("--override", metavar="FILE", help="合并到配置中的 JSON 文件，例如调整并发数")
+    parser.add_argument("--output", metavar="FILE", help="结果文件，默认 bench/results/<时间>-<engine>.json")
+    parser.add_argument("--compare", metavar="FILE", help="与之前的结果文件比较")
+    mock_server.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.seed is None:
+        args.seed = 0
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = mock_server.settings_from_args(args)
+    override = None
+    if args.override:
+        with open(args.override, 'r', encoding='utf-8') as f:
+            override = json.load(f)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "engine": args.engine,
+        "python": sys.version.split()[0],
+        "mock": asdict(settings),
+        "override": override,
+        "results": [],
+    }
+    for size in args.sizes:
+        print(f"运行 {size} 张图片 ({args.engine}) ...", flush=True)
+        result = run_once(size, args, settings, override)
+        report["results"].append(result)
+        status = "" if result["returncode"] == 0 else f"（退出码 {result['returncode']}）"
+        print(f"  耗时 {result['wall']:.1f} 秒，吞吐 {result['throughput']} 张/秒，峰值内存 {result['peak_rss_mb']} MB，"
+              f"请求 {result['server']['requests']} 次，写入笔记 {result['notes']} 篇{status}", flush=True)
+
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR,
+                                         f"{time.strftime('%Y%m%d-%H%M%S')}-{args.engine}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {output}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+    return report
+
+
+if __name__ == '__main__':
+    main()
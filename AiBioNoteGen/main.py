@@ -1,5 +1,24 @@
 from utils import Ai
 from utils import file
+from utils import cache as result_cache
+from utils.journal import RunJournal
+from utils import notes
+from utils import notewriter
+from utils import pipeline
+from utils import prompts
+from utils import ratelimit
+from utils import image
+from utils import dedup
+from utils import endpoints
+from utils import jobqueue
+from utils import routing
+from utils import discovery
+from utils import vault
+from utils import linker
+from utils import logs
+from utils import metrics
+import asyncio
+import argparse
 import base64
 import json
 import os
@@ -8,6 +27,7 @@ import logging
 from openai import OpenAI
 import re  
 import threading
+import time
 import concurrent.futures
 
 
@@ -30,21 +50,11 @@ def clean_path(path):
         path = path[1:-1]
     return path
 
-def get_image_paths():
-    image_extensions = ('.jpg', '.jpeg', '.png')
-    current_dir = os.getcwd()
-    image_paths = []
-    for root, dirs, files in os.walk(current_dir):
-        if 'log' in dirs:
-            dirs.remove('log')
-        if os.path.basename(root) == 'AiBioNoteGen': 
-            pass
-            
-        for file in files:
-            if file.lower().endswith(image_extensions):
-                full_path = os.path.join(root, file)
-                image_paths.append(full_path)
-    return image_paths
+def get_image_paths(settings=None):
+    """
+    按配置的根目录、扩展名和 include / exclude 规则查找图片，见 utils/discovery.py。
+    """
+    return discovery.discover(settings)
 
 def del_images(images):
     deleted_count = 0  
@@ -97,55 +107,271 @@ def prompt_reader(name:str) ->str:
 def save_files_from_response(response_text: str, output_dir: str):
     """
     解析由最终模型生成的、包含多个文件的单一文本响应，并保存它们。
+    返回成功保存的文件数。
     """
     if response_text is None:
         logging.error("无法保存文件：响应文本为None")
-        return
+        return 0
         
     # 确保输出目录存在
     os.makedirs(output_dir, exist_ok=True)
-    file_separator = "###-###-END-OF-FILE-###-###"
-    file_blocks = response_text.strip().split(file_separator)
-    
-    saved_count = 0
-    for block in file_blocks:
-        block = block.strip()
-        if not block:
-            continue
-        lines = block.split('\n', 1)
-        if not lines or not lines[0].startswith('FILENAME:'):
-            logging.warning(f"跳过格式不正确的文本块: {block[:100]}...")
+    items = []
+    for filename, content in notes.iter_file_blocks(response_text):
+        if filename is None:
+            logging.warning(f"跳过格式不正确的文本块: {content[:100]}...")
             continue
-        filename = lines[0].replace('FILENAME:', '').strip()
-        content = lines[1].strip() if len(lines) > 1 else ""
-        if not filename or '..' in filename or os.path.isabs(filename):
+        if not notes.is_safe_filename(filename):
             logging.error(f"检测到不安全或无效的文件名，已跳过: {filename}")
             continue
+        items.append((os.path.join(output_dir, filename), content))
+    # 笔记较多时并发写入，内容没有变化的笔记不会重写
+    statuses = notewriter.get_writer().write_many(items)
+    counts = {status: statuses.count(status) for status in
+              (notewriter.CREATED, notewriter.UPDATED, notewriter.UNCHANGED, notewriter.FAILED)}
+    saved_count = len(statuses) - counts[notewriter.FAILED]
+    logging.info(f"从单次响应中总共保存了 {saved_count} 个文件（{notewriter.summarize(counts)}）。")
+    return saved_count
 
-        file_path = os.path.join(output_dir, filename)
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            logging.info(f"成功创建文件: {file_path}")
-            saved_count += 1
-        except Exception as e:
-            logging.error(f"创建文件 {filename} 时发生错误: {e}")
-            
-    logging.info(f"从单次响应中总共保存了 {saved_count} 个文件。")
+def written_notes(response_text):
+    """
+    返回响应文本中各个 FILENAME 块的文件名，即本次写入的笔记。
+    """
+    return [filename for filename, _ in notes.iter_file_blocks(response_text or "") if filename is not None]
+
+def stream_files_from_chat(agent, prompt, output_dir, cache=None, stage="", keep_answer=False):
+    """
+    流式调用模型，边生成边解析 FILENAME 块，每个文件一结束就写入磁盘。
+    启用缓存时同样按模型名 + 系统提示 + 完整输入文本缓存完整回答。
+    不使用缓存且 keep_answer 为 False（调用方不需要写入运行记录）时不保留完整回答，内存占用以单篇笔记为上限。
+    返回 (完整回答, 写入的文件名列表)，调用失败时完整回答为 None，不保留时为空字符串。
+    """
+    key = result_cache.make_key(stage, agent.model_name, agent.system_prompt, prompt)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info(f"阶段 {stage} 命中缓存，跳过模型调用。")
+            written = written_notes(cached) if save_files_from_response(cached, output_dir) else []
+            return cached, written
+
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+
+    def on_file(filename, content):
+        if notes.save_note(filename, content, output_dir):
+            written.append(filename)
+
+    parser = notes.FileBlockParser(on_file, lambda block: logging.warning(f"跳过格式不正确的文本块: {block[:100]}..."))
+    # 缓存和运行记录需要完整回答，只有都不需要时才可以不保留
+    answer = agent.stream(prompt, parser.feed, keep_answer=keep_answer or cache is not None)
+    parser.close()
+    if cache is not None and answer:
+        cache.put(key, answer, stage=stage, model=agent.model_name)
+    return answer, written
+
+def cached_chat(agent, prompt, cache=None, stage=""):
+    """
+    带缓存的单次文本对话，键为模型名 + 系统提示 + 完整输入文本。Build / merge 阶段使用。
+    返回未格式化的回答：结果会写入笔记（跳过 Gen 或 Gen 失败时）或交给下一阶段。
+    """
+    key = result_cache.make_key(stage, result_cache.RAW_ANSWER, agent.model_name, agent.system_prompt, prompt)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info(f"阶段 {stage} 命中缓存，跳过模型调用。")
+            return cached
+    answer = agent.chat(prompt, raw=True)
+    if cache is not None and answer:
+        cache.put(key, answer, stage=stage, model=agent.model_name)
+    return answer
+
+def merge_file_versions(outputs, merge_agent, prompt_set, cache=None, batch_tokens=0, fan_out=4, vault_index=None):
+    """
+    Build 的 reduce 步骤：合并各批次的输出。
+    只出现在一个批次中的文件直接保留，同名文件才交给模型合并；合并失败时保留最长的版本。
+    笔记库中已有同名笔记时，已有内容作为其中一个版本参与合并，结果写回原路径。
+    """
+    versions = {}
+    loose = []
+    for output in outputs:
+        for filename, content in notes.iter_file_blocks(output):
+            if filename is None:
+                loose.append(content)
+            else:
+                versions.setdefault(notes.note_key(filename), []).append((filename, content))
+    if not versions:
+        return "\n".join(outputs)
+
+    existing = {}
+    if vault_index is not None:
+        for key in versions:
+            block = vault_index.existing_block(key)
+            if block is not None:
+                existing[key] = block
+                versions[key].insert(0, block)
+        if existing:
+            logging.info(f"{len(existing)} 篇笔记已存在于笔记库中，将与已有内容合并: {list(existing)}")
+
+    duplicates = [key for key, items in versions.items() if len(items) > 1]
+    if duplicates:
+        logging.info(f"Build reduce: {len(duplicates)} 个同名文件需要合并")
+        units = [notes.join_file_blocks(versions[key]) for key in duplicates]
+        merge_batches = notes.pack_batches(units, batch_tokens, Ai.estimate_tokens) if batch_tokens else [units]
+
+        def merge(batch):
+            merge_prompt = prompt_set.render("merge", {prompts.MERGE_SLOT: "\n".join(batch)})
+            # 合并结果会写回笔记库中的已有笔记，cached_chat 返回未格式化的回答
+            return cached_chat(merge_agent, merge_prompt, cache, "merge")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=fan_out) as executor:
+            merged_outputs = list(executor.map(merge, merge_batches))
+
+        merged = {}
+        for merged_output in merged_outputs:
+            for filename, content in notes.iter_file_blocks(merged_output or ""):
+                if filename is not None:
+                    merged[notes.note_key(filename)] = (filename, content)
+        for key in duplicates:
+            versions[key] = [notes.settle_merge(key, versions[key], merged.get(key), existing.get(key))]
+
+    result = notes.join_file_blocks([items[0] for items in versions.values()])
+    if loose:
+        result += "\n" + "\n".join(loose)
+    return result
+
+def run_build_stage(drafts, build_agent, prompt_set, cache=None, batch_tokens=0, fan_out=4, vault_index=None):
+    """
+    Stage 2：结构与内容优化。
+    草稿总量不超过 batch_tokens（或 batch_tokens 为 0）时整体一次调用；
+    否则按主题分组打包为多个批次并行优化 (map)，再合并同名文件 (reduce)。
+    每个批次附上笔记库中与该批草稿相关的已有笔记（名称、别名、标题），同名的已有笔记在 reduce 中合并。
+    返回优化稿，失败时返回 None。
+    """
+    aggregated_draft = "\n".join(drafts)
+
+    def build(text):
+        values = {prompts.DRAFT_SLOT: text}
+        if vault_index is not None:
+            values[vault.CONTEXT_SLOT] = vault_index.context([text], Ai.estimate_tokens)
+        return cached_chat(build_agent, prompt_set.render("build", values), cache, "build")
+
+    if not batch_tokens or Ai.estimate_tokens(aggregated_draft) <= batch_tokens:
+        output = build(aggregated_draft)
+        if not output or vault_index is None:
+            return output
+        return merge_file_versions([output], build_agent, prompt_set, cache, batch_tokens, fan_out, vault_index)
+
+    batches = notes.pack_batches(drafts, batch_tokens, Ai.estimate_tokens)
+    logging.info(f"Build map: {len(drafts)} 份初稿打包为 {len(batches)} 个批次，最多 {fan_out} 个并行")
+    batch_texts = ["\n".join(batch) for batch in batches]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=fan_out) as executor:
+        outputs = list(executor.map(build, batch_texts))
+
+    failed = sum(1 for output in outputs if not output)
+    if failed == len(outputs):
+        return None
+    if failed:
+        logging.warning(f"Build map: {failed} 个批次优化失败，这些批次使用原始草稿")
+    outputs = [output or text for output, text in zip(outputs, batch_texts)]
+    return merge_file_versions(outputs, build_agent, prompt_set, cache, batch_tokens, fan_out, vault_index)
+
+def run_gen_stage(refined_draft, gen_agent, prompt_set, output_dir, cache=None, max_workers=4, vault_index=None,
+                  keep_output=True):
+    """
+    Stage 3：最终格式化与渲染。
+    把优化稿按 FILENAME 块拆成单篇笔记并行渲染，流式输出中每个文件一结束就立即写入；
+    某篇渲染失败时只有这一篇退回 Build 的版本。
+    优化稿中没有可拆分的文件块时整体一次调用。
+    keep_output 为 False 时（不需要写入运行记录）不保留渲染结果，最终输出为空字符串。
+    返回 (最终输出, 写入的文件数, 失败的笔记数, 写入的文件名列表)。
+    """
+    os.makedirs(output_dir, exist_ok=True)
 
-def run_first_draft_generation(image_path, vision_agent, vision_prompt):
+    def render(text):
+        gen_prompt = prompt_set.render("gen", {prompts.GEN_SLOT: text})
+        return stream_files_from_chat(gen_agent, gen_prompt, output_dir, cache, "gen", keep_output)
+
+    def fallback(text):
+        saved_count = save_files_from_response(text, output_dir)
+        return text if keep_output else "", saved_count, written_notes(text) if saved_count else []
+
+    blocks = [(filename, content) for filename, content in notes.iter_file_blocks(refined_draft) if filename is not None]
+    if len(blocks) <= 1:
+        final_output, written = render(refined_draft)
+        if final_output is None or not written:
+            output, saved_count, written = fallback(refined_draft)
+            return output, saved_count, 1, written
+        return final_output, len(written), 0, written
+
+    # 单篇渲染时附上同批次的文件列表，便于模型添加指向其他笔记的链接
+    all_names = "、".join(notes.note_key(filename) for filename, _ in blocks)
+
+    def render_note(block):
+        unit = notes.format_file_block(*block) + f"\n\n（本批次的全部文件：{all_names}）"
+        if vault_index is not None:
+            existing_names = vault_index.related_names([block[1]], exclude=[block[0]])
+            if existing_names:
+                unit += f"\n（可以链接的已有笔记：{'、'.join(existing_names)}）"
+        output, written = render(unit)
+        if output is None or not written:
+            logging.error(f"笔记 {block[0]} 渲染失败，使用 Build 阶段的版本")
+            return (*fallback(notes.format_file_block(*block)), False)
+        return output, len(written), written, True
+
+    logging.info(f"Gen: 共 {len(blocks)} 篇笔记，最多 {max_workers} 个并行渲染")
+    results = [None] * len(blocks)
+    saved_count = 0
+    failed = 0
+    written = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_index = {executor.submit(render_note, block): i for i, block in enumerate(blocks)}
+        for future in concurrent.futures.as_completed(future_to_index):
+            i = future_to_index[future]
+            try:
+                output, saved, files, ok = future.result()
+            except Exception as e:
+                logging.error(f"笔记 {blocks[i][0]} 渲染时产生异常: {e}")
+                output, saved, files, ok = (*fallback(notes.format_file_block(*blocks[i])), False)
+            if not ok:
+                failed += 1
+            results[i] = output
+            saved_count += saved
+            written += files
+    return "\n".join(results) if keep_output else "", saved_count, failed, written
+
+def run_first_draft_generation(image_path, vision_agent, vision_prompt, cache=None, image_settings=None, image_pool=None,
+                               prepared=None):
     """
     工作单元函数，仅执行Stage 1：根据图片生成初稿。
-    被线程池中的每个线程调用。
+    被线程池中的每个线程调用。图片预处理提交到进程池 image_pool 执行，
+    与其他线程的网络请求并行；没有进程池时在当前线程执行。已预处理过的图片通过 prepared 传入。
     """
+    image_settings = image_settings or image.ImageSettings(enabled=False)
     thread_name = threading.current_thread().name
     image_name = os.path.basename(image_path)
     logging.info(f"[{thread_name}] 开始生成初稿: {image_name}")
     print(f"[{thread_name}] 开始生成初稿: {image_name}")
     
     try:
-        image_encoded = [Ai.encode_image(image_path)]
-        first_draft = vision_agent.chat(vision_prompt, image_encoded, False)
+        key = None
+        if cache is not None:
+            key = result_cache.make_key("vision", result_cache.RAW_ANSWER, result_cache.file_digest(image_path),
+                                        vision_agent.model_name, vision_agent.system_prompt, vision_prompt,
+                                        image_settings.cache_tag())
+            cached = cache.get(key)
+            if cached is not None:
+                logging.info(f"[{thread_name}] {image_name} 命中缓存，跳过模型调用。")
+                print(f"[{thread_name}] {image_name} 命中缓存。")
+                return cached
+        if prepared is None:
+            if image_pool is not None:
+                prepared = image_pool.submit(image.prepare_image, image_path, image_settings).result()
+            else:
+                prepared = image.prepare_image(image_path, image_settings)
+            image.log_saving(prepared)
+        # 初稿在 Build 和 Gen 都失败时会直接写入笔记，使用未格式化的回答
+        first_draft = vision_agent.chat(vision_prompt, [prepared.data_url], False, raw=True)
+        if key is not None and first_draft:
+            cache.put(key, first_draft, stage="vision", model=vision_agent.model_name, image=image_name)
         logging.info(f"[{thread_name}] 成功为 {image_name} 生成初稿。")
         print(f"[{thread_name}] 成功为 {image_name} 生成初稿。")
         return first_draft
@@ -154,104 +380,720 @@ def run_first_draft_generation(image_path, vision_agent, vision_prompt):
         print(f"[{thread_name}] 生成初稿失败 for {image_name}: {e}")
         return ""
 
-def v050():
-    # 同时运行的vision数量限制
-    concurrency = 10
-    
-    # --- 1. 配置与初始化 ---
+def run_batch_draft_generation(batch, vision_agent, vision_prompt, cache=None, image_settings=None, image_pool=None,
+                               batch_settings=None):
+    """
+    工作单元函数：把同一目录下相邻的多张图片放进一次 Vision 请求，主模板只发送一次。
+    返回 {图片路径: 初稿}：一次请求的初稿记在其中第一张图片上，其余图片记为空字符串；
+    预处理后按体积和 token 上限再拆分，某次请求失败时逐张退回单图请求，仍然失败的图片不出现在结果中。
+    """
+    image_settings = image_settings or image.ImageSettings(enabled=False)
+    batch_settings = batch_settings or image.BatchSettings()
+    results = {}
+
+    def single(image_path, prepared=None):
+        with logs.context(image=logs.image_label([image_path])):
+            draft = run_first_draft_generation(image_path, vision_agent, vision_prompt, cache, image_settings,
+                                               image_pool, prepared)
+        if draft and draft.strip():
+            results[image_path] = draft
+
+    if len(batch) == 1:
+        single(batch[0])
+        return results
+
+    thread_name = threading.current_thread().name
+    names = "、".join(os.path.basename(path) for path in batch)
+    logging.info(f"[{thread_name}] 开始为 {len(batch)} 张图片生成合并初稿: {names}")
+    print(f"[{thread_name}] 开始为 {len(batch)} 张图片生成合并初稿: {names}")
+
+    digests = {}
+
+    def batch_key(paths):
+        for path in paths:
+            if path not in digests:
+                digests[path] = result_cache.file_digest(path)
+        return result_cache.make_key("vision", result_cache.RAW_ANSWER, *(digests[path] for path in paths),
+                                     vision_agent.model_name,
+                                     vision_agent.system_prompt, image.batch_prompt(vision_prompt, len(paths)),
+                                     image_settings.cache_tag())
+
+    def record(paths, draft):
+        results[paths[0]] = draft
+        for path in paths[1:]:
+            results[path] = ""
+
+    try:
+        if cache is not None:
+            cached = cache.get(batch_key(batch))
+            if cached is not None:
+                logging.info(f"[{thread_name}] {names} 命中缓存，跳过模型调用。")
+                record(batch, cached)
+                return results
+        if image_pool is not None:
+            prepared_list = list(image_pool.map(image.prepare_image, batch, [image_settings] * len(batch)))
+        else:
+            prepared_list = [image.prepare_image(path, image_settings) for path in batch]
+    except Exception as e:
+        logging.error(f"[{thread_name}] 合并请求准备失败，逐张生成初稿: {e}")
+        for path in batch:
+            single(path)
+        return results
+
+    for prepared in prepared_list:
+        image.log_saving(prepared)
+    for group in image.split_batch(prepared_list, batch_settings):
+        paths = [prepared.path for prepared in group]
+        if len(group) == 1:
+            single(paths[0], group[0])
+            continue
+        try:
+            key = batch_key(paths) if cache is not None else None
+            # 整批的缓存在预处理前已经查过
+            draft = cache.get(key) if key is not None and paths != batch else None
+            if draft is None:
+                draft = vision_agent.chat(image.batch_prompt(vision_prompt, len(group)),
+                                          [prepared.data_url for prepared in group], False, raw=True)
+                if key is not None and draft and draft.strip():
+                    cache.put(key, draft, stage="vision", model=vision_agent.model_name, images=len(group))
+        except Exception as e:
+            logging.error(f"[{thread_name}] 合并请求异常: {e}")
+            draft = None
+        if draft and draft.strip():
+            logging.info(f"[{thread_name}] 成功为 {len(group)} 张图片生成合并初稿。")
+            record(paths, draft)
+            continue
+        logging.warning(f"[{thread_name}] {len(group)} 张图片的合并请求失败，逐张重新生成初稿")
+        for prepared in group:
+            single(prepared.path, prepared)
+    return results
+
+def load_settings(use_cache=True, purge_cache=False):
+    """
+    读取配置、初始化结果缓存，读取主模板和各阶段的包装Prompt并预编译（见 utils/prompts.py）。
+    返回 (配置, 缓存, prompts.PromptSet)。
+    """
     logging.info("--- 初始化配置与AI Agent ---")
     cur_path = os.path.dirname(os.path.abspath(__file__))
     keyexample = load_config(os.path.join(cur_path, 'keyexample.json'))
     cfg = file.Config("key-api.json",keyexample,True)
     cfg.load()
     conf = cfg.context
+    logs.configure(conf.get("logging"))
+    notewriter.configure(conf.get("writer"))
+    cache = result_cache.ResponseCache.from_config(conf.get("cache"), enabled=use_cache)
+    metrics.configure(conf.get("metrics"))
+    if purge_cache:
+        cache.purge()
     
-    # 读取主模板和三个阶段的包装Prompt
-    master_prompt = prompt_reader("master_prompt.txt")
-    vision_prompt_template = prompt_reader("vision.txt")
-    build_prompt_template = prompt_reader("build.txt")
-    gen_prompt_template = prompt_reader("gen.txt")
-    
-    # 构造完整的、可直接使用的Prompt
-    vision_prompt = vision_prompt_template.replace("[此处由程序粘贴 master_prompt.txt 的全部内容]", master_prompt)
-    
-    # Agent的角色现在都统一为知识库架构师，因为它们都遵循同一个主模板
-    vision_agent = Ai.LLM(conf["vision"]["api_key"], conf["vision"]["base_url"], conf["vision"]["model"], "你是一位知识库架构师大师")
-    build_agent = Ai.LLM(conf["review"]["api_key"], conf["review"]["base_url"], conf["review"]["model"], "你是一位知识库架构师大师")
-    gen_agent = Ai.LLM(conf["formatting"]["api_key"], conf["formatting"]["base_url"], conf["formatting"]["model"], "你是一位知识库架构师大师")
-
-    output_directory = os.path.join(cur_path, 'Obsidian-Notes')
+    # 读取主模板和各阶段的包装Prompt
+    templates = {
+        "master": prompt_reader("master_prompt.txt"),
+        "vision": prompt_reader("vision.txt"),
+        "build": prompt_reader("build.txt"),
+        "gen": prompt_reader("gen.txt"),
+        "merge": prompt_reader("merge.txt"),
+    }
+    return conf, cache, prompts.PromptSet.compile(templates)
 
-    # --- 2. 扇出 (Fan-out): 并行生成所有图片的初稿 ---
-    image_paths = get_image_paths()
+def open_journal(resume=None, dedup_settings=None, discovery_settings=None, image_paths=None):
+    """
+    新建或加载运行记录。返回 (运行记录, 图片列表)，没有图片时返回 (None, [])。
+    新建时处理 image_paths（未指定时查找全部图片），先去除重复拍摄的图片，
+    重复图片记录在运行记录中，随代表图片一起清理。
+    """
+    if resume:
+        journal = RunJournal.load(resume)
+        return journal, journal.images
+    if image_paths is None:
+        image_paths = get_image_paths(discovery_settings)
     if not image_paths:
         logging.warning("未找到任何图片，程序退出。")
+        return None, []
+    image_paths, duplicates = drop_duplicates(image_paths, dedup_settings)
+    return RunJournal.create(image_paths, duplicates=duplicates), image_paths
+
+def drop_duplicates(image_paths, dedup_settings=None):
+    """
+    去除重复拍摄的图片。返回 (需要处理的图片, {重复图片: 代表图片})，去重失败时处理全部图片。
+    """
+    duplicates = {}
+    if dedup_settings is not None:
+        try:
+            duplicates = dedup.find_duplicates(image_paths, dedup_settings)
+        except Exception as e:
+            logging.error(f"图片去重失败，处理全部图片: {e}")
+    if duplicates:
+        image_paths = [img_path for img_path in image_paths if img_path not in duplicates]
+        logging.info(f"去重: 跳过 {len(duplicates)} 张重复图片，实际处理 {len(image_paths)} 张")
+    return image_paths, duplicates
+
+def iter_runs(conf, resume=None, watch=False, stop=None):
+    """
+    依次产出需要处理的 (运行记录, 图片列表)。
+    普通模式只产出一次；监听模式下每监听到一批新图片就新建一次运行记录，直到 stop 被设置。
+    """
+    dedup_settings = dedup.DedupSettings.from_config(conf.get("dedup"))
+    discovery_settings = discovery.DiscoverySettings.from_config(conf.get("discovery"))
+    if not watch:
+        journal, image_paths = open_journal(resume, dedup_settings, discovery_settings)
+        if journal is not None:
+            yield journal, image_paths
         return
-        
-    logging.info(f"--- 阶段1 (并行): 发现 {len(image_paths)} 张图片，启动最多{concurrency}个线程生成初稿 ---")
-    
-    all_first_drafts = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-        future_to_image = {executor.submit(run_first_draft_generation, img_path, vision_agent, vision_prompt): img_path for img_path in image_paths}
-        for future in concurrent.futures.as_completed(future_to_image):
-            try:
-                result_draft = future.result()
-                if result_draft and result_draft.strip():
-                    all_first_drafts.append(result_draft)
-            except Exception as exc:
-                logging.error(f"处理图片 {os.path.basename(future_to_image[future])} 的结果时产生异常: {exc}")
-
-    if not all_first_drafts:
-        logging.warning("所有图片均未能生成有效初稿，程序终止。")
-        del_images(image_paths) 
+    for batch in discovery.watch(discovery_settings, stop):
+        journal, image_paths = open_journal(dedup_settings=dedup_settings, image_paths=batch)
+        if journal is not None:
+            yield journal, image_paths
+
+def sync_notes():
+    """
+    使本批写入的笔记持久化（目录 fsync、保存笔记清单），并报告新建 / 更新 / 未变化的笔记数。
+    删除图片之前调用，保证图片删除时笔记已经落盘。
+    """
+    writer = notewriter.get_writer()
+    writer.sync()
+    counts = writer.reset_counts()
+    if any(counts.values()):
+        logging.info(f"笔记写入统计: {notewriter.summarize(counts)}")
+        print(f"笔记写入统计: {notewriter.summarize(counts)}")
+
+def finish_run(journal, image_paths, drafts, saved_count):
+    """
+    笔记写入后的收尾：更新运行记录，只删除已生成初稿的图片，失败的图片留给续跑。
+    """
+    sync_notes()
+    if not saved_count:
+        logging.error(f"没有写入任何笔记，图片已保留，可使用 --resume {journal.run_id} 重试。")
         return
-        
-    # --- 3. 聚合与迭代优化 ---
-    # 将所有初稿聚合为一个大文本块
-    aggregated_draft = "\n".join(all_first_drafts)
+    journal.set_status("written", saved_files=saved_count)
     
-    # --- STAGE 2: Build - 结构与内容优化 ---
-    logging.info("--- 阶段2 (顺序): 开始对聚合后的草稿进行结构与内容优化 ---")
-    try:
-        build_prompt = build_prompt_template.replace("[此处由程序粘贴 Vision 阶段生成的草稿]", aggregated_draft)
-        build_prompt = build_prompt.replace("[此处由程序粘贴 master_prompt.txt 的全部内容]", master_prompt)
-        refined_draft = build_agent.chat(build_prompt)
-        logging.info("结构与内容优化完成。")
-    except Exception as e:
-        logging.error(f"阶段2 Build 失败: {e}")
-        refined_draft = aggregated_draft # 如果Build失败，就用原始草稿进行下一步
+    logging.info("--- 清理已处理的图片 ---")
+    missing = [img_path for img_path in image_paths if drafts.get(img_path) is None]
+    processed = [img_path for img_path in image_paths if drafts.get(img_path) is not None]
+    # 重复图片跟随代表图片：代表图片生成了初稿才删除
+    done = set(processed)
+    processed += [dup for dup, kept in journal.duplicates.items() if kept in done]
+    del_images([img_path for img_path in processed if os.path.exists(img_path)])
+    journal.set_status("done" if not missing else "partial")
+    
+    for base_url, stats in Ai.connection_stats().items():
+        logging.info(f"连接复用统计 {base_url}: 请求 {stats['requests']} 次，新建连接 {stats['new_connections']} 个，"
+                     f"复用 {stats['reused_connections']} 次")
+    for base_url, stats in ratelimit.limiter_stats().items():
+        if stats["throttled"] or stats["retries"]:
+            logging.info(f"限流统计 {base_url}: 被限流 {stats['throttled']} 次，重试 {stats['retries']} 次，"
+                         f"当前并发上限 {stats['concurrency_limit']}")
+    for stats in endpoints.pool_stats():
+        if stats["errors"] or stats["trips"]:
+            logging.info(f"接口池统计 {stats['model']}@{stats['base_url']}: 请求 {stats['requests']} 次，"
+                         f"失败 {stats['errors']} 次，熔断 {stats['trips']} 次，当前状态 {stats['state']}")
 
-    # --- STAGE 3: Gen - 最终格式化与渲染 ---
-    logging.info("--- 阶段3 (顺序): 开始进行最终的格式化与链接渲染 ---")
-    try:
-        gen_prompt = gen_prompt_template.replace("[此处由程序粘贴 Build 阶段生成的草稿]", refined_draft)
-        gen_prompt = gen_prompt.replace("[此处由程序粘贴 master_prompt.txt 的全部内容]", master_prompt)
-        final_output = gen_agent.chat(gen_prompt)
-        logging.info("最终渲染完成。")
-    except Exception as e:
-        logging.error(f"阶段3 Gen 失败: {e}")
-        final_output = refined_draft # 如果Gen失败，就使用Build的结果
+def fast_vision_conf(conf, routing_settings):
+    """
+    启用难度路由时返回快速视觉模型的配置段，未启用、配置缺失或 api_key 仍是 keyexample.json 中的示例值时返回 None
+    """
+    if not routing_settings.enabled:
+        return None
+    fast_conf = conf.get(routing_settings.fast)
+    if not fast_conf:
+        logging.warning(f"配置中没有 {routing_settings.fast} 段，跳过 Vision 难度路由")
+        return None
+    keyexample = load_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keyexample.json'))
+    if fast_conf.get("api_key") == keyexample.get(routing_settings.fast, {}).get("api_key"):
+        logging.warning(f"{routing_settings.fast} 段的 api_key 还是示例值，跳过 Vision 难度路由")
+        return None
+    return fast_conf
 
-    # --- 4. 文件写入与清理 ---
-    logging.info("--- 开始解析并写入最终文件 ---")
-    save_files_from_response(final_output, output_directory)
+def make_agents(conf, prompt_set, concurrency, routing_settings):
+    """
+    构造线程版本使用的 Agent。返回 ({fast / deep: Vision Agent}, Build Agent, Gen Agent)，
+    未启用难度路由时只有 deep。
+    """
+    build_conf = conf.get("build", {})
+    gen_conf = conf.get("gen", {})
+    # Agent的角色现在都统一为知识库架构师，因为它们都遵循同一个主模板
+    # 主模板放在所有 Agent 共用的系统提示中，每次请求的开头逐字节相同，便于接口侧的前缀缓存命中
+    # Vision 阶段由多个线程并发调用，每张图片都是独立请求，使用无状态会话，避免历史在线程间共享和膨胀
+    # 角色配置中的 endpoints 组成接口池，每次调用选择负载最低的健康接口
+    vision_agent = Ai.LLM.from_config(conf, "vision", prompt_set.system, history_policy="stateless",
+                                      max_connections=concurrency, role="vision")
+    vision_agents = {routing.DEEP: vision_agent}
+    if fast_vision_conf(conf, routing_settings) is not None:
+        vision_agents[routing.FAST] = Ai.LLM.from_config(conf, routing_settings.fast, prompt_set.system,
+                                                         history_policy="stateless", max_connections=concurrency,
+                                                         role=routing.ROLES[routing.FAST])
+    build_agent = Ai.LLM.from_config(conf, "review", prompt_set.system, history_policy="stateless",
+                                     max_connections=build_conf.get("fan_out", 4), role="build")
+    gen_agent = Ai.LLM.from_config(conf, "formatting", prompt_set.system, history_policy="stateless",
+                                   max_connections=gen_conf.get("max_workers", 4), role="gen")
+    return vision_agents, build_agent, gen_agent
+
+def v050(use_cache=True, purge_cache=False, resume=None, watch=False):
+    conf, cache, prompt_set = load_settings(use_cache, purge_cache)
+    # 同时运行的vision数量限制
+    concurrency = conf.get("pipeline", {}).get("vision_concurrency", 10)
+    build_conf = conf.get("build", {})
+    gen_conf = conf.get("gen", {})
     
-    logging.info("--- 清理已处理的图片 ---")
-    del_images(image_paths)
+    # 构造完整的、可直接使用的Prompt
+    vision_prompt = prompt_set.render("vision")
+    
+    # 难度路由：以文字为主的页面交给更快的视觉模型
+    routing_settings = routing.RoutingSettings.from_config(conf.get("vision_routing"))
+    vision_agents, build_agent, gen_agent = make_agents(conf, prompt_set, concurrency, routing_settings)
+
+    output_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Obsidian-Notes')
+
+    image_settings = image.ImageSettings.from_config(conf.get("image"))
+    batch_settings = image.BatchSettings.from_config(conf.get("vision_batch"))
+    vault_index = vault.VaultIndex.from_config(output_directory, conf.get("vault"))
+    linker_settings = linker.LinkerSettings.from_config(conf.get("linker"))
+
+    recorder = metrics.get_recorder()
+
+    def process(journal, image_paths, image_pool, executor):
+        # --- 2. 扇出 (Fan-out): 并行生成所有图片的初稿 ---
+        print(f"运行编号: {journal.run_id}（失败后可使用 --resume {journal.run_id} 续跑）")
+        recorder.begin_run(journal.run_id)
+
+        drafts = {img_path: journal.get_draft(img_path) for img_path in image_paths}
+        pending = [img_path for img_path, draft in drafts.items() if draft is None]
+        logging.info(f"--- 阶段1 (并行): 共 {len(image_paths)} 张图片，其中 {len(pending)} 张需要生成初稿，启动最多{concurrency}个线程 ---")
     
-    logging.info("--- 所有任务完成 ---")
+        routes = {}
+        if len(vision_agents) > 1:
+            with recorder.stage("routing"):
+                routes = routing.route_images(pending, routing_settings, image_pool)
+        # 合并请求只在同一条路线内分组
+        batches = [(route, batch) for route, paths in routing.split_routes(pending, routes).items()
+                   for batch in image.plan_batches(paths, batch_settings.max_images)]
+        if batch_settings.max_images > 1:
+            logging.info(f"多图合并请求: {len(pending)} 张图片分为 {len(batches)} 批，每批最多 {batch_settings.max_images} 张")
+        with recorder.stage("vision"):
+            future_to_batch = {executor.submit(logs.bound(run_batch_draft_generation, image=logs.image_label(batch)),
+                                               batch, vision_agents[route], vision_prompt, cache, image_settings,
+                                               image_pool, batch_settings): batch
+                               for route, batch in batches}
+            for future in concurrent.futures.as_completed(future_to_batch):
+                batch = future_to_batch[future]
+                try:
+                    for img_path, result_draft in future.result().items():
+                        drafts[img_path] = result_draft
+                        journal.save_draft(img_path, result_draft)
+                except Exception as exc:
+                    logging.error(f"处理图片 {[os.path.basename(p) for p in batch]} 的结果时产生异常: {exc}")
+
+        # 按图片顺序聚合，保证续跑时 Build 的输入与首次运行一致
+        all_first_drafts = [drafts[img_path] for img_path in image_paths if drafts[img_path]]
+        if not all_first_drafts:
+            logging.warning(f"所有图片均未能生成有效初稿，程序终止。图片已保留，可使用 --resume {journal.run_id} 重试。")
+            recorder.report()
+            return
+        # 合并请求中除第一张以外的图片记为空字符串，只有 None 表示失败
+        missing = [img_path for img_path in image_paths if drafts[img_path] is None]
+        if missing:
+            logging.warning(f"{len(missing)} 张图片未能生成初稿，将被保留以便续跑: {[os.path.basename(p) for p in missing]}")
+        
+        # --- 3. 聚合与迭代优化 ---
+        # 将所有初稿聚合为一个大文本块
+        aggregated_draft = "\n".join(all_first_drafts)
+    
+        # --- STAGE 2: Build - 结构与内容优化 ---
+        vault_index.refresh()
+        refined_draft = journal.get_stage("build")
+        if refined_draft is not None:
+            logging.info("--- 阶段2: 使用运行记录中已完成的结果 ---")
+        else:
+            logging.info("--- 阶段2 (顺序): 开始对聚合后的草稿进行结构与内容优化 ---")
+            try:
+                with recorder.stage("build"):
+                    refined_draft = run_build_stage(all_first_drafts, build_agent, prompt_set, cache,
+                                                    build_conf.get("batch_tokens", 24000),
+                                                    build_conf.get("fan_out", 4), vault_index)
+                if not refined_draft:
+                    raise RuntimeError("模型没有返回内容")
+                journal.save_stage("build", aggregated_draft, refined_draft)
+                logging.info("结构与内容优化完成。")
+            except Exception as e:
+                logging.error(f"阶段2 Build 失败: {e}")
+                refined_draft = aggregated_draft # 如果Build失败，就用原始草稿进行下一步
+
+        # --- STAGE 3: Gen - 最终格式化与渲染 ---
+        final_output = journal.get_stage("gen")
+        if final_output is not None:
+            logging.info("--- 阶段3: 使用运行记录中已完成的结果 ---")
+            logging.info("--- 开始解析并写入最终文件 ---")
+            saved_count = save_files_from_response(final_output, output_directory)
+        elif linker_settings.skip_gen:
+            logging.info("--- 阶段3: 跳过 Gen，直接写入 Build 的结果，链接由本地完成 ---")
+            final_output = refined_draft
+            saved_count = save_files_from_response(refined_draft, output_directory)
+            journal.save_stage("gen", refined_draft, final_output)
+        else:
+            logging.info("--- 阶段3 (并行): 开始逐篇进行最终的格式化与链接渲染，完成一篇写入一篇 ---")
+            try:
+                with recorder.stage("gen"):
+                    final_output, saved_count, failed, _ = run_gen_stage(refined_draft, gen_agent, prompt_set,
+                                                                      output_directory, cache,
+                                                                      gen_conf.get("max_workers", 4), vault_index)
+                if failed:
+                    logging.warning(f"{failed} 篇笔记渲染失败，已使用 Build 的结果；续跑时会重新渲染这些笔记")
+                else:
+                    journal.save_stage("gen", refined_draft, final_output)
+                logging.info("最终渲染完成。")
+            except Exception as e:
+                logging.error(f"阶段3 Gen 失败: {e}")
+                # 如果Gen失败，就使用Build的结果
+                final_output = refined_draft
+                saved_count = save_files_from_response(refined_draft, output_directory)
+
+        if linker_settings.enabled:
+            with recorder.stage("link"):
+                linker.link_notes(vault_index, written_notes(final_output), linker_settings)
+
+        # --- 4. 清理 ---
+        finish_run(journal, image_paths, drafts, saved_count)
+        recorder.report()
+
+    # 进程池、线程池、Agent 和 Prompt 在监听模式下的多次运行之间复用
+    with concurrent.futures.ProcessPoolExecutor(max_workers=image_settings.workers or None) as image_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for journal, image_paths in iter_runs(conf, resume, watch):
+            process(journal, image_paths, image_pool, executor)
+            if cache.enabled:
+                logging.info(f"缓存统计: 命中 {cache.hits} 次，未命中 {cache.misses} 次")
+            logging.info("--- 所有任务完成 ---")
+
+def v060(use_cache=True, purge_cache=False, resume=None, watch=False):
+    """
+    asyncio 版本的流水线：各阶段独立限流，Build / Gen 随初稿到达逐批启动，见 utils/pipeline.py。
+    """
+    conf, cache, prompt_set = load_settings(use_cache, purge_cache)
+    build_conf = conf.get("build", {})
+    gen_conf = conf.get("gen", {})
+    limits = {
+        "vision": conf.get("pipeline", {}).get("vision_concurrency", 10),
+        "build": build_conf.get("fan_out", 4),
+        "gen": gen_conf.get("max_workers", 4),
+    }
+
+    agents = {
+        stage: Ai.AsyncLLM.from_config(conf, role, prompt_set.system, history_policy="stateless",
+                                       max_connections=limits[stage], role=stage)
+        for stage, role in (("vision", "vision"), ("build", "review"), ("gen", "formatting"))
+    }
+    routing_settings = routing.RoutingSettings.from_config(conf.get("vision_routing"))
+    if fast_vision_conf(conf, routing_settings) is not None:
+        agents["vision_fast"] = Ai.AsyncLLM.from_config(conf, routing_settings.fast, prompt_set.system,
+                                                        history_policy="stateless", max_connections=limits["vision"],
+                                                        role=routing.ROLES[routing.FAST])
+    else:
+        routing_settings.enabled = False
+    output_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Obsidian-Notes')
+
+    image_settings = image.ImageSettings.from_config(conf.get("image"))
+    batch_settings = image.BatchSettings.from_config(conf.get("vision_batch"))
+    vault_index = vault.VaultIndex.from_config(output_directory, conf.get("vault"))
+    linker_settings = linker.LinkerSettings.from_config(conf.get("linker"))
+
+    recorder = metrics.get_recorder()
+
+    async def process(journal, image_paths, image_pool):
+        print(f"运行编号: {journal.run_id}（失败后可使用 --resume {journal.run_id} 续跑）")
+        recorder.begin_run(journal.run_id)
+        drafts = {img_path: journal.get_draft(img_path) for img_path in image_paths}
+
+        final_output = journal.get_stage("gen")
+        if final_output is not None:
+            logging.info("--- 使用运行记录中已完成的 Gen 结果 ---")
+            saved_count = save_files_from_response(final_output, output_directory)
+            written = written_notes(final_output)
+        else:
+            logging.info(f"--- 异步流水线: 共 {len(image_paths)} 张图片，并发上限 {limits} ---")
+            await asyncio.to_thread(vault_index.refresh)
+            engine = pipeline.AsyncPipeline(agents, prompt_set, output_directory, cache, journal, limits,
+                                            build_conf.get("batch_tokens", 24000), image_settings, image_pool,
+                                            batch_settings, vault_index, linker_settings.skip_gen, routing_settings)
+            # 异步流水线中各阶段相互重叠，只统计整条流水线的耗时，各阶段的活跃区间见调用统计
+            with recorder.stage("pipeline"):
+                drafts = await engine.run(image_paths, drafts)
+            saved_count = len(engine.saved_files)
+            written = engine.saved_files
+            if engine.failed_notes:
+                logging.warning(f"{engine.failed_notes} 篇笔记渲染失败，已使用 Build 的结果；续跑时会重新渲染这些笔记")
+
+        if linker_settings.enabled:
+            with recorder.stage("link"):
+                await asyncio.to_thread(linker.link_notes, vault_index, written, linker_settings)
+        finish_run(journal, image_paths, drafts, saved_count)
+        recorder.report()
+        if cache.enabled:
+            logging.info(f"缓存统计: 命中 {cache.hits} 次，未命中 {cache.misses} 次")
+        logging.info("--- 所有任务完成 ---")
+
+    async def run(image_pool):
+        # 监听模式下所有批次在同一个事件循环中处理，连接池在批次之间复用
+        stop = threading.Event()
+        runs = iter_runs(conf, resume, watch, stop)
+        try:
+            while True:
+                item = await asyncio.to_thread(next, runs, None)
+                if item is None:
+                    break
+                await process(*item, image_pool)
+        finally:
+            stop.set()
+            await Ai.close_async_clients()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=image_settings.workers or None) as image_pool:
+        asyncio.run(run(image_pool))
+
+def enqueue_images(paths=None):
+    """
+    把图片加入任务队列（utils/jobqueue.py），一次入队中同一目录下的图片为一个主题组。
+    paths 为图片或目录，省略时按 discovery 配置查找；仍在队列中处理的图片跳过。
+    去重和难度路由在入队时完成，工作进程只负责调用模型。返回新建的主题组编号。
+    """
+    conf = load_settings(use_cache=False)[0]
+    queue = jobqueue.JobQueue(jobqueue.QueueSettings.from_config(conf.get("queue")))
+    discovery_settings = discovery.DiscoverySettings.from_config(conf.get("discovery"))
+    if paths:
+        image_paths = [os.path.abspath(clean_path(path)) for path in paths if os.path.isfile(clean_path(path))]
+        directories = [clean_path(path) for path in paths if os.path.isdir(clean_path(path))]
+        if directories:
+            discovery_settings.roots = directories
+            image_paths += get_image_paths(discovery_settings)
+    else:
+        image_paths = get_image_paths(discovery_settings)
+    queued = queue.queued_images()
+    image_paths = [img_path for img_path in dict.fromkeys(image_paths) if img_path not in queued]
+    if not image_paths:
+        print("没有需要入队的新图片")
+        return []
+
+    image_paths, duplicates = drop_duplicates(image_paths, dedup.DedupSettings.from_config(conf.get("dedup")))
+    routing_settings = routing.RoutingSettings.from_config(conf.get("vision_routing"))
+    routes = {}
+    if fast_vision_conf(conf, routing_settings) is not None:
+        routes = routing.route_images(image_paths, routing_settings)
+    groups = {}
+    for img_path in image_paths:
+        groups.setdefault(os.path.relpath(os.path.dirname(img_path)), []).append(img_path)
+    group_ids = queue.enqueue(groups, duplicates, routes)
+    message = f"已入队 {len(image_paths)} 张图片，共 {len(group_ids)} 个主题组" + \
+        (f"（跳过 {len(duplicates)} 张重复图片）" if duplicates else "")
+    logging.info(message)
+    print(message)
+    return group_ids
+
+def finish_group(queue, group_id, saved_count):
+    """
+    主题组的笔记写入后清理图片：只删除已生成初稿的图片，重复图片跟随代表图片。
+    """
+    sync_notes()
+    drafts = dict(queue.drafts(group_id))
+    done = {img_path for img_path, draft in drafts.items() if draft is not None}
+    processed = list(done) + [dup for dup, kept in queue.group(group_id)["duplicates"].items() if kept in done]
+    del_images([img_path for img_path in processed if os.path.exists(img_path)])
+    queue.set_saved(group_id, saved_count)
+    missing = len(drafts) - len(done)
+    if missing:
+        logging.warning(f"主题组 {group_id} 有 {missing} 张图片未能生成初稿，已保留")
+
+def run_workers(workers=0, use_cache=True, exit_when_idle=False):
+    """
+    运行任务队列的工作线程：每个线程循环领取 gen / build / vision 任务（先完成已经进行到后面阶段的主题组）。
+    多个进程或多台机器可以共用同一个队列数据库同时运行，处理能力随工作线程数增加；
+    进程崩溃时未完成的任务在租约过期后由其他工作线程重新领取。
+    """
+    conf, cache, prompt_set = load_settings(use_cache)
+    queue_settings = jobqueue.QueueSettings.from_config(conf.get("queue"))
+    queue = jobqueue.JobQueue(queue_settings)
+    workers = workers or queue_settings.workers
+    build_conf = conf.get("build", {})
+    gen_conf = conf.get("gen", {})
+    vision_prompt = prompt_set.render("vision")
+    # 入队时已经完成路由，这里只需要构造对应的 Agent；每个工作线程同时只有一个 Vision 请求
+    routing_settings = routing.RoutingSettings.from_config(conf.get("vision_routing"))
+    vision_agents, build_agent, gen_agent = make_agents(conf, prompt_set, workers, routing_settings)
+
+    output_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Obsidian-Notes')
+    image_settings = image.ImageSettings.from_config(conf.get("image"))
+    batch_settings = image.BatchSettings.from_config(conf.get("vision_batch"))
+    vault_index = vault.VaultIndex.from_config(output_directory, conf.get("vault"))
+    linker_settings = linker.LinkerSettings.from_config(conf.get("linker"))
+    # 笔记库索引在进程内共用，刷新和链接不与其他工作线程同时进行
+    vault_lock = threading.Lock()
+
+    recorder = metrics.get_recorder()
+    recorder.begin_run(f"queue-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+
+    def run_vision(jobs, image_pool):
+        by_path = {job.image: job for job in jobs}
+        # 没有配置快速模型的工作进程用 vision 模型处理所有图片
+        agent = vision_agents.get(jobs[0].route or routing.DEEP, vision_agents[routing.DEEP])
+        with logs.context(image=logs.image_label(by_path)):
+            results = run_batch_draft_generation(list(by_path), agent, vision_prompt, cache, image_settings,
+                                                 image_pool, batch_settings)
+        for img_path, job in by_path.items():
+            if img_path in results:
+                queue.complete(job, results[img_path])
+            else:
+                queue.fail(job, "未能生成初稿")
+
+    def run_build(job):
+        drafts = [draft for _, draft in queue.drafts(job.group_id) if draft]
+        with vault_lock:
+            vault_index.refresh()
+        try:
+            refined_draft = run_build_stage(drafts, build_agent, prompt_set, cache, build_conf.get("batch_tokens", 24000),
+                                            build_conf.get("fan_out", 4), vault_index)
+            if not refined_draft:
+                raise RuntimeError("模型没有返回内容")
+        except Exception as e:
+            # 与 v050 相同，Build 失败时用原始草稿继续
+            logging.error(f"主题组 {job.group_id} Build 失败，使用原始草稿: {e}")
+            refined_draft = "\n".join(drafts)
+        queue.complete(job, refined_draft)
+
+    def run_gen(job):
+        refined_draft = queue.result(job.group_id, "build")
+        if linker_settings.skip_gen:
+            saved_count = save_files_from_response(refined_draft, output_directory)
+            written = written_notes(refined_draft)
+        else:
+            # 队列不保存 Gen 的结果，渲染结果写入笔记后即可丢弃
+            _, saved_count, failed, written = run_gen_stage(refined_draft, gen_agent, prompt_set, output_directory,
+                                                            cache, gen_conf.get("max_workers", 4), vault_index,
+                                                            keep_output=False)
+            if failed:
+                logging.warning(f"主题组 {job.group_id} 有 {failed} 篇笔记渲染失败，已使用 Build 的结果")
+        if not saved_count:
+            raise RuntimeError("没有写入任何笔记")
+        if linker_settings.enabled:
+            with vault_lock:
+                linker.link_notes(vault_index, written, linker_settings)
+        finish_group(queue, job.group_id, saved_count)
+        queue.complete(job)
+
+    stop = threading.Event()
+    heartbeat = jobqueue.Heartbeat(queue)
+
+    def work(index, image_pool):
+        name = jobqueue.worker_name(index)
+        while not stop.is_set():
+            try:
+                jobs = queue.claim(name, batch_settings.max_images)
+            except Exception as e:
+                logging.error(f"[{name}] 领取任务失败: {e}")
+                stop.wait(queue_settings.poll_interval)
+                continue
+            if not jobs:
+                if exit_when_idle and queue.idle():
+                    break
+                stop.wait(queue_settings.poll_interval)
+                continue
+            kind = jobs[0].kind
+            logging.info(f"[{name}] 领取 {kind} 任务 {[job.id for job in jobs]}（主题组 {jobs[0].group_id}）")
+            with heartbeat.hold(jobs), recorder.stage(kind):
+                try:
+                    if kind == "vision":
+                        run_vision(jobs, image_pool)
+                    elif kind == "build":
+                        run_build(jobs[0])
+                    else:
+                        run_gen(jobs[0])
+                except Exception as e:
+                    logging.error(f"[{name}] {kind} 任务 {[job.id for job in jobs]} 异常: {e}")
+                    for job in jobs:
+                        queue.fail(job, f"{type(e).__name__}: {e}")
+
+    print(f"启动 {workers} 个工作线程，队列: {os.path.normpath(queue.path)}")
+    logging.info(f"--- 任务队列: 启动 {workers} 个工作线程，队列 {queue.path} ---")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=image_settings.workers or None) as image_pool:
+        threads = [threading.Thread(target=work, args=(i, image_pool), name=f"queue-worker-{i}", daemon=True)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            logging.info("收到停止信号，等待正在处理的任务完成")
+            print("正在停止，等待正在处理的任务完成（再次 Ctrl+C 强制退出，未完成的任务会在租约过期后重新领取）")
+            stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            heartbeat.stop()
+            recorder.report()
+    if cache.enabled:
+        logging.info(f"缓存统计: 命中 {cache.hits} 次，未命中 {cache.misses} 次")
+    logging.info("--- 工作线程已全部退出 ---")
+
+def print_status():
+    """
+    打印任务队列的状态：各类任务的数量、租约过期的任务、活跃的工作线程和每个主题组的进度。
+    """
+    conf = load_settings(use_cache=False)[0]
+    queue = jobqueue.JobQueue(jobqueue.QueueSettings.from_config(conf.get("queue")))
+    status = queue.status()
+    print(f"队列: {os.path.normpath(queue.path)}")
+    for kind, states in status["jobs"].items():
+        counts = "，".join(f"{state} {count}" for state, count in sorted(states.items())) or "无"
+        print(f"  {kind}: {counts}")
+    print(f"租约过期待重新领取: {status['expired']}，活跃工作线程: {len(status['workers'])}")
+    for worker in status["workers"]:
+        print(f"  {worker}")
+    finished = [group for group in status["groups"] if group["state"] == "done"]
+    if finished:
+        print(f"已完成主题组: {len(finished)} 个，写入笔记 {sum(group['saved'] for group in finished)} 篇")
+    for group in status["groups"]:
+        if group["state"] == "done":
+            continue
+        print(f"  #{group['id']} {group['name']} [{group['state']}] 初稿 {group['drafted']}/{group['images']}"
+              + (f"（失败 {group['failed']}）" if group["failed"] else ""))
+    return status
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="根据图片生成 Obsidian 双链笔记")
+    parser.add_argument("--no-cache", action="store_true", help="不读取也不写入结果缓存")
+    parser.add_argument("--purge-cache", action="store_true", help="运行前清空结果缓存")
+    parser.add_argument("--resume", metavar="RUN_ID", help="续跑指定编号的运行，跳过已完成的阶段")
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread",
+                        help="thread: 线程池版本 (v050)；async: asyncio 流水线 (v060)")
+    parser.add_argument("--watch", action="store_true",
+                        help="常驻监听图片目录，新图片写入完成后攒成小批次处理（配置 discovery 段）")
+    commands = parser.add_subparsers(dest="command", metavar="命令",
+                                     help="省略时直接处理当前图片；enqueue / work / status 使用任务队列（配置 queue 段）")
+    enqueue = commands.add_parser("enqueue", help="把图片加入任务队列，同一目录下的图片为一个主题组")
+    enqueue.add_argument("paths", nargs="*", help="图片或目录，省略时按 discovery 配置查找")
+    work = commands.add_parser("work", help="运行工作线程处理任务队列，可在多个进程或机器上同时运行")
+    work.add_argument("--workers", type=int, default=0, help="工作线程数，默认取配置 queue.workers")
+    work.add_argument("--exit-when-idle", action="store_true", help="队列中没有任务时退出，而不是继续等待")
+    commands.add_parser("status", help="查看任务队列的状态")
+    args = parser.parse_args(argv)
+    if args.watch and args.resume:
+        parser.error("--watch 不能与 --resume 同时使用")
+    if args.command and (args.watch or args.resume):
+        parser.error("--watch / --resume 不能与队列命令同时使用")
+    return args
 
 if __name__ == "__main__":
-    # log
-    current_dir = os.path.dirname(__file__)
-    log_dir = os.path.join(current_dir, 'log')
-    os.makedirs(log_dir, exist_ok=True)
-    log_file_path = os.path.join(log_dir, 'main.log')
-    logging.basicConfig(
-        filename=log_file_path,
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
-    )
+    args = parse_args()
+    # log：读取配置前先按默认参数写入 log/main.log，load_settings 中再按 logging 段重新配置
+    logs.setup()
     # 主要部分
-    v050()
+    run = v060 if args.engine == "async" else v050
+    try:
+        if args.command == "enqueue":
+            enqueue_images(args.paths)
+        elif args.command == "work":
+            run_workers(args.workers, use_cache=not args.no_cache, exit_when_idle=args.exit_when_idle)
+        elif args.command == "status":
+            print_status()
+        else:
+            run(use_cache=not args.no_cache, purge_cache=args.purge_cache, resume=args.resume, watch=args.watch)
+    except KeyboardInterrupt:
+        logging.info("已手动停止")
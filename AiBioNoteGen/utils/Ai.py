@@ -1,31 +1,442 @@
 import base64
+import functools
 import json
 import requests
 import logging
 import os
-from openai import OpenAI
-from typing import List, Optional, Union
+import threading
+import time
+import httpx
+import asyncio
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI, DefaultHttpxClient
+from typing import Callable, List, Optional, Union
+try:
+    from . import budget, endpoints, hedge, image, logs, metrics, ratelimit
+except ImportError:  # 直接运行 utils/Ai.py 时
+    import budget
+    import endpoints
+    import hedge
+    import image
+    import logs
+    import metrics
+    import ratelimit
 
 def log_init():
-    current_dir = os.path.dirname(__file__)
-    log_dir = os.path.join(current_dir, '..', 'log')
-    os.makedirs(log_dir, exist_ok=True)
-    log_file_path = os.path.join(log_dir, 'Ai.log')
-    logging.basicConfig(
-        filename=log_file_path,
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
-    )
+    logs.setup(logs.LogSettings(path=os.path.join(logs.LOG_DIR, 'Ai.log')))
+
+
+class ConnectionStats:
+    """统计某个接口的HTTP请求数与新建连接数，用于确认连接池确实被复用"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def on_request(self, request: httpx.Request):
+        """httpx 请求钩子：计数并挂上 httpcore 的 trace 回调"""
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name: str, info: dict):
+        # 只有新建连接时 httpcore 才会触发 connect_tcp 事件，复用连接时不会
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    async def on_request_async(self, request: httpx.Request):
+        """异步 httpx 客户端使用的请求钩子，异步连接池要求 trace 回调也是协程"""
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._trace_async
+
+    async def _trace_async(self, event_name: str, info: dict):
+        self._trace(event_name, info)
+
+    @property
+    def reused_connections(self) -> int:
+        return max(self.requests - self.new_connections, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(self.requests - self.new_connections, 0),
+            }
+
+
+# 每个 (base_url, api_key) 共享一个长连接客户端
+_clients = {}
+_clients_lock = threading.Lock()
+_closed_stats = []
+
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+
+
+def get_client(api_key: str, base_url: str, max_connections: Optional[int] = None,
+               keepalive_expiry: Optional[float] = None) -> OpenAI:
+    """获取（必要时创建）某个接口共享的 OpenAI 客户端
+
+    OpenAI 客户端和底层 httpx 连接池都是线程安全的，同一接口的所有 LLM 实例和线程共用一个。
+    连接池大小只在第一次创建时生效，应与调用方的并发数保持一致。
+
+    Args:
+        api_key (str): API密钥
+        base_url (str): 接口地址
+        max_connections (Optional[int]): 连接池最大连接数（同时也是保持的长连接数）
+        keepalive_expiry (Optional[float]): 空闲长连接的保持时间（秒）
+
+    Returns:
+        OpenAI: 共享的客户端
+    """
+    key = (base_url, api_key)
+    max_connections = max_connections or DEFAULT_MAX_CONNECTIONS
+    keepalive_expiry = keepalive_expiry or DEFAULT_KEEPALIVE_EXPIRY
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            stats = ConnectionStats()
+            http_client = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+                event_hooks={"request": [stats.on_request]},
+            )
+            # 重试由 ratelimit 统一处理，关闭 SDK 自带的重试，限流错误才能被限流器感知
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+            entry = _clients[key] = {"client": client, "stats": stats, "max_connections": max_connections}
+            logging.info(f"创建连接池: {base_url} (最大连接数 {max_connections})")
+        elif max_connections > entry["max_connections"]:
+            logging.warning(f"{base_url} 的连接池已按 {entry['max_connections']} 个连接创建，"
+                            f"忽略新的连接数 {max_connections}")
+        return entry["client"]
+
+
+def get_async_client(api_key: str, base_url: str, max_connections: Optional[int] = None,
+                     keepalive_expiry: Optional[float] = None) -> AsyncOpenAI:
+    """获取（必要时创建）某个接口在当前事件循环中共享的 AsyncOpenAI 客户端
+
+    异步连接池绑定在创建它的事件循环上，因此按 (base_url, api_key, 事件循环) 共享，
+    连接复用统计与同步客户端合并在 connection_stats() 中。必须在事件循环内调用。
+    """
+    loop = asyncio.get_running_loop()
+    key = (base_url, api_key, id(loop))
+    max_connections = max_connections or DEFAULT_MAX_CONNECTIONS
+    keepalive_expiry = keepalive_expiry or DEFAULT_KEEPALIVE_EXPIRY
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            stats = ConnectionStats()
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+                event_hooks={"request": [stats.on_request_async]},
+            )
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+            entry = _clients[key] = {"client": client, "stats": stats, "max_connections": max_connections}
+            logging.info(f"创建异步连接池: {base_url} (最大连接数 {max_connections})")
+        return entry["client"]
+
+
+def connection_stats() -> dict:
+    """获取所有共享客户端的连接复用统计
+
+    Returns:
+        dict: {base_url: {"requests", "new_connections", "reused_connections"}}，
+            同一 base_url 的多个密钥会合并统计
+    """
+    result = {}
+    with _clients_lock:
+        entries = [(key[0], entry["stats"]) for key, entry in _clients.items()] + list(_closed_stats)
+    for base_url, stats in entries:
+        snap = stats.snapshot()
+        total = result.setdefault(base_url, {k: 0 for k in snap})
+        for k, v in snap.items():
+            total[k] += v
+    return result
+
+
+def close_clients():
+    """关闭所有共享的同步客户端，释放连接"""
+    with _clients_lock:
+        keys = [key for key, entry in _clients.items() if isinstance(entry["client"], OpenAI)]
+        entries = [_clients.pop(key) for key in keys]
+        _closed_stats.extend((key[0], entry["stats"]) for key, entry in zip(keys, entries))
+    for entry in entries:
+        entry["client"].close()
+
+
+async def close_async_clients():
+    """关闭当前事件循环中共享的异步客户端"""
+    loop_id = id(asyncio.get_running_loop())
+    with _clients_lock:
+        keys = [key for key in _clients if len(key) == 3 and key[2] == loop_id]
+        entries = [_clients.pop(key) for key in keys]
+        # 保留已关闭客户端的统计，运行结束后仍可汇总
+        _closed_stats.extend((key[0], entry["stats"]) for key, entry in zip(keys, entries))
+    for entry in entries:
+        await entry["client"].close()
+
+
+class Conversation:
+    """单个会话的消息历史，带有显式的历史保留策略
+
+    Attributes:
+        policy (str): 历史策略，可选值：
+            - "stateless": 不保留历史，每次请求只发送系统提示和当前消息
+            - "unbounded": 保留全部历史（旧版 LLM.chat 的行为）
+            - "turns": 只保留最近 max_turns 轮对话
+            - "budget": 按字节/估算token预算保留历史，超出时从最早的轮次开始淘汰
+        messages (list): 当前保留的消息列表，第一条始终是系统提示
+    """
+    POLICIES = ("stateless", "unbounded", "turns", "budget")
+
+    def __init__(self, system_prompt: str, policy: str = "unbounded", max_turns: Optional[int] = None,
+                 max_bytes: Optional[int] = None, max_tokens: Optional[int] = None):
+        """初始化会话
+
+        Args:
+            system_prompt (str): 系统提示
+            policy (str): 历史策略，见类说明
+            max_turns (Optional[int]): "turns" 策略下保留的最大轮数
+            max_bytes (Optional[int]): "budget" 策略下历史的最大字节数
+            max_tokens (Optional[int]): "budget" 策略下历史的最大估算token数
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知的历史策略: {policy}")
+        if policy == "turns" and not max_turns:
+            raise ValueError("turns 策略需要指定 max_turns")
+        if policy == "budget" and not (max_bytes or max_tokens):
+            raise ValueError("budget 策略需要指定 max_bytes 或 max_tokens")
+        self.policy = policy
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.messages = [{"role": "system", "content": system_prompt}]
+        self._lock = threading.Lock()
+
+    @property
+    def system_prompt(self) -> str:
+        return self.messages[0]["content"]
+
+    def build_request(self, user_message: dict) -> list:
+        """根据策略构造本次请求要发送的消息列表（不修改历史）"""
+        with self._lock:
+            if self.policy == "stateless":
+                return [self.messages[0], user_message]
+            return list(self.messages) + [user_message]
+
+    def record(self, user_message: dict, assistant_message: dict):
+        """记录一轮完成的对话，并按策略淘汰最早的轮次"""
+        if self.policy == "stateless":
+            return
+        with self._lock:
+            self.messages.append(user_message)
+            self.messages.append(assistant_message)
+            self._evict()
+
+    def _evict(self):
+        if self.policy == "turns":
+            while self.turn_count() > self.max_turns:
+                del self.messages[1:3]
+        elif self.policy == "budget":
+            # 至少保留最近一轮，避免单轮超预算时把历史清空成只剩系统提示
+            while self.turn_count() > 1 and self._over_budget():
+                del self.messages[1:3]
+
+    def _over_budget(self) -> bool:
+        history = self.messages[1:]
+        if self.max_bytes and sum(message_bytes(m) for m in history) > self.max_bytes:
+            return True
+        if self.max_tokens and sum(estimate_tokens(message_text(m)) for m in history) > self.max_tokens:
+            return True
+        return False
+
+    def turn_count(self) -> int:
+        """获取对话轮数（不包括系统提示）"""
+        return (len(self.messages) - 1) // 2
+
+    def clear(self):
+        """清除对话历史，只保留系统提示"""
+        with self._lock:
+            self.messages = [self.messages[0]]
+
+
+def _role_stage(method):
+    """调用期间的日志以 LLM 的角色作为 stage 字段（见 utils/logs.py）"""
+    if asyncio.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with logs.context(stage=self.role):
+                return await method(self, *args, **kwargs)
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with logs.context(stage=self.role):
+                return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _StreamCollector:
+    """处理流式回答的每个分块：区分思考过程与回答内容，按需打印、回调和保留
+
+    同时记录首 token / 首个回答 token 的时间（time.perf_counter）、两部分的字符数，以及接口返回的 usage。
+    """
+    def __init__(self, streaming_output: bool, on_answer: Optional[Callable[[str], None]] = None,
+                 keep_answer: bool = True):
+        self.streaming_output = streaming_output
+        self.on_answer = on_answer
+        self.keep_answer = keep_answer
+        self.reasoning_parts = []
+        self.answer_parts = []
+        self.is_answering = False
+        # 是否已经把回答交给 on_answer，交出后请求不能再重试，否则回调会收到重复内容
+        self.answered = False
+        self.first_token = None
+        self.first_answer = None
+        # 按 (中日韩字符数, 其他字符数) 计数，回答不保留时也能估算 token 数
+        self.reasoning_chars = [0, 0]
+        self.answer_chars = [0, 0]
+        self.usage = None
+        # 本路请求使用的接口、发出时间（time.perf_counter）和所属的对冲竞争，由 LLM._leg 设置
+        self.member = None
+        self.sent = None
+        self.race = None
+
+    def start(self):
+        if self.streaming_output:
+            print("\n" + "="*50)
+            print("🤔 思考过程:")
+            print("="*50)
+
+    def handle(self, chunk):
+        # 开启 include_usage 时最后一个分块没有 choices，只带 usage
+        if getattr(chunk, 'usage', None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+            
+        delta = chunk.choices[0].delta
+        # 处理思考过程
+        if hasattr(delta, 'reasoning_content') and delta.reasoning_content is not None:
+            if delta.reasoning_content and self.first_token is None:
+                self.first_token = time.perf_counter()
+            _count_chars(delta.reasoning_content, self.reasoning_chars)
+            self.reasoning_parts.append(delta.reasoning_content)
+            if self.streaming_output:
+                print(delta.reasoning_content, end='', flush=True)
+        else:
+            # 处理回复内容
+            if hasattr(delta, 'content') and delta.content is not None:
+                if delta.content != "" and self.is_answering is False:
+                    # 对冲时先开始回答的一路胜出，落败的一路不能把回答交给调用方
+                    if self.race is not None and not self.race.claim(self):
+                        raise hedge.HedgeLost()
+                    self.is_answering = True
+                    self.first_answer = time.perf_counter()
+                    if self.first_token is None:
+                        self.first_token = self.first_answer
+                    if self.streaming_output:
+                        print("\n" + "="*50)
+                        print("💡 回答结果:")
+                        print("="*50)
+                _count_chars(delta.content, self.answer_chars)
+                if self.keep_answer:
+                    self.answer_parts.append(delta.content)
+                if self.on_answer is not None:
+                    self.answered = True
+                    self.on_answer(delta.content)
+                if self.streaming_output:
+                    print(delta.content, end='', flush=True)
+
+    def finish(self) -> str:
+        if self.streaming_output:
+            print("\n" + "="*50)
+        return "".join(self.answer_parts)
 
 
 class LLM:
-    def __init__(self, api_key, base_url, model_name, system_prompt = "使用中文回答用户的问题"):
-        
+    def __init__(self, api_key, base_url, model_name, system_prompt = "使用中文回答用户的问题",
+                 history_policy: str = "unbounded", max_connections: Optional[int] = None,
+                 keepalive_expiry: Optional[float] = None, rate_limit: Optional[dict] = None, role: str = "",
+                 limits: Optional[dict] = None, pool: Optional[List[dict]] = None, failover: Optional[dict] = None,
+                 hedging: Optional[dict] = None, **history_limits):
+        """
+        Args:
+            api_key: API密钥（接口池中的第一个接口）
+            base_url: 接口地址
+            model_name: 模型名称，同时用作结果缓存的键
+            system_prompt: 系统提示
+            history_policy: 默认会话的历史策略，见 Conversation
+            max_connections: 共享连接池的最大连接数，应与并发调用的线程数一致
+            keepalive_expiry: 空闲长连接的保持时间（秒）
+            rate_limit: 接口限流与重试配置，见 ratelimit.EndpointLimiter.from_config
+            role: 调用方角色（vision / build / gen 等），记录在调用指标中，见 metrics.CallRecord
+            limits: 生成预算与超时配置，见 budget.GenerationLimits
+            pool: 接口列表（见 endpoints.role_endpoints），省略时只使用上面的一个接口
+            failover: 熔断配置，见 endpoints.FailoverSettings
+            hedging: 对冲请求配置，见 hedge.HedgeSettings，默认不对冲
+            **history_limits: 传递给 Conversation 的 max_turns / max_bytes / max_tokens
+        """
         self.api_key = api_key
         self.base_url = base_url
         self.model_name = model_name
-        self.messages = [{"role": "system", "content": system_prompt}]
+        self.role = role or model_name
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.client = self._make_client()
+        pool = pool or [{"base_url": base_url, "api_key": api_key, "model": model_name, "rate_limit": rate_limit}]
+        self.pool = endpoints.EndpointPool.create(pool, failover, max_connections or DEFAULT_MAX_CONNECTIONS)
+        self.limiter = self.pool.primary.limiter
+        self.limits = budget.GenerationLimits.from_config(limits)
+        self.hedging = hedge.HedgePolicy(hedge.HedgeSettings.from_config(hedging))
+        self.system_prompt = system_prompt
+        self.conversation = Conversation(system_prompt, history_policy, **history_limits)
+
+    @classmethod
+    def from_config(cls, conf: dict, section: str, system_prompt: str, **kwargs) -> "LLM":
+        """按配置段创建，角色配置中的 endpoints 列表组成接口池（见 endpoints.role_endpoints）
+
+        Args:
+            conf (dict): 完整配置
+            section (str): 角色配置段，如 vision / review / formatting
+            system_prompt (str): 系统提示
+            **kwargs: 其余参数同 __init__（history_policy / max_connections / role 等）
+        """
+        pool = endpoints.role_endpoints(conf, section)
+        primary = pool[0]
+        return cls(primary["api_key"], primary["base_url"], primary["model"], system_prompt,
+                   rate_limit=primary.get("rate_limit"), limits=conf[section].get("limits"), pool=pool,
+                   failover=conf.get("failover"), hedging=conf[section].get("hedge"), **kwargs)
+
+    def _make_client(self):
+        return get_client(self.api_key, self.base_url, self.max_connections, self.keepalive_expiry)
+
+    def _client(self, member: "endpoints.Member") -> OpenAI:
+        return get_client(member.api_key, member.base_url, self.max_connections, self.keepalive_expiry)
+
+    @property
+    def messages(self):
+        return self.conversation.messages
+
+    def new_conversation(self, policy: str = "stateless", **limits) -> Conversation:
+        """创建一个独立的会话对象，可以在线程间或请求间单独使用
+
+        Args:
+            policy (str): 历史策略，见 Conversation
+            **limits: max_turns / max_bytes / max_tokens
+
+        Returns:
+            Conversation: 新会话，系统提示与本 LLM 相同
+        """
+        return Conversation(self.system_prompt, policy, **limits)
 
     def format_chinese_response(self, text):
         """格式化中文回答"""
@@ -82,83 +493,267 @@ class LLM:
             else:
                 content.append({
                     "type": "image_url", 
-                    "image_url": {"url": f"data:image/jpeg;base64,{img}"}
+                    "image_url": {"url": f"data:{image.detect_mime_base64(img)};base64,{img}"}
                 })
         return content
-        
-    def chat(self, text: str, images: Optional[Union[str, List[str]]] = None, streaming_output: bool = True) -> str | None:
+
+    def _stream_completion(self, messages: list, streaming_output: bool,
+                           on_answer: Optional[Callable[[str], None]] = None, keep_answer: bool = True) -> str:
+        """发送流式请求并收集回答内容，按接口限流，可重试的错误按退避策略重试
+
+        Args:
+            messages (list): 完整的请求消息列表
+            streaming_output (bool): 是否把思考过程和回答实时打印到终端
+            on_answer (Optional[Callable[[str], None]]): 每收到一段回答内容时调用
+            keep_answer (bool): 是否保留完整回答，为 False 时返回空字符串，内存占用与回答长度无关
+
+        Returns:
+            str: 未经格式化的回答内容
+        """
+        tokens = request_tokens(messages)
+        record, start = self._new_record(messages)
+        attempt = 0
+        tried = []
+        while True:
+            # 在途计数从排队开始，限流器中排队的请求也算作接口的负载
+            member = self.pool.pick(tried)
+            collector = primary = _StreamCollector(streaming_output, on_answer, keep_answer)
+            race = self._race()
+            if race is not None:
+                race.launch = functools.partial(self._launch_hedge, race, member, messages, tokens, on_answer,
+                                                keep_answer)
+            error = None
+            try:
+                self._leg(member, messages, tokens, collector, race, record)
+            except Exception as e:
+                error = e
+                # 原请求失败或落败时，对冲请求可能已经（或即将）得到结果
+                outcome = race.resolve(primary) if race is not None else None
+                if outcome is not None:
+                    collector, error = outcome
+                    member = collector.member
+            else:
+                if race is not None:
+                    race.close()
+            self._settle_race(record, race, primary, collector)
+            if error is None:
+                answer = collector.finish()
+                self._finish_record(record, start, collector.sent, collector, tokens, attempt, member=member)
+                return answer
+            if isinstance(error, budget.BudgetExceeded):
+                record.limit = error.kind
+            # 已经收到回答内容说明接口可用，按重试和降级策略处理
+            failover = not sum(collector.answer_chars) and self.pool.can_fail_over(member, error, tried)
+            if not failover and not self._should_retry(error, attempt - record.failovers, collector, member):
+                answer = self._degrade(error, collector)
+                self._finish_record(record, start, collector.sent, collector, tokens, attempt, error,
+                                    answer is not None, member)
+                if answer is not None:
+                    return answer
+                raise error
+            if failover:
+                tried.append(member)
+                record.failovers += 1
+                logging.warning(f"{member.endpoint.name} 请求失败，改用接口池中的其他接口: {error}")
+            else:
+                time.sleep(self._retry_delay(error, attempt, member))
+            attempt += 1
+
+    def _leg(self, member: "endpoints.Member", messages: list, tokens: int, collector: "_StreamCollector",
+             race: Optional["hedge.Race"] = None, record: Optional["metrics.CallRecord"] = None):
+        """发出一路流式请求并读完，结果留在 collector 中
+
+        失败时抛出异常，超出限制或被对冲的另一路取消时为 BudgetExceeded，落败时为 HedgeLost。
+
+        Args:
+            race: 所属的对冲竞争，为 None 时不对冲
+            record: 累计排队时间的调用指标，对冲请求不累计
+        """
+        collector.member = member
+        waited = time.perf_counter()
+        member.limiter.acquire(tokens)
+        collector.sent = time.perf_counter()
+        if record is not None:
+            record.queued += collector.sent - waited
+        error = None
+        guard = budget.StreamGuard(self.limits, collector, collector.sent, _estimate_counted)
+        collector.race = race
+        try:
+            if race is not None:
+                race.join(collector, functools.partial(guard.cancel, "hedge"))
+            with budget.watch(guard):
+                completion = self._client(member).chat.completions.create(**self._request_args(messages, member))
+                guard.attach(completion)
+                if guard.reason is not None:
+                    # 收到响应头之前已经被取消
+                    raise budget.BudgetExceeded(guard.reason)
+                collector.start()
+                for chunk in completion:
+                    collector.handle(chunk)
+                    guard.check()
+            if race is not None and not race.claim(collector):
+                raise hedge.HedgeLost()
+        except Exception as e:
+            error = guard.error(e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            member.limiter.release(error)
+            self.pool.done(member, error, _first_token_latency(collector, collector.sent))
+
+    def _race(self) -> Optional["hedge.Race"]:
+        """本次尝试的对冲竞争，未启用对冲或样本不足时为 None"""
+        delay = self.hedging.delay()
+        return None if delay is None else hedge.Race(self.hedging, delay, None)
+
+    def _launch_hedge(self, race: "hedge.Race", primary_member: "endpoints.Member", messages: list, tokens: int,
+                      on_answer: Optional[Callable[[str], None]], keep_answer: bool):
+        """在新线程中发出对冲请求，接口池中有其他接口时优先使用其他接口"""
+        member = self.pool.pick([primary_member])
+        collector = _StreamCollector(False, on_answer, keep_answer)
+
+        def run():
+            error = None
+            try:
+                self._leg(member, messages, tokens, collector, race)
+            except Exception as e:
+                error = e
+            finally:
+                race.settle(collector, error)
+
+        threading.Thread(target=logs.bound(run), name="hedge", daemon=True).start()
+
+    def _settle_race(self, record: "metrics.CallRecord", race: Optional["hedge.Race"], primary: "_StreamCollector",
+                     collector: "_StreamCollector"):
+        """记录对冲结果，并把首个回答 token 的延迟（从原请求发出算起）加入对冲策略的样本"""
+        if race is not None and race.hedged:
+            record.hedged = True
+            if collector is not primary:
+                record.hedge_won = True
+                record.hedge_saved = race.saved
+        if self.hedging.enabled and collector.first_answer is not None:
+            self.hedging.observe(collector.first_answer - primary.sent)
+
+    def _request_args(self, messages: list, member: "endpoints.Member") -> dict:
+        args = {"model": member.model, "messages": messages, "stream": True}
+        if metrics.get_recorder().settings.stream_usage:
+            args["stream_options"] = {"include_usage": True}
+        args.update(self.limits.request_args())
+        return args
+
+    def _degrade(self, error: Exception, collector: "_StreamCollector") -> Optional[str]:
+        """超出限制且策略为 degrade 时，返回已经收到的部分回答；否则返回 None"""
+        if not isinstance(error, budget.BudgetExceeded) or self.limits.on_limit != "degrade":
+            return None
+        if not sum(collector.answer_chars):
+            return None
+        logging.warning(f"{self.model_name} {error}，使用已收到的部分回答")
+        return collector.finish()
+
+    def _new_record(self, messages: list):
+        """创建本次调用的指标记录，返回 (记录, 开始时的 perf_counter)"""
+        images = 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list):
+                images += sum(1 for part in content if part.get("type") == "image_url")
+        record = metrics.CallRecord(self.role, self.model_name, self.base_url, started=time.time(),
+                                    request_bytes=sum(message_bytes(m) for m in messages), images=images)
+        return record, time.perf_counter()
+
+    def _finish_record(self, record: "metrics.CallRecord", start: float, sent: float, collector: "_StreamCollector",
+                       prompt_tokens: int, attempt: int, error: Optional[Exception] = None, degraded: bool = False,
+                       member: Optional["endpoints.Member"] = None):
+        now = time.perf_counter()
+        if member is not None:
+            # 记录最后一次尝试实际使用的接口
+            record.model = member.model
+            record.base_url = member.base_url
+        record.sent = record.started + (sent - start)
+        record.duration = now - start
+        if collector.first_token is not None:
+            record.ttft = collector.first_token - sent
+        if collector.first_answer is not None:
+            record.ttfa = collector.first_answer - sent
+        record.reasoning_chars = sum(collector.reasoning_chars)
+        record.answer_chars = sum(collector.answer_chars)
+        record.prompt_tokens = prompt_tokens
+        record.reasoning_tokens = _estimate_counted(collector.reasoning_chars)
+        record.answer_tokens = _estimate_counted(collector.answer_chars)
+        usage = collector.usage
+        if usage is not None:
+            record.usage = True
+            record.prompt_tokens = getattr(usage, "prompt_tokens", None) or prompt_tokens
+            record.cached_tokens = _cached_tokens(usage)
+            details = getattr(usage, "completion_tokens_details", None)
+            reasoning = getattr(details, "reasoning_tokens", None) if details is not None else None
+            if reasoning is not None:
+                record.reasoning_tokens = reasoning
+            completion_tokens = getattr(usage, "completion_tokens", None)
+            if completion_tokens is not None:
+                record.answer_tokens = max(0, completion_tokens - record.reasoning_tokens)
+        record.retries = attempt
+        if degraded:
+            record.degraded = True
+        elif error is not None:
+            record.ok = False
+            record.error = type(error).__name__
+        metrics.get_recorder().record(record)
+
+    def _should_retry(self, error: Exception, attempt: int, collector: "_StreamCollector",
+                      member: "endpoints.Member") -> bool:
+        if attempt >= member.limiter.retry.max_retries or collector.answered:
+            return False
+        if isinstance(error, budget.BudgetExceeded):
+            return self.limits.on_limit == "retry"
+        return ratelimit.is_retryable(error)
+
+    def _retry_delay(self, error: Exception, attempt: int, member: "endpoints.Member") -> float:
+        delay = member.limiter.retry.delay(attempt, ratelimit.retry_after_seconds(error))
+        member.limiter.retries += 1
+        logging.warning(f"{member.model} 请求失败（第{attempt + 1}次重试，{delay:.1f}秒后）: {error}")
+        return delay
+
+    @_role_stage
+    def chat(self, text: str, images: Optional[Union[str, List[str]]] = None, streaming_output: bool = True,
+             conversation: Optional[Conversation] = None, raw: bool = False) -> str | None:
         """与LLM进行对话，支持文本和图片输入
 
         Args:
             text (str): 文本消息
             images (Optional[Union[str, List[str]]]): 单个图片或图片列表，可以是URL或base64编码
             streaming_output (bool, optional): 是否流式输出. Defaults to True.
+            conversation (Optional[Conversation]): 使用的会话，默认使用本 LLM 的默认会话。
+                多线程并发调用时应传入各自的会话或使用 stateless 策略。
+            raw (bool): 返回未格式化的回答。要写入文件或交给下一阶段的回答必须使用原始回答，
+                format_chinese_response 的缩进和边框只适合在终端显示
 
         Returns:
             str | None: ai的回答，None为异常
         """
-        client = OpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url,
-        )
-
-        reasoning_content = ""
-        answer_content = ""
-        is_answering = False
+        conversation = conversation or self.conversation
 
         # 准备消息内容
         message_content = self._prepare_message_content(text, images)
-        self.messages.append({"role": "user", "content": message_content})
+        user_message = {"role": "user", "content": message_content}
 
         try:
-            completion = client.chat.completions.create(
-                model=self.model_name,
-                messages=self.messages,
-                stream=True,
-            )
-            
-            if streaming_output:
-                print("\n" + "="*50)
-                print("🤔 思考过程:")
-                print("="*50)
-            
-            for chunk in completion:
-                if not chunk.choices:
-                    continue
-                    
-                delta = chunk.choices[0].delta
-                # 处理思考过程
-                if hasattr(delta, 'reasoning_content') and delta.reasoning_content is not None:
-                    reasoning_content += delta.reasoning_content
-                    if streaming_output:
-                        print(delta.reasoning_content, end='', flush=True)
-                else:
-                    # 处理回复内容
-                    if hasattr(delta, 'content') and delta.content is not None:
-                        if delta.content != "" and is_answering is False:
-                            is_answering = True
-                            if streaming_output:
-                                print("\n" + "="*50)
-                                print("💡 回答结果:")
-                                print("="*50)
-                        answer_content += delta.content
-                        if streaming_output:
-                            print(delta.content, end='', flush=True)
-            
-            if streaming_output:
-                print("\n" + "="*50)
+            answer_content = self._stream_completion(conversation.build_request(user_message), streaming_output)
 
-            # 将AI的回复添加到消息历史中
-            self.messages.append({"role": "assistant", "content": answer_content})
+            # 将本轮对话按会话策略记录到历史中
+            conversation.record(user_message, {"role": "assistant", "content": answer_content})
             
             # 记录日志
-            log_msg = f"对话 - 用户: {text}"
+            log_msg = f"对话 - 用户: {logs.payload(text)}"
             if images:
                 img_count = 1 if isinstance(images, str) else len(images)
                 log_msg += f" (包含{img_count}张图片)"
             logging.info(log_msg)
-            logging.info(f"对话 - AI: {answer_content[:100]}...")
+            logging.info(f"对话 - AI: {logs.payload(answer_content)}")
             
+            if raw:
+                return answer_content
             formatted_answer = self.format_chinese_response(answer_content)
             return formatted_answer
             
@@ -166,6 +761,38 @@ class LLM:
             logging.error(f"聊天时发生错误: {str(e)}")
             return None
     
+    @_role_stage
+    def stream(self, text: str, on_answer: Callable[[str], None], images: Optional[Union[str, List[str]]] = None,
+               keep_answer: bool = False, conversation: Optional[Conversation] = None) -> str | None:
+        """流式对话，把回答内容逐段交给 on_answer 处理，不做格式化
+
+        Args:
+            text (str): 文本消息
+            on_answer (Callable[[str], None]): 每收到一段回答内容时调用
+            images (Optional[Union[str, List[str]]]): 单个图片或图片列表，可以是URL或base64编码
+            keep_answer (bool): 是否同时返回完整回答；为 False 时不在内存中保留回答，也不记录会话历史
+            conversation (Optional[Conversation]): 使用的会话，默认使用本 LLM 的默认会话
+
+        Returns:
+            str | None: keep_answer 为 True 时返回未格式化的完整回答，否则返回空字符串；None为异常
+        """
+        conversation = conversation or self.conversation
+        message_content = self._prepare_message_content(text, images)
+        user_message = {"role": "user", "content": message_content}
+
+        try:
+            answer_content = self._stream_completion(conversation.build_request(user_message), False,
+                                                     on_answer, keep_answer)
+            if keep_answer:
+                conversation.record(user_message, {"role": "assistant", "content": answer_content})
+            logging.info(f"流式对话 - 用户: {logs.payload(text)}")
+            logging.info(f"流式对话 - AI: {logs.payload(answer_content)}")
+            return answer_content
+        except Exception as e:
+            logging.error(f"流式对话时发生错误: {str(e)}")
+            return None
+
+    @_role_stage
     def ask(self, text: str, images: Optional[Union[str, List[str]]] = None, streaming_output: bool = True) -> str | None:
         """单次提问方法，不记录对话历史
         
@@ -177,67 +804,23 @@ class LLM:
         Returns:
             str | None: ai的回答，None为异常
         """
-        client = OpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url,
-        )
-        
-        reasoning_content = ""
-        answer_content = ""
-        is_answering = False
-        
         # 创建临时消息列表
-        temp_messages = [{"role": "system", "content": self.messages[0]["content"]}]
+        temp_messages = [{"role": "system", "content": self.system_prompt}]
         
         # 准备消息内容
         message_content = self._prepare_message_content(text, images)
         temp_messages.append({"role": "user", "content": message_content})
         
         try:
-            completion = client.chat.completions.create(
-                model=self.model_name,
-                messages=temp_messages,
-                stream=True,
-            )
-            
-            if streaming_output:
-                print("\n" + "="*50)
-                print("🤔 思考过程:")
-                print("="*50)
-            
-            for chunk in completion:
-                if not chunk.choices:
-                    continue
-                    
-                delta = chunk.choices[0].delta
-                # 处理思考过程
-                if hasattr(delta, 'reasoning_content') and delta.reasoning_content is not None:
-                    reasoning_content += delta.reasoning_content
-                    if streaming_output:
-                        print(delta.reasoning_content, end='', flush=True)
-                else:
-                    # 处理回复内容
-                    if hasattr(delta, 'content') and delta.content is not None:
-                        if delta.content != "" and is_answering is False:
-                            is_answering = True
-                            if streaming_output:
-                                print("\n" + "="*50)
-                                print("💡 回答结果:")
-                                print("="*50)
-                        answer_content += delta.content
-                        if streaming_output:
-                            print(delta.content, end='', flush=True)
-            
-            if streaming_output:
-                print("\n" + "="*50)
+            answer_content = self._stream_completion(temp_messages, streaming_output)
             
             # 记录日志
-            log_msg = f"单次提问: {text}"
+            log_msg = f"单次提问: {logs.payload(text)}"
             if images:
                 img_count = 1 if isinstance(images, str) else len(images)
                 log_msg += f" (包含{img_count}张图片)"
             logging.info(log_msg)
-            logging.info(f"AI回答: {answer_content[:100]}...")
+            logging.info(f"AI回答: {logs.payload(answer_content)}")
             
             formatted_answer = self.format_chinese_response(answer_content)
             return formatted_answer
@@ -248,16 +831,281 @@ class LLM:
 
     def clear_history(self):
         """清除对话历史，只保留系统提示"""
-        self.messages = [self.messages[0]]
+        self.conversation.clear()
         logging.info("对话历史已清除")
 
     def get_history(self):
         """获取当前对话历史"""
-        return self.messages
+        return self.conversation.messages
 
     def get_history_count(self):
         """获取对话轮数（不包括系统提示）"""
-        return (len(self.messages) - 1) // 2
+        return self.conversation.turn_count()
+
+
+class AsyncLLM(LLM):
+    """LLM 的 asyncio 版本
+
+    会话、消息构造和格式化与 LLM 相同；请求通过当前事件循环中共享的 AsyncOpenAI 客户端发出，
+    适合在单个线程中维持成百上千个并发请求。
+    """
+    def _make_client(self):
+        # 异步客户端与事件循环绑定，在第一次请求时于事件循环内获取
+        return None
+
+    async def _stream_completion_async(self, messages: list, on_answer: Optional[Callable[[str], None]] = None,
+                                       keep_answer: bool = True) -> str:
+        tokens = request_tokens(messages)
+        record, start = self._new_record(messages)
+        attempt = 0
+        tried = []
+        while True:
+            member = self.pool.pick(tried)
+            collector = primary = _StreamCollector(False, on_answer, keep_answer)
+            race = self._race()
+            error = None
+            try:
+                if race is None:
+                    await self._leg_async(member, messages, tokens, collector, None, record)
+                else:
+                    race.launch = functools.partial(self._launch_hedge_async, race, member, messages, tokens,
+                                                    on_answer, keep_answer)
+                    await self._primary_leg_async(race, member, messages, tokens, collector, record)
+            except Exception as e:
+                error = e
+                outcome = await race.resolve_async(primary) if race is not None else None
+                if outcome is not None:
+                    collector, error = outcome
+                    member = collector.member
+            else:
+                if race is not None:
+                    race.close()
+            self._settle_race(record, race, primary, collector)
+            if error is None:
+                answer = collector.finish()
+                self._finish_record(record, start, collector.sent, collector, tokens, attempt, member=member)
+                return answer
+            if isinstance(error, budget.BudgetExceeded):
+                record.limit = error.kind
+            # 已经收到回答内容说明接口可用，按重试和降级策略处理
+            failover = not sum(collector.answer_chars) and self.pool.can_fail_over(member, error, tried)
+            if not failover and not self._should_retry(error, attempt - record.failovers, collector, member):
+                answer = self._degrade(error, collector)
+                self._finish_record(record, start, collector.sent, collector, tokens, attempt, error,
+                                    answer is not None, member)
+                if answer is not None:
+                    return answer
+                raise error
+            if failover:
+                tried.append(member)
+                record.failovers += 1
+                logging.warning(f"{member.endpoint.name} 请求失败，改用接口池中的其他接口: {error}")
+            else:
+                await asyncio.sleep(self._retry_delay(error, attempt, member))
+            attempt += 1
+
+    async def _leg_async(self, member: "endpoints.Member", messages: list, tokens: int, collector: "_StreamCollector",
+                         race: Optional["hedge.Race"] = None, record: Optional["metrics.CallRecord"] = None):
+        """LLM._leg 的异步版本；对冲时每一路在单独的任务中运行，落败的一路由胜出的一路取消任务"""
+        collector.member = member
+        client = get_async_client(member.api_key, member.base_url, self.max_connections, self.keepalive_expiry)
+        waited = time.perf_counter()
+        await member.limiter.acquire_async(tokens)
+        collector.sent = time.perf_counter()
+        if record is not None:
+            record.queued += collector.sent - waited
+        error = None
+        guard = budget.StreamGuard(self.limits, collector, collector.sent, _estimate_counted)
+        collector.race = race
+        try:
+            if race is not None:
+                race.join(collector, asyncio.current_task().cancel)
+            await self._read_stream_async(client, messages, collector, guard, member)
+            if race is not None and not race.claim(collector):
+                raise hedge.HedgeLost()
+        except asyncio.CancelledError as e:
+            error = e
+            raise
+        except Exception as e:
+            error = guard.error(e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            member.limiter.release(error)
+            self.pool.done(member, error, _first_token_latency(collector, collector.sent))
+
+    async def _primary_leg_async(self, race: "hedge.Race", member: "endpoints.Member", messages: list, tokens: int,
+                                 collector: "_StreamCollector", record: "metrics.CallRecord"):
+        """在单独的任务中运行原请求，被对冲请求取消时抛出 HedgeLost，调用方被取消时一并取消两路请求"""
+        leg = asyncio.ensure_future(self._leg_async(member, messages, tokens, collector, race, record))
+        try:
+            await asyncio.wait([leg])
+        except asyncio.CancelledError:
+            for task in [leg] + race.tasks:
+                task.cancel()
+            raise
+        if leg.cancelled():
+            raise hedge.HedgeLost()
+        leg.result()
+
+    def _launch_hedge_async(self, race: "hedge.Race", primary_member: "endpoints.Member", messages: list,
+                            tokens: int, on_answer: Optional[Callable[[str], None]], keep_answer: bool):
+        """在事件循环中创建对冲请求的任务"""
+        member = self.pool.pick([primary_member])
+        collector = _StreamCollector(False, on_answer, keep_answer)
+
+        async def run():
+            error = None
+            try:
+                await self._leg_async(member, messages, tokens, collector, race)
+            except Exception as e:
+                error = e
+            finally:
+                race.settle(collector, error)
+
+        race.tasks.append(asyncio.ensure_future(run()))
+
+    async def _read_stream_async(self, client: AsyncOpenAI, messages: list, collector: "_StreamCollector",
+                                 guard: "budget.StreamGuard", member: "endpoints.Member"):
+        """发出请求并读取全部分块；设置了时间限制时每次等待都不超过最近的截止时间，超时即取消读取"""
+        if not self.limits.timed:
+            completion = await client.chat.completions.create(**self._request_args(messages, member))
+            async for chunk in completion:
+                collector.handle(chunk)
+                guard.check()
+            return
+        try:
+            completion = await asyncio.wait_for(client.chat.completions.create(**self._request_args(messages, member)),
+                                                guard.remaining())
+        except asyncio.TimeoutError:
+            raise guard.expired_error() from None
+        chunks = completion.__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), guard.remaining())
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise guard.expired_error() from None
+                collector.handle(chunk)
+                guard.check()
+        except BaseException:
+            # 超时或异常时关闭响应，连接不再复用
+            await completion.close()
+            raise
+
+    @_role_stage
+    async def chat(self, text: str, images: Optional[Union[str, List[str]]] = None,
+                   conversation: Optional[Conversation] = None, raw: bool = False) -> str | None:
+        """异步对话，参数与返回值同 LLM.chat（不支持终端流式打印）"""
+        conversation = conversation or self.conversation
+        message_content = self._prepare_message_content(text, images)
+        user_message = {"role": "user", "content": message_content}
+
+        try:
+            answer_content = await self._stream_completion_async(conversation.build_request(user_message))
+            conversation.record(user_message, {"role": "assistant", "content": answer_content})
+            log_msg = f"异步对话 - 用户: {logs.payload(text)}"
+            if images:
+                img_count = 1 if isinstance(images, str) else len(images)
+                log_msg += f" (包含{img_count}张图片)"
+            logging.info(log_msg)
+            logging.info(f"异步对话 - AI: {logs.payload(answer_content)}")
+            return answer_content if raw else self.format_chinese_response(answer_content)
+        except Exception as e:
+            logging.error(f"异步对话时发生错误: {str(e)}")
+            return None
+
+    @_role_stage
+    async def stream(self, text: str, on_answer: Callable[[str], None], images: Optional[Union[str, List[str]]] = None,
+                     keep_answer: bool = False, conversation: Optional[Conversation] = None) -> str | None:
+        """异步流式对话，参数与返回值同 LLM.stream"""
+        conversation = conversation or self.conversation
+        message_content = self._prepare_message_content(text, images)
+        user_message = {"role": "user", "content": message_content}
+
+        try:
+            answer_content = await self._stream_completion_async(conversation.build_request(user_message),
+                                                                 on_answer, keep_answer)
+            if keep_answer:
+                conversation.record(user_message, {"role": "assistant", "content": answer_content})
+            logging.info(f"异步流式对话 - 用户: {logs.payload(text)}")
+            logging.info(f"异步流式对话 - AI: {logs.payload(answer_content)}")
+            return answer_content
+        except Exception as e:
+            logging.error(f"异步流式对话时发生错误: {str(e)}")
+            return None
+
+    async def ask(self, text: str, images: Optional[Union[str, List[str]]] = None) -> str | None:
+        """异步单次提问，不记录对话历史"""
+        return await self.chat(text, images, conversation=self.new_conversation("stateless"))
+
+
+def message_text(message: dict) -> str:
+    """提取消息中的文本部分（忽略图片）"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content or [] if part.get("type") == "text")
+
+
+def message_bytes(message: dict) -> int:
+    """计算消息序列化后的字节数（包括base64图片）"""
+    return len(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+
+
+def request_tokens(messages: list) -> int:
+    """估算一次请求的输入 token 数，用于 tpm 限流；图片按固定数量估算"""
+    tokens = 0
+    for message in messages:
+        tokens += estimate_tokens(message_text(message))
+        content = message.get("content")
+        if isinstance(content, list):
+            tokens += ratelimit.IMAGE_TOKEN_ESTIMATE * sum(1 for part in content if part.get("type") == "image_url")
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数
+
+    中日韩字符大约每字1个token，其余字符大约每4个字符1个token。
+    """
+    counts = [0, 0]
+    _count_chars(text, counts)
+    return _estimate_counted(counts)
+
+
+def _first_token_latency(collector: "_StreamCollector", sent: float) -> Optional[float]:
+    """本次尝试的首 token 延迟，作为接口池估计负载的依据；没有收到任何 token 时为 None"""
+    if collector.first_token is None:
+        return None
+    return collector.first_token - sent
+
+
+def _cached_tokens(usage) -> int:
+    """usage 中命中接口侧前缀缓存的输入 token 数
+
+    OpenAI 兼容接口（含 DashScope）放在 prompt_tokens_details.cached_tokens，DeepSeek 为 prompt_cache_hit_tokens。
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return cached or 0
+
+
+def _count_chars(text: str, counts: list):
+    """把文本的中日韩字符数和其他字符数累加到 counts，流式分块逐段累加后再估算 token 数"""
+    cjk = sum(1 for ch in text if '\u3000' <= ch <= '\u9fff' or '\uff00' <= ch <= '\uffef')
+    counts[0] += cjk
+    counts[1] += len(text) - cjk
+
+
+def _estimate_counted(counts: list) -> int:
+    """按 _count_chars 的累计结果估算 token 数，与 estimate_tokens 的规则相同"""
+    return counts[0] + (counts[1] + 3) // 4
 
 
 def encode_image(image_path: str) -> str:
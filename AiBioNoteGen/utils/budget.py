@@ -0,0 +1,273 @@
+"""生成预算与流式超时模块
+
+限制单次流式调用的输出量和耗时，避免推理模型在 reasoning_content 中打转时长时间占住工作线程，
+拖住 v050 的 as_completed 屏障或异步流水线的信号量：
+- max_tokens: 作为请求参数交给接口，限制输出长度
+- reasoning_budget: 思考过程的估算 token 上限，超出即取消
+- connect_timeout / first_token_timeout / total_timeout: 建立连接、收到第一个 token、整个调用的时间上限
+- stall_timeout: 两个分块之间的最长间隔
+超出限制的流会被干净地取消（关闭连接），然后按 on_limit 处理：
+- "retry": 按接口的重试策略重试（已经交给 on_answer 的回答不能重试），重试用尽后失败
+- "degrade": 保留已经收到的部分回答作为结果；一点回答都没有时失败
+- "fail": 直接失败
+同步调用由一个共享的看门狗线程在截止时间到达时关闭连接的套接字，阻塞在读取上的线程会立即返回；
+异步调用对每次读取分块使用 asyncio.wait_for。
+"""
+
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+try:
+    from openai import Timeout
+except ImportError:  # openai 只在真正发出请求时需要
+    Timeout = None
+
+ON_LIMIT = ("retry", "degrade", "fail")
+
+
+@dataclass
+class GenerationLimits:
+    """单个角色的生成预算与超时（秒），0 表示不限制
+
+    Attributes:
+        max_tokens (int): 请求参数 max_tokens
+        reasoning_budget (int): 思考过程的估算 token 上限
+        connect_timeout (float): 建立连接的超时
+        first_token_timeout (float): 发出请求到收到第一个 token（思考过程或回答）的超时
+        total_timeout (float): 整个流式调用的超时（不含排队）
+        stall_timeout (float): 两个分块之间的最长间隔
+        on_limit (str): 超出限制时的处理方式，retry / degrade / fail
+    """
+    max_tokens: int = 0
+    reasoning_budget: int = 0
+    connect_timeout: float = 0
+    first_token_timeout: float = 0
+    total_timeout: float = 0
+    stall_timeout: float = 0
+    on_limit: str = "retry"
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "GenerationLimits":
+        conf = conf or {}
+        limits = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        if limits.on_limit not in ON_LIMIT:
+            logging.warning(f"未知的超限处理方式 {limits.on_limit}，改用 retry")
+            limits.on_limit = "retry"
+        return limits
+
+    @property
+    def timed(self) -> bool:
+        """是否设置了需要在流式读取过程中检查的时间限制"""
+        return bool(self.first_token_timeout or self.total_timeout or self.stall_timeout)
+
+    def request_args(self) -> dict:
+        """追加到 chat.completions.create 的参数
+
+        传输层的读超时取 first_token_timeout 与 stall_timeout 中较大的一个，作为收到响应头之前的兜底；
+        收到响应头之后由 StreamGuard 精确地按各项限制取消。
+        """
+        args = {}
+        if self.max_tokens:
+            args["max_tokens"] = self.max_tokens
+        if Timeout is not None and (self.connect_timeout or self.timed):
+            read = max(self.first_token_timeout, self.stall_timeout) or None
+            total = self.total_timeout or None
+            if read is None:
+                read = total
+            args["timeout"] = Timeout(total, connect=self.connect_timeout or None, read=read)
+        return args
+
+
+class BudgetExceeded(Exception):
+    """流式调用超出生成预算或超时
+
+    Attributes:
+        kind (str): 超出的限制，first_token / stall / total / reasoning
+    """
+    def __init__(self, kind: str, detail: str = ""):
+        super().__init__(f"超出限制 {kind}" + (f": {detail}" if detail else ""))
+        self.kind = kind
+
+
+class StreamGuard:
+    """单次流式调用的限制检查
+
+    Attributes:
+        reason (Optional[str]): 被看门狗取消时超出的限制
+    """
+    def __init__(self, limits: GenerationLimits, collector, sent: float, estimate: Callable[[list], int]):
+        """
+        Args:
+            limits: 生成预算与超时
+            collector: Ai._StreamCollector，读取其首 token 时间和思考过程字数
+            sent: 发出请求时的 time.perf_counter()
+            estimate: 根据 collector 的字数估算 token 数的函数
+        """
+        self.limits = limits
+        self.collector = collector
+        self.sent = sent
+        self.last = sent
+        self.estimate = estimate
+        self.reason = None
+        self._completion = None
+        self._lock = threading.Lock()
+
+    def attach(self, completion):
+        """登记流式响应，超时时由看门狗关闭"""
+        self._completion = completion
+
+    def _deadline(self):
+        """返回 (最近的截止时间, 对应的限制)，没有时间限制时为 (None, None)"""
+        limits = self.limits
+        candidates = []
+        if limits.total_timeout:
+            candidates.append((self.sent + limits.total_timeout, "total"))
+        if limits.first_token_timeout and self.collector.first_token is None:
+            candidates.append((self.sent + limits.first_token_timeout, "first_token"))
+        if limits.stall_timeout:
+            candidates.append((self.last + limits.stall_timeout, "stall"))
+        if not candidates:
+            return None, None
+        return min(candidates)
+
+    def deadline(self) -> Optional[float]:
+        return self._deadline()[0]
+
+    def remaining(self, now: Optional[float] = None) -> Optional[float]:
+        """距离最近的截止时间还有多少秒，没有时间限制时为 None"""
+        deadline = self._deadline()[0]
+        if deadline is None:
+            return None
+        return max(0.0, deadline - (now or time.perf_counter()))
+
+    def check(self):
+        """每收到一个分块后调用：刷新停顿计时，超出任何限制时抛出 BudgetExceeded"""
+        now = time.perf_counter()
+        deadline, kind = self._deadline()
+        if deadline is not None and now > deadline:
+            raise BudgetExceeded(kind)
+        self.last = now
+        budget = self.limits.reasoning_budget
+        if budget:
+            used = self.estimate(self.collector.reasoning_chars)
+            if used > budget:
+                raise BudgetExceeded("reasoning", f"思考过程约 {used} token")
+
+    def expired_error(self) -> BudgetExceeded:
+        """截止时间已过时对应的异常"""
+        return BudgetExceeded(self._deadline()[1] or "total")
+
+    def error(self, e: Exception) -> Exception:
+        """把取消连接引起的读取错误和传输层超时转换为 BudgetExceeded"""
+        if isinstance(e, BudgetExceeded):
+            return e
+        if self.reason is not None:
+            converted = BudgetExceeded(self.reason)
+        elif self.limits.timed and type(e).__name__ in ("ReadTimeout", "APITimeoutError", "TimeoutError"):
+            converted = BudgetExceeded("first_token" if self.collector.first_token is None else "stall")
+        else:
+            return e
+        converted.__cause__ = e
+        return converted
+
+    def cancel(self, kind: str):
+        """由看门狗调用：记录原因并关闭连接，让阻塞在读取上的线程立即返回"""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = kind
+        completion = self._completion
+        if completion is None:
+            # 还没有收到响应头，由传输层的读超时兜底
+            return
+        sock = None
+        response = getattr(completion, "response", None)
+        stream = getattr(response, "extensions", {}).get("network_stream") if response is not None else None
+        if stream is not None:
+            try:
+                sock = stream.get_extra_info("socket")
+            except Exception:
+                sock = None
+        try:
+            if sock is not None:
+                # 只 close 不能唤醒阻塞在 recv 上的线程，shutdown 可以
+                sock.shutdown(socket.SHUT_RDWR)
+            else:
+                completion.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """关闭流式响应（调用异常结束时，连接不再复用）"""
+        completion = self._completion
+        if completion is not None:
+            try:
+                completion.close()
+            except Exception:
+                pass
+
+
+class _Watchdog:
+    """共享的看门狗线程：在最近的截止时间醒来，取消已经超时的流"""
+    def __init__(self):
+        self._guards = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, guard: StreamGuard):
+        with self._cond:
+            self._guards.add(guard)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stream-watchdog", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def remove(self, guard: StreamGuard):
+        with self._cond:
+            self._guards.discard(guard)
+
+    def _run(self):
+        while True:
+            expired = []
+            with self._cond:
+                now = time.perf_counter()
+                nearest = None
+                for guard in self._guards:
+                    deadline, kind = guard._deadline()
+                    if deadline is None:
+                        continue
+                    if deadline <= now:
+                        expired.append((guard, kind))
+                    elif nearest is None or deadline < nearest:
+                        nearest = deadline
+                for guard, _ in expired:
+                    self._guards.discard(guard)
+                if not expired:
+                    self._cond.wait(None if nearest is None else nearest - now)
+            for guard, kind in expired:
+                logging.warning(f"流式调用超出限制 {kind}，取消请求")
+                guard.cancel(kind)
+
+
+_watchdog = _Watchdog()
+
+
+@contextmanager
+def watch(guard: StreamGuard):
+    """同步调用期间由看门狗监视 guard；调用异常结束时关闭流式响应"""
+    timed = guard.limits.timed
+    if timed:
+        _watchdog.add(guard)
+    try:
+        yield guard
+    except BaseException:
+        guard.close()
+        raise
+    finally:
+        if timed:
+            _watchdog.remove(guard)
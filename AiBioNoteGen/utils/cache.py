@@ -0,0 +1,199 @@
+"""磁盘结果缓存模块
+
+以内容哈希为键，把模型的回答持久化到本地目录，重复运行时直接返回已有结果而不发起网络请求。
+- Vision 阶段的键：图片字节 + 模型名 + 完整的 vision prompt
+- Build / Gen 阶段的键：模型名 + 完整的输入文本
+缓存按条目年龄和总大小淘汰（最久未使用的先删除）。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional, Union
+
+current_dir = os.path.dirname(__file__)
+DEFAULT_CACHE_DIR = os.path.join(current_dir, '..', 'cache')
+# 缓存保存未格式化的模型回答；写入缓存键，使之前缓存的格式化回答（带缩进和边框）不再命中
+RAW_ANSWER = "raw-answer"
+
+
+def make_key(*parts: Union[str, bytes]) -> str:
+    """根据若干部分计算缓存键
+
+    Args:
+        *parts: 参与计算的内容，字符串按 UTF-8 编码
+
+    Returns:
+        str: sha256 十六进制摘要
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # 写入长度前缀，避免 ("ab", "c") 与 ("a", "bc") 冲突
+        h.update(len(part).to_bytes(8, 'big'))
+        h.update(part)
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """计算文件内容的 sha256 摘要"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """内容寻址的磁盘缓存
+
+    每个条目是缓存目录下的一个 JSON 文件，文件名为键。读取时刷新文件的 mtime，
+    因此按 mtime 淘汰即为最久未使用优先。
+
+    Attributes:
+        path (str): 缓存目录
+        max_bytes (int): 缓存总大小上限，0 表示不限制
+        max_age (float): 条目最长闲置时间（秒），超过后视为过期，0 表示不限制
+        enabled (bool): 为 False 时 get 永远未命中且 put 不写入
+    """
+    def __init__(self, path: str = DEFAULT_CACHE_DIR, max_bytes: int = 0, max_age: float = 0, enabled: bool = True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if enabled:
+            os.makedirs(path, exist_ok=True)
+            self.evict()
+
+    @classmethod
+    def from_config(cls, conf: dict, enabled: bool = True) -> "ResponseCache":
+        """根据配置中的 cache 段创建缓存
+
+        Args:
+            conf (dict): 形如 {"dir": ..., "max_mb": ..., "max_age_days": ...}，均可省略
+            enabled (bool): 是否启用缓存
+        """
+        conf = conf or {}
+        path = conf.get("dir") or DEFAULT_CACHE_DIR
+        return cls(path,
+                   max_bytes=int(conf.get("max_mb", 0) * 1024 * 1024),
+                   max_age=conf.get("max_age_days", 0) * 86400,
+                   enabled=enabled)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存
+
+        Returns:
+            Optional[str]: 命中时返回缓存的回答，否则返回 None
+        """
+        if not self.enabled:
+            return None
+        entry_path = self._entry_path(key)
+        try:
+            if self.max_age and time.time() - os.stat(entry_path).st_mtime > self.max_age:
+                self._remove(entry_path)
+                raise FileNotFoundError(entry_path)
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"缓存条目损坏，已忽略: {entry_path}: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return entry.get("value")
+
+    def put(self, key: str, value: str, **meta):
+        """写入缓存
+
+        Args:
+            key (str): 缓存键
+            value (str): 要缓存的回答
+            **meta: 额外记录在条目中的信息（模型名、阶段等），仅供排查使用
+        """
+        if not self.enabled or not value:
+            return
+        entry = {"created": time.time(), "meta": meta, "value": value}
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logging.error(f"写入缓存失败 {entry_path}: {e}")
+            self._remove(tmp_path)
+            return
+        if self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """按年龄和总大小淘汰缓存条目"""
+        with self._lock:
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if self.max_age and now - st.st_mtime > self.max_age:
+                    self._remove(entry.path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+            if not self.max_bytes:
+                return
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def purge(self) -> int:
+        """清空缓存
+
+        Returns:
+            int: 删除的条目数
+        """
+        removed = 0
+        if not os.path.isdir(self.path):
+            return removed
+        with self._lock:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.json') and self._remove(entry.path):
+                    removed += 1
+        logging.info(f"已清空缓存 {self.path}，共删除 {removed} 个条目")
+        return removed
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
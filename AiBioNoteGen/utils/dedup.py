@@ -0,0 +1,225 @@
+"""输入图片去重模块
+
+同一页教材常被拍了好几次，每一张都会消耗一次完整的 Vision 请求。这里在发现图片之后、上传之前：
+- 为每张图片计算 64 位感知哈希（aHash / dHash / pHash）
+- 汉明距离不超过 max_distance 的图片归为一组（传递闭包）
+- 每组只保留质量最好的一张（分辨率最高或最清晰），其余记为重复图片
+解码缩略图交给进程池并行执行，哈希和两两距离的计算用 NumPy 整批完成。
+重复图片不发送请求，但和它的代表图片一起清理。
+依赖 Pillow 和 NumPy；任一未安装时跳过去重。
+"""
+
+import concurrent.futures
+import functools
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow / NumPy 为可选依赖
+    np = None
+    Image = None
+    ImageOps = None
+
+METHODS = ("ahash", "dhash", "phash")
+# 计算清晰度时使用的缩略图长边
+_SHARPNESS_EDGE = 512
+# 清晰度相差不超过该比例时视为一样清晰
+_SHARPNESS_TOLERANCE = 0.1
+# 一次计算多少行的两两距离，限制中间矩阵的内存占用
+_BLOCK_ROWS = 512
+
+
+@dataclass
+class DedupSettings:
+    """去重参数
+
+    Attributes:
+        enabled (bool): 是否启用去重（未安装 Pillow 或 NumPy 时自动关闭）
+        method (str): 感知哈希算法，ahash / dhash / phash
+        max_distance (int): 视为重复的最大汉明距离（64 位哈希）
+        keep (str): 每组保留哪一张，resolution（分辨率最高）或 sharpness（最清晰）
+        workers (int): 解码图片的进程数，0 表示由系统决定
+    """
+    enabled: bool = True
+    method: str = "phash"
+    max_distance: int = 6
+    keep: str = "sharpness"
+    workers: int = 0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "DedupSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        if settings.method not in METHODS:
+            logging.warning(f"未知的感知哈希算法 {settings.method}，改用 phash")
+            settings.method = "phash"
+        if settings.enabled and np is None:
+            logging.warning("未安装 Pillow 或 NumPy，跳过图片去重")
+            settings.enabled = False
+        return settings
+
+
+def _hash_size(method: str) -> Tuple[int, int]:
+    """计算哈希前缩放到的 (宽, 高)"""
+    if method == "phash":
+        return 32, 32
+    if method == "dhash":
+        return 9, 8
+    return 8, 8
+
+
+def load_features(path: str, method: str) -> Optional[tuple]:
+    """解码一张图片，返回 (哈希用灰度缩略图, 像素数, 清晰度)，无法读取时返回 None
+
+    JPEG 使用 draft 模式按比例解码，不需要解出全尺寸图片。该函数只依赖参数，可以在子进程中执行。
+    """
+    try:
+        with Image.open(path) as img:
+            pixels = img.size[0] * img.size[1]
+            img.draft('L', (_SHARPNESS_EDGE, _SHARPNESS_EDGE))
+            gray = ImageOps.exif_transpose(img).convert('L')
+            small = np.asarray(gray.resize(_hash_size(method), Image.LANCZOS), dtype=np.float32)
+            # 统一缩放到相同长边再比较清晰度，低分辨率的副本放大后会变模糊
+            scale = _SHARPNESS_EDGE / max(gray.size)
+            gray = gray.resize((max(1, round(gray.size[0] * scale)), max(1, round(gray.size[1] * scale))), Image.BICUBIC)
+            return small, pixels, _sharpness(np.asarray(gray, dtype=np.float32))
+    # 损坏的图片抛出 OSError，EXIF 或颜色模式异常抛出 ValueError，超大图片抛出 DecompressionBombError
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning(f"无法读取图片，跳过去重 {path}: {e}")
+        return None
+
+
+def _sharpness(gray) -> float:
+    """拉普拉斯算子响应的方差，越大越清晰"""
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0.0
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+                 - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def _dct_matrix(n: int):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def compute_hashes(stack, method: str):
+    """整批计算感知哈希
+
+    Args:
+        stack: (N, 高, 宽) 的灰度缩略图
+        method (str): ahash / dhash / phash
+
+    Returns:
+        np.ndarray: (N,) 的 uint64 哈希
+    """
+    if method == "phash":
+        dct = _dct_matrix(stack.shape[1])
+        coeffs = (dct @ stack @ dct.T)[:, :8, :8].reshape(len(stack), 64)
+        # 直流分量不参与中位数
+        bits = coeffs > np.median(coeffs[:, 1:], axis=1, keepdims=True)
+    elif method == "dhash":
+        bits = (stack[:, :, 1:] > stack[:, :, :-1]).reshape(len(stack), 64)
+    else:
+        flat = stack.reshape(len(stack), 64)
+        bits = flat > flat.mean(axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+@functools.lru_cache(maxsize=1)
+def _popcount_table():
+    return np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+
+def _popcount(values):
+    """逐元素统计 uint64 中 1 的个数"""
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+        return np.bitwise_count(values)
+    table = _popcount_table()
+    return sum(table[(values >> np.uint64(shift)) & np.uint64(0xFFFF)] for shift in (0, 16, 32, 48))
+
+
+def near_pairs(hashes, max_distance: int) -> List[Tuple[int, int]]:
+    """找出汉明距离不超过 max_distance 的所有下标对 (i, j)，i < j"""
+    count = len(hashes)
+    pairs = []
+    for start in range(0, count, _BLOCK_ROWS):
+        block = hashes[start:start + _BLOCK_ROWS]
+        distance = _popcount(np.bitwise_xor(block[:, None], hashes[None, :]))
+        rows, cols = np.nonzero(distance <= max_distance)
+        rows += start
+        keep = rows < cols
+        pairs.extend(zip(rows[keep].tolist(), cols[keep].tolist()))
+    return pairs
+
+
+def _clusters(count: int, pairs: List[Tuple[int, int]]) -> List[List[int]]:
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    groups = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _pick_best(members: List[int], features: list, keep: str) -> int:
+    """从一组重复图片中选出代表
+
+    清晰度差别不大时（JPEG 噪声等）按分辨率选择，避免留下低分辨率的副本。
+    """
+    if keep == "sharpness":
+        sharpest = max(features[i][2] for i in members)
+        members = [i for i in members if features[i][2] >= sharpest * (1 - _SHARPNESS_TOLERANCE)]
+    return max(members, key=lambda i: (features[i][1], features[i][2]))
+
+
+def find_duplicates(paths: List[str], settings: DedupSettings, pool=None) -> Dict[str, str]:
+    """找出重复图片
+
+    Args:
+        paths (List[str]): 图片路径
+        settings (DedupSettings): 去重参数
+        pool: 解码图片使用的进程池，为 None 时临时创建
+
+    Returns:
+        Dict[str, str]: {重复图片: 保留的代表图片}，没有重复时为空
+    """
+    if not settings.enabled or len(paths) < 2:
+        return {}
+    if pool is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=settings.workers or None) as own_pool:
+            return find_duplicates(paths, settings, own_pool)
+
+    features = list(pool.map(load_features, paths, [settings.method] * len(paths), chunksize=16))
+    valid = [i for i, item in enumerate(features) if item is not None]
+    if len(valid) < 2:
+        return {}
+    stack = np.stack([features[i][0] for i in valid])
+    hashes = compute_hashes(stack, settings.method)
+
+    duplicates = {}
+    for group in _clusters(len(valid), near_pairs(hashes, settings.max_distance)):
+        members = [valid[k] for k in group]
+        best = _pick_best(members, features, settings.keep)
+        for i in members:
+            if i != best:
+                duplicates[paths[i]] = paths[best]
+        logging.info(f"重复图片: 保留 {os.path.basename(paths[best])}，跳过 "
+                     f"{[os.path.basename(paths[i]) for i in members if i != best]}")
+    return duplicates
@@ -0,0 +1,204 @@
+"""图片发现与监听模块
+
+- discover: 用 os.scandir 遍历配置的根目录，按扩展名和 include / exclude 通配符筛选图片，
+  被排除的目录（日志、缓存、运行记录、笔记库、隐藏目录等）整个跳过，不会进入
+- watch: 常驻监听根目录，新图片写入完成（大小和修改时间在 debounce 秒内不再变化）后
+  攒成一个小批次交给流水线，省去每批照片都重新启动进程、读取配置和 Prompt 的开销
+安装了 watchdog 时由文件系统事件（Linux 上为 inotify）立即唤醒扫描，否则按 poll_interval 轮询。
+"""
+
+import fnmatch
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog 为可选依赖
+    FileSystemEventHandler = object
+    Observer = None
+
+
+def _default_exclude() -> List[str]:
+    # 程序目录下的运行数据，bench 下还有基准测试生成的图片
+    return [".*", "log", "cache", "runs", "index", "queue", "bench", "Obsidian-Notes", "__pycache__"]
+
+
+@dataclass
+class DiscoverySettings:
+    """图片发现参数
+
+    Attributes:
+        roots (List[str]): 搜索的根目录，相对路径以当前工作目录为基准
+        extensions (List[str]): 图片扩展名（不区分大小写）
+        include (List[str]): 文件需要匹配其中之一的通配符，为空表示不限制
+        exclude (List[str]): 排除的目录或文件通配符，与名称或相对根目录的路径匹配
+        debounce (float): 监听模式下文件多少秒没有变化才视为写入完成
+        poll_interval (float): 监听模式下两次扫描的最长间隔（秒）
+        max_batch (int): 监听模式下每批最多的图片数，0 表示不限制
+    """
+    roots: List[str] = field(default_factory=lambda: ["."])
+    extensions: List[str] = field(default_factory=lambda: [".jpg", ".jpeg", ".png"])
+    include: List[str] = field(default_factory=list)
+    exclude: List[str] = field(default_factory=_default_exclude)
+    debounce: float = 5.0
+    poll_interval: float = 2.0
+    max_batch: int = 0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "DiscoverySettings":
+        conf = conf or {}
+        return cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+
+    def root_paths(self) -> List[str]:
+        return [os.path.abspath(root) for root in self.roots]
+
+
+def _matches(patterns: List[str], name: str, rel_path: str) -> bool:
+    rel_path = rel_path.replace(os.sep, '/')
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def scan(settings: DiscoverySettings) -> Iterator[Tuple[str, os.stat_result]]:
+    """遍历根目录，依次产出 (图片路径, stat)，同一目录内按文件名排序"""
+    extensions = tuple(ext.lower() for ext in settings.extensions)
+    seen = set()
+    for root in settings.root_paths():
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                logging.warning(f"无法读取目录 {directory}: {e}")
+                continue
+            subdirs = []
+            for entry in entries:
+                rel_path = os.path.relpath(entry.path, root)
+                if _matches(settings.exclude, entry.name, rel_path):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                        continue
+                    if settings.include and not _matches(settings.include, entry.name, rel_path):
+                        continue
+                    if entry.path in seen:
+                        continue
+                    seen.add(entry.path)
+                    yield entry.path, entry.stat()
+                except OSError:
+                    # 扫描过程中被删除的文件
+                    continue
+            # 倒序入栈，保证按名称顺序深度优先遍历
+            stack.extend(reversed(subdirs))
+
+
+def discover(settings: Optional[DiscoverySettings] = None) -> List[str]:
+    """返回当前所有符合条件的图片路径"""
+    return [path for path, _ in scan(settings or DiscoverySettings())]
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, changed: threading.Event):
+        super().__init__()
+        self.changed = changed
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+
+class _Notifier:
+    """等待下一次扫描：有文件系统事件时立即返回，否则最多等待 timeout 秒"""
+    def __init__(self, settings: DiscoverySettings, stop: threading.Event):
+        self.stop = stop
+        self.changed = threading.Event()
+        self.observer = None
+        if Observer is not None:
+            self.observer = Observer()
+            handler = _ChangeHandler(self.changed)
+            for root in settings.root_paths():
+                if os.path.isdir(root):
+                    self.observer.schedule(handler, root, recursive=True)
+
+    @property
+    def mode(self) -> str:
+        return "文件系统事件" if self.observer is not None else "轮询"
+
+    def __enter__(self):
+        if self.observer is not None:
+            self.observer.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def wait(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        # 分段等待，保证 stop 被设置后能及时退出
+        while not self.stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.changed.wait(min(remaining, 0.5)):
+                break
+        self.changed.clear()
+
+
+def watch(settings: Optional[DiscoverySettings] = None, stop: Optional[threading.Event] = None) -> Iterator[List[str]]:
+    """持续监听根目录，产出新图片组成的小批次
+
+    启动时已经存在的图片作为第一批。每张图片只产出一次；
+    图片从磁盘上消失后再次出现（例如同名文件重新放入），会被当作新图片。
+
+    Args:
+        settings (Optional[DiscoverySettings]): 发现参数
+        stop (Optional[threading.Event]): 设置后停止监听
+
+    Yields:
+        List[str]: 一批写入完成的新图片，按路径排序
+    """
+    settings = settings or DiscoverySettings()
+    stop = stop or threading.Event()
+    known = set()
+    pending: Dict[str, tuple] = {}
+    changed_at: Dict[str, float] = {}
+    with _Notifier(settings, stop) as notifier:
+        logging.info(f"开始监听 {settings.root_paths()}（{notifier.mode}），按 Ctrl+C 停止")
+        while not stop.is_set():
+            now = time.monotonic()
+            present = {}
+            for path, stat in scan(settings):
+                present[path] = (stat.st_size, stat.st_mtime_ns)
+            known.intersection_update(present)
+            current = {path: sig for path, sig in present.items() if path not in known}
+            for path, sig in current.items():
+                if pending.get(path) != sig:
+                    changed_at[path] = now
+            pending = current
+            changed_at = {path: changed_at[path] for path in pending}
+
+            ready = sorted(path for path in pending if now - changed_at[path] >= settings.debounce)
+            # 所有新图片都已写入完成，或者写入完成的图片已经攒够一批
+            if ready and (len(ready) == len(pending) or (settings.max_batch and len(ready) >= settings.max_batch)):
+                batch = ready[:settings.max_batch] if settings.max_batch else ready
+                known.update(batch)
+                for path in batch:
+                    del pending[path]
+                logging.info(f"监听到 {len(batch)} 张新图片")
+                yield batch
+                continue
+
+            timeout = settings.poll_interval
+            waiting = [changed_at[path] for path in pending if now - changed_at[path] < settings.debounce]
+            if waiting:
+                timeout = min(timeout, max(0.1, settings.debounce - (now - min(waiting))))
+            notifier.wait(timeout)
+    logging.info("停止监听")
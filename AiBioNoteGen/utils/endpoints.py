@@ -0,0 +1,291 @@
+"""多接口池模块
+
+该模块允许每个角色（vision / review / formatting 等）配置一组接口（endpoints），每次调用时选择负载最低的健康接口。
+主要功能包括：
+- 按在途请求数、权重、首 token 延迟和最近错误率计算负载
+- 熔断: 连续 failure_threshold 次失败后暂停使用 cooldown 秒，冷却结束后只放行一个探测请求
+- 故障转移: 调用失败时立即改用池中没有试过的接口
+接口状态按 (base_url, api_key, model) 在所有角色和线程间共享；只配置一个接口时行为不变。
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from . import budget, ratelimit
+except ImportError:  # 直接运行 utils 下的脚本时
+    import budget
+    import ratelimit
+
+# 接口条目中可以单独指定、缺省时从角色配置继承的字段
+FIELDS = ("base_url", "api_key", "model", "rate_limit")
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# 错误率对负载的放大倍数：错误率 50% 的接口负载按 1 + 4 × 0.5 = 3 倍计算
+_ERROR_PENALTY = 4.0
+# 视为接口故障的状态码（密钥失效、无权限、模型不存在），换一个接口可能成功
+_ENDPOINT_STATUS = (401, 403, 404)
+# 视为接口过慢的超时（回答过长导致的 total / reasoning 超限与接口无关）
+_ENDPOINT_LIMITS = ("first_token", "stall")
+
+
+@dataclass
+class FailoverSettings:
+    """熔断与负载估计参数（配置 failover 段）
+
+    Attributes:
+        failure_threshold (int): 连续失败多少次后熔断
+        cooldown (float): 第一次熔断的冷却时间（秒）
+        max_cooldown (float): 冷却时间上限，探测失败时冷却时间翻倍
+        decay (float): 延迟和错误率指数移动平均中最近一次调用的权重
+    """
+    failure_threshold: int = 3
+    cooldown: float = 30.0
+    max_cooldown: float = 300.0
+    decay: float = 0.2
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "FailoverSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        settings.failure_threshold = max(1, settings.failure_threshold)
+        settings.decay = min(1.0, max(0.01, settings.decay))
+        return settings
+
+
+class Endpoint:
+    """一个接口 (base_url, api_key, model) 的负载与健康状态，所有字段由模块锁保护
+
+    Attributes:
+        in_flight (int): 在途（含排队）的请求数
+        latency (Optional[float]): 首 token 延迟的移动平均（秒），还没有成功调用时为 None
+        error_rate (float): 错误率的移动平均
+        state (str): closed / open / half_open
+    """
+    def __init__(self, base_url: str, api_key: str, model: str, settings: FailoverSettings):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.settings = settings
+        self.in_flight = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = settings.cooldown
+        self.open_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.trips = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.model}@{self.base_url}"
+
+    def available(self, now: float) -> bool:
+        """是否可以接收请求：未熔断，或冷却已结束且没有正在进行的探测"""
+        if self.state == CLOSED:
+            return True
+        return self.state == OPEN and now >= self.open_until
+
+    def _succeed(self, latency: Optional[float]):
+        decay = self.settings.decay
+        if latency is not None:
+            self.latency = latency if self.latency is None else (1 - decay) * self.latency + decay * latency
+        self.error_rate *= 1 - decay
+        self.failures = 0
+        if self.state != CLOSED:
+            logging.info(f"接口 {self.name} 探测成功，恢复使用")
+            self.state = CLOSED
+            self.cooldown = self.settings.cooldown
+
+    def _fail(self, now: float):
+        decay = self.settings.decay
+        self.errors += 1
+        self.error_rate = (1 - decay) * self.error_rate + decay
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.settings.max_cooldown, self.cooldown * 2)
+            self._trip(now, "探测失败")
+        elif self.state == CLOSED and self.failures >= self.settings.failure_threshold:
+            self._trip(now, f"连续失败 {self.failures} 次")
+
+    def _trip(self, now: float, reason: str):
+        self.state = OPEN
+        self.open_until = now + self.cooldown
+        self.trips += 1
+        logging.warning(f"接口 {self.name} {reason}，熔断 {self.cooldown:.0f} 秒")
+
+    def snapshot(self) -> dict:
+        return {
+            "model": self.model,
+            "base_url": self.base_url,
+            "requests": self.requests,
+            "errors": self.errors,
+            "trips": self.trips,
+            "state": self.state,
+            "latency": None if self.latency is None else round(self.latency, 3),
+        }
+
+
+class Member:
+    """池中的一个接口：共享的接口状态 + 本角色使用的权重和限流器"""
+    def __init__(self, endpoint: Endpoint, weight: float, limiter: "ratelimit.EndpointLimiter"):
+        self.endpoint = endpoint
+        self.weight = weight
+        self.limiter = limiter
+
+    @property
+    def base_url(self) -> str:
+        return self.endpoint.base_url
+
+    @property
+    def api_key(self) -> str:
+        return self.endpoint.api_key
+
+    @property
+    def model(self) -> str:
+        return self.endpoint.model
+
+
+class EndpointPool:
+    """一个角色可用的接口列表，负责选择接口和记录每次调用的结果"""
+    def __init__(self, members: List[Member]):
+        if not members:
+            raise ValueError("接口池中至少需要一个接口")
+        self.members = members
+
+    @classmethod
+    def create(cls, entries: List[dict], failover: Optional[dict] = None, max_concurrency: int = 10) -> "EndpointPool":
+        """
+        Args:
+            entries (List[dict]): 接口列表，每项包含 base_url / api_key / model，可选 weight / rate_limit
+            failover (Optional[dict]): 熔断配置，见 FailoverSettings，只在接口第一次创建时生效
+            max_concurrency (int): 限流配置中没有 max_concurrency 时的并发上限
+        """
+        settings = FailoverSettings.from_config(failover)
+        members = []
+        for entry in entries:
+            endpoint = get_endpoint(entry["base_url"], entry["api_key"], entry["model"], settings)
+            limiter = ratelimit.get_limiter(entry["base_url"], entry["api_key"], entry.get("rate_limit"), max_concurrency)
+            members.append(Member(endpoint, max(float(entry.get("weight", 1.0)), 0.01), limiter))
+        return cls(members)
+
+    @property
+    def primary(self) -> Member:
+        return self.members[0]
+
+    def pick(self, exclude: Iterable[Member] = ()) -> Member:
+        """选择负载最低的健康接口并计入在途请求，调用结束后必须调用 done
+
+        exclude 中的接口（本次调用已经失败过的）只在没有其他接口时使用。
+        """
+        exclude = set(exclude)
+        candidates = [m for m in self.members if m not in exclude] or self.members
+        now = time.monotonic()
+        with _lock:
+            healthy = [m for m in candidates if m.endpoint.available(now)]
+            if healthy:
+                known = [m.endpoint.latency for m in healthy if m.endpoint.latency is not None]
+                # 还没有延迟数据的接口按已知延迟的平均值估计，保证新接口也会被尝试
+                default = sum(known) / len(known) if known else 1.0
+                member = min(healthy, key=lambda m: _load(m, default))
+                if member.endpoint.state == OPEN:
+                    member.endpoint.state = HALF_OPEN
+            else:
+                # 全部熔断时仍然发出请求，选最早恢复的接口
+                member = min(candidates, key=lambda m: m.endpoint.open_until)
+            member.endpoint.in_flight += 1
+            member.endpoint.requests += 1
+        return member
+
+    def done(self, member: Member, error: Optional[Exception] = None, latency: Optional[float] = None):
+        """记录一次调用的结果；与接口无关的错误（如请求本身有误）只释放在途计数"""
+        with _lock:
+            endpoint = member.endpoint
+            endpoint.in_flight -= 1
+            if error is None:
+                endpoint._succeed(latency)
+            elif is_endpoint_error(error):
+                endpoint._fail(time.monotonic())
+            elif endpoint.state == HALF_OPEN:
+                # 探测请求因其他原因失败，允许下一个请求继续探测
+                endpoint.state = OPEN
+
+    def can_fail_over(self, member: Member, error: Exception, tried: Iterable[Member]) -> bool:
+        """错误来自接口本身，且池中还有其他没有试过的接口"""
+        if len(self.members) < 2 or not is_endpoint_error(error):
+            return False
+        tried = set(tried) | {member}
+        return any(m not in tried for m in self.members)
+
+
+def _load(member: Member, default_latency: float) -> float:
+    endpoint = member.endpoint
+    latency = endpoint.latency if endpoint.latency is not None else default_latency
+    return (endpoint.in_flight + 1) / member.weight * max(latency, 0.001) * (1 + _ERROR_PENALTY * endpoint.error_rate)
+
+
+def is_endpoint_error(error: Exception) -> bool:
+    """错误是否说明接口本身有问题（换一个接口可能成功）"""
+    if isinstance(error, budget.BudgetExceeded):
+        return error.kind in _ENDPOINT_LIMITS
+    if getattr(error, "status_code", None) in _ENDPOINT_STATUS:
+        return True
+    return ratelimit.is_retryable(error)
+
+
+def role_endpoints(conf: dict, section: str) -> List[dict]:
+    """读取某个角色配置段的接口列表
+
+    角色配置中的 endpoints 为列表时，每项可以是：
+    - 字典: 可选 base_url / api_key / model / rate_limit / weight，省略的字段从角色配置继承；
+      写 "section" 时先使用该配置段的接口字段（例如把闲置的 incorporation / optimization 加入池中）
+    - 字符串: 等同于 {"section": 名称}
+    没有 endpoints 时角色配置本身就是唯一的接口。
+    """
+    role = conf[section]
+    entries = []
+    for item in role.get("endpoints") or [{}]:
+        if isinstance(item, str):
+            item = {"section": item}
+        entry = {k: role[k] for k in FIELDS if k in role}
+        if item.get("section"):
+            source = conf.get(item["section"])
+            if not isinstance(source, dict):
+                logging.error(f"{section} 的接口池引用了不存在的配置段 {item['section']}，已跳过")
+                continue
+            entry.update({k: source[k] for k in FIELDS if k in source})
+        entry.update({k: item[k] for k in FIELDS + ("weight",) if k in item})
+        missing = [k for k in ("base_url", "api_key", "model") if not entry.get(k)]
+        if missing:
+            logging.error(f"{section} 的接口池中有一项缺少 {missing}，已跳过")
+            continue
+        entries.append(entry)
+    if not entries:
+        raise ValueError(f"配置段 {section} 中没有可用的接口")
+    return entries
+
+
+_endpoints: Dict[tuple, Endpoint] = {}
+_lock = threading.Lock()
+
+
+def get_endpoint(base_url: str, api_key: str, model: str, settings: Optional[FailoverSettings] = None) -> Endpoint:
+    """获取（必要时创建）共享的接口状态，熔断配置只在第一次创建时生效"""
+    key = (base_url, api_key, model)
+    with _lock:
+        endpoint = _endpoints.get(key)
+        if endpoint is None:
+            endpoint = _endpoints[key] = Endpoint(base_url, api_key, model, settings or FailoverSettings())
+        return endpoint
+
+
+def pool_stats() -> List[dict]:
+    """所有接口的请求数、失败数、熔断次数、当前状态和首 token 延迟"""
+    with _lock:
+        return [endpoint.snapshot() for endpoint in _endpoints.values()]
@@ -10,20 +10,15 @@
 import os
 import json
 import logging
+try:
+    from . import logs
+except ImportError:  # 直接运行 utils/file.py 时
+    import logs
 
 current_dir = os.path.dirname(__file__)
 # log
 def log_init():
-    current_dir = os.path.dirname(__file__)
-    log_dir = os.path.join(current_dir, '..', 'log')
-    os.makedirs(log_dir, exist_ok=True)
-    log_file_path = os.path.join(log_dir, 'file.log')
-    logging.basicConfig(
-        filename=log_file_path,
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
-    )
+    logs.setup(logs.LogSettings(path=os.path.join(logs.LOG_DIR, 'file.log')))
 
 
 class Config:
@@ -43,10 +38,7 @@ class Config:
             default_context (dict): 默认配置内容，默认为空字典
             secret (bool): 是否为加密配置文件，默认为True
         """
-        if secret:
-            self.path = os.path.join(current_dir, '..', f'secret-{name}.json')
-        else:
-            self.path = os.path.join(current_dir, '..', f'{name}.json')
+        self.path = self.path_for(name, secret)
         self.context = default_context
         try:
             if not os.path.exists(self.path):
@@ -57,6 +49,13 @@ class Config:
             raise e
         self.load()
             
+    @staticmethod
+    def path_for(name: str, secret: bool = True) -> str:
+        """名为 name 的配置文件路径（不创建文件）"""
+        if secret:
+            return os.path.join(current_dir, '..', f'secret-{name}.json')
+        return os.path.join(current_dir, '..', f'{name}.json')
+
     def load(self):
         """从文件加载配置内容
         
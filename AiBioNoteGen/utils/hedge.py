@@ -0,0 +1,221 @@
+"""对冲请求模块
+
+Vision 阶段的耗时取决于最慢的一张图片：qvq-max 偶尔在思考过程中停留很久，整批的 Build 都要等它。
+启用对冲（角色配置中的 hedge 段）后，一次请求发出后如果超过最近首个回答 token 延迟的 percentile 分位数
+（不少于 min_delay 秒）还没有开始回答，就再发一个相同的请求（优先发给接口池中的其他接口，见 endpoints.py）：
+- 两路请求中先开始输出回答的一路胜出，另一路立即取消（关闭连接），回答只交给调用方一次
+- 对冲次数不超过调用次数的 max_ratio，额外的花费有上限；最近的样本少于 min_samples 时不对冲
+- 胜出的对冲请求按历史延迟估算节省的时间：原请求的延迟取历史样本中超过当时已等待时间的样本的平均值
+对冲次数、胜出次数和估算节省的时间记录在调用指标中，运行汇总按角色统计。
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+try:
+    from . import metrics
+except ImportError:  # 直接运行 utils 下的脚本时
+    import metrics
+
+
+class HedgeLost(Exception):
+    """对冲竞争中落败的一路请求，由胜出的一路取消"""
+
+
+@dataclass
+class HedgeSettings:
+    """对冲参数（角色配置中的 hedge 段）
+
+    Attributes:
+        enabled (bool): 是否启用对冲，默认关闭
+        percentile (float): 等待多久后对冲：最近首个回答 token 延迟的分位数（0~100）
+        min_delay (float): 对冲前至少等待的秒数
+        max_ratio (float): 对冲次数占调用次数的上限
+        window (int): 计算分位数使用的最近样本数
+        min_samples (int): 样本少于该数时不对冲
+    """
+    enabled: bool = False
+    percentile: float = 95.0
+    min_delay: float = 1.0
+    max_ratio: float = 0.1
+    window: int = 200
+    min_samples: int = 20
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "HedgeSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        settings.percentile = min(100.0, max(0.0, settings.percentile))
+        settings.window = max(1, settings.window)
+        return settings
+
+
+class HedgePolicy:
+    """一个角色的对冲策略：维护最近的延迟样本和对冲配额"""
+    def __init__(self, settings: Optional[HedgeSettings] = None):
+        self.settings = settings or HedgeSettings()
+        self.samples = collections.deque(maxlen=self.settings.window)
+        self.calls = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.enabled
+
+    def delay(self) -> Optional[float]:
+        """本次请求的对冲等待时间，不对冲时为 None；同时计入调用次数"""
+        if not self.settings.enabled:
+            return None
+        with self._lock:
+            self.calls += 1
+            if len(self.samples) < self.settings.min_samples:
+                return None
+            recent = metrics.percentile(list(self.samples), self.settings.percentile)
+            return max(self.settings.min_delay, recent or 0.0)
+
+    def acquire(self) -> bool:
+        """占用一次对冲配额，超过 max_ratio 时返回 False"""
+        with self._lock:
+            if self.hedges + 1 > self.settings.max_ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def observe(self, latency: float):
+        """记录一次调用从发出到首个回答 token 的时间"""
+        with self._lock:
+            self.samples.append(latency)
+
+    def estimate_saved(self, elapsed: float) -> float:
+        """对冲胜出时估算节省的时间：原请求已等待 elapsed 秒，按历史上更慢的样本估计它还要等多久"""
+        with self._lock:
+            slower = [value for value in self.samples if value > elapsed]
+        if not slower:
+            return 0.0
+        return sum(slower) / len(slower) - elapsed
+
+
+class Race:
+    """一次尝试中的两路请求（原请求和对冲请求）
+
+    每一路开始输出回答时调用 claim，第一个调用的一路胜出，其余各路被取消。
+    同步调用的一路通过 StreamGuard.cancel 关闭连接，异步调用的一路取消所在的任务。
+    """
+    def __init__(self, policy: HedgePolicy, delay: float, launch: Callable[[], None]):
+        """
+        Args:
+            policy: 所属角色的对冲策略
+            delay: 原请求发出后等待多久对冲
+            launch: 发出对冲请求，由计时器（同步）或事件循环（异步）调用
+        """
+        self.policy = policy
+        self.delay = delay
+        self.launch = launch
+        self.winner = None
+        self.hedged = False
+        self.saved = 0.0
+        self.tasks = []
+        self._legs = []
+        self._settled = {}
+        self._closed = False
+        self._timer = None
+        self._started = None
+        self._cond = threading.Condition()
+
+    def join(self, collector, cancel: Callable[[], None]):
+        """登记一路请求（发出请求之前）；第一路登记时开始计时。竞争已经结束时抛出 HedgeLost"""
+        with self._cond:
+            if self.winner is not None or (self._legs and self._closed):
+                raise HedgeLost()
+            self._legs.append((collector, cancel))
+            first = len(self._legs) == 1
+        if first:
+            self._started = time.perf_counter()
+            self._arm()
+
+    def _arm(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            self._timer = loop.call_later(self.delay, self._fire)
+        else:
+            self._timer = threading.Timer(self.delay, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self):
+        with self._cond:
+            primary = self._legs[0][0]
+            if self._closed or self.winner is not None or primary.first_answer is not None:
+                return
+            if not self.policy.acquire():
+                return
+            self.hedged = True
+        logging.info(f"请求 {self.delay:.1f} 秒内没有开始回答，发出对冲请求")
+        try:
+            self.launch()
+        except Exception as e:
+            logging.error(f"发出对冲请求失败: {e}")
+
+    def claim(self, collector) -> bool:
+        """某一路开始输出回答（或没有回答内容就结束）时调用，返回这一路是否胜出"""
+        with self._cond:
+            if self.winner is None:
+                self.winner = collector
+                losers = [cancel for leg, cancel in self._legs if leg is not collector]
+                if collector is not self._legs[0][0]:
+                    self.saved = self.policy.estimate_saved(time.perf_counter() - self._started)
+            else:
+                return self.winner is collector
+        self._stop_timer()
+        for cancel in losers:
+            cancel()
+        return True
+
+    def settle(self, collector, error: Optional[Exception] = None):
+        """对冲请求结束（成功、失败或被取消）"""
+        with self._cond:
+            self._settled[id(collector)] = error
+            self._cond.notify_all()
+
+    def close(self):
+        """原请求结束，之后不再发出对冲请求"""
+        with self._cond:
+            self._closed = True
+        self._stop_timer()
+
+    def _stop_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _result(self, primary) -> Optional[tuple]:
+        if self.winner is None or self.winner is primary:
+            return None
+        return self.winner, self._settled.get(id(self.winner))
+
+    def resolve(self, primary) -> Optional[tuple]:
+        """原请求失败或落败后调用：等待对冲请求结束。
+
+        Returns:
+            Optional[tuple]: 对冲请求胜出时为 (对冲请求的 collector, 异常或 None)，否则为 None
+        """
+        self.close()
+        with self._cond:
+            self._cond.wait_for(lambda: all(id(leg) in self._settled for leg, _ in self._legs[1:]))
+            return self._result(primary)
+
+    async def resolve_async(self, primary) -> Optional[tuple]:
+        """resolve 的异步版本，等待对冲任务结束"""
+        self.close()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        return self._result(primary)
+
@@ -0,0 +1,281 @@
+"""图片预处理模块
+
+在 base64 编码之前对图片做预处理，减少上传体积、视觉 token 和首 token 延迟：
+- 按 EXIF 方向旋正，并去除 EXIF 等元数据
+- 长边超过 max_edge 时等比缩小
+- 按质量（或目标体积）重新编码为 JPEG
+- 根据文件内容识别真实的 MIME 类型
+预处理是纯 CPU 工作，由调用方放入进程池与网络请求并行执行。
+依赖 Pillow；未安装时只做 MIME 识别，原样上传。
+另外提供多图批量请求的分组工具：同一目录下按文件名顺序相邻的图片放进同一次 Vision 请求，
+受图片数、字节数和估算 token 数限制。
+"""
+
+import base64
+import io
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import List
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+    ImageOps = None
+
+try:
+    from . import ratelimit
+except ImportError:  # 直接运行 utils 下的脚本时
+    import ratelimit
+
+# 估算视觉 token 时每个 token 覆盖的像素边长（常见视觉模型按 28x28 切块）
+_PATCH_EDGE = 28
+
+_MAGIC = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+
+def detect_mime(data: bytes, default: str = 'image/jpeg') -> str:
+    """根据文件头识别图片的 MIME 类型"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for magic, mime in _MAGIC:
+        if data.startswith(magic):
+            return mime
+    return default
+
+
+def detect_mime_base64(encoded: str, default: str = 'image/jpeg') -> str:
+    """根据 base64 编码内容的开头识别图片的 MIME 类型"""
+    try:
+        head = base64.b64decode(encoded[:24])
+    except (ValueError, TypeError):
+        return default
+    return detect_mime(head, default)
+
+
+@dataclass
+class ImageSettings:
+    """预处理参数
+
+    Attributes:
+        enabled (bool): 是否启用预处理（未安装 Pillow 时自动关闭）
+        max_edge (int): 长边上限（像素），0 表示不缩放
+        quality (int): JPEG 编码质量
+        target_kb (int): 目标体积（KB），超过时逐步降低质量，0 表示不限制
+        min_quality (int): 按目标体积降质时的最低质量
+        workers (int): 预处理进程数，0 表示由系统决定
+    """
+    enabled: bool = True
+    max_edge: int = 2048
+    quality: int = 85
+    target_kb: int = 0
+    min_quality: int = 50
+    workers: int = 0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "ImageSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        if settings.enabled and Image is None:
+            logging.warning("未安装 Pillow，跳过图片预处理，仅识别 MIME 类型")
+            settings.enabled = False
+        return settings
+
+    def cache_tag(self) -> str:
+        """参与缓存键计算的参数摘要：预处理参数不同，模型看到的图片也不同"""
+        if not self.enabled:
+            return "raw"
+        return f"edge={self.max_edge};q={self.quality};target={self.target_kb};min={self.min_quality}"
+
+
+@dataclass
+class PreparedImage:
+    """预处理后的图片
+
+    Attributes:
+        path (str): 原图路径
+        data_url (str): 可直接放入请求的 data URL
+        mime (str): 上传的 MIME 类型
+        original_bytes (int): 原图字节数
+        prepared_bytes (int): 上传的字节数
+        size (tuple): 上传图片的 (宽, 高)，未知时为 None
+    """
+    path: str
+    data_url: str
+    mime: str
+    original_bytes: int
+    prepared_bytes: int
+    size: tuple = None
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - self.prepared_bytes
+
+
+def _encode(img, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    # 不传 exif 参数，保存时即去除全部元数据
+    img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def prepare_image(path: str, settings: ImageSettings) -> PreparedImage:
+    """读取并预处理一张图片
+
+    原图是无需旋正、缩放且不含元数据的 JPEG，并且重新编码后反而更大时，上传原图。
+    该函数只依赖参数，可以在子进程中执行。
+
+    Args:
+        path (str): 图片路径
+        settings (ImageSettings): 预处理参数
+
+    Returns:
+        PreparedImage: 预处理结果
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    mime = detect_mime(raw)
+    data, size = raw, None
+
+    if settings.enabled and Image is not None:
+        try:
+            data, mime, size = _reencode(raw, mime, settings)
+        # 损坏的图片抛出 OSError，EXIF 或颜色模式异常抛出 ValueError，超大图片抛出 DecompressionBombError
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logging.warning(f"图片预处理失败，上传原图 {path}: {e}")
+
+    encoded_b64 = base64.b64encode(data).decode('utf-8')
+    return PreparedImage(path, f"data:{mime};base64,{encoded_b64}", mime, len(raw), len(data), size)
+
+
+def _reencode(raw: bytes, mime: str, settings: ImageSettings):
+    """旋正、缩放并重新编码，返回 (数据, MIME, 尺寸)"""
+    data = raw
+    with Image.open(io.BytesIO(raw)) as img:
+        # 无需旋正、没有元数据、尺寸不变的 JPEG 才允许保留原图
+        pristine = img.getexif().get(0x0112, 1) == 1 and not img.info.get('exif') and mime == 'image/jpeg'
+        original_size = img.size
+        transposed = ImageOps.exif_transpose(img)
+        if transposed.mode not in ('RGB', 'L'):
+            # 透明背景铺白后再转 JPEG
+            background = Image.new('RGB', transposed.size, (255, 255, 255))
+            rgba = transposed.convert('RGBA')
+            background.paste(rgba, mask=rgba.split()[-1])
+            transposed = background
+        if settings.max_edge and max(transposed.size) > settings.max_edge:
+            transposed.thumbnail((settings.max_edge, settings.max_edge), Image.LANCZOS)
+        quality = settings.quality
+        encoded = _encode(transposed, quality)
+        while settings.target_kb and len(encoded) > settings.target_kb * 1024 and quality > settings.min_quality:
+            quality = max(settings.min_quality, quality - 10)
+            encoded = _encode(transposed, quality)
+        if not (pristine and transposed.size == original_size and len(encoded) >= len(raw)):
+            data, mime = encoded, 'image/jpeg'
+        return data, mime, transposed.size
+
+
+def log_saving(prepared: PreparedImage):
+    """记录单张图片预处理节省的字节数"""
+    name = os.path.basename(prepared.path)
+    if prepared.original_bytes:
+        ratio = prepared.saved_bytes / prepared.original_bytes * 100
+    else:
+        ratio = 0
+    logging.info(f"图片预处理 {name}: {prepared.original_bytes / 1024:.0f}KB -> {prepared.prepared_bytes / 1024:.0f}KB "
+                 f"(节省 {ratio:.0f}%)")
+
+
+@dataclass
+class BatchSettings:
+    """多图批量请求参数
+
+    Attributes:
+        max_images (int): 每次请求的图片数上限，1 表示不合并
+        max_kb (int): 每次请求上传的图片总体积上限（KB），0 表示不限制
+        max_tokens (int): 每次请求的图片估算 token 上限，0 表示不限制
+    """
+    max_images: int = 1
+    max_kb: int = 0
+    max_tokens: int = 0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "BatchSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        settings.max_images = max(1, settings.max_images)
+        return settings
+
+
+def _natural_key(path: str):
+    """文件名中的数字按数值比较，保证 page2 排在 page10 之前"""
+    name = os.path.basename(path).lower()
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def plan_batches(paths: List[str], max_images: int) -> List[List[str]]:
+    """按目录和文件名顺序把图片分成批次
+
+    同一目录下按文件名排序后相邻的图片（例如同一章节的连续页面）依次放进同一批，
+    不同目录的图片不会合并。
+
+    Args:
+        paths (List[str]): 图片路径
+        max_images (int): 每批的图片数上限
+
+    Returns:
+        List[List[str]]: 批次列表
+    """
+    by_dir = {}
+    for path in paths:
+        by_dir.setdefault(os.path.dirname(path), []).append(path)
+    batches = []
+    for dir_paths in by_dir.values():
+        dir_paths.sort(key=_natural_key)
+        step = max(1, max_images)
+        batches.extend(dir_paths[i:i + step] for i in range(0, len(dir_paths), step))
+    return batches
+
+
+def estimate_tokens(prepared: PreparedImage) -> int:
+    """按上传尺寸估算一张图片的视觉 token 数，尺寸未知时按固定值计算"""
+    if not prepared.size:
+        return ratelimit.IMAGE_TOKEN_ESTIMATE
+    width, height = prepared.size
+    return math.ceil(width / _PATCH_EDGE) * math.ceil(height / _PATCH_EDGE)
+
+
+def split_batch(prepared: List[PreparedImage], settings: BatchSettings) -> List[List[PreparedImage]]:
+    """按体积和 token 上限把预处理后的一批图片依次拆分，单张超限的图片单独成批"""
+    groups = []
+    current, current_bytes, current_tokens = [], 0, 0
+    for item in prepared:
+        tokens = estimate_tokens(item)
+        over = (len(current) >= settings.max_images
+                or (settings.max_kb and current_bytes + item.prepared_bytes > settings.max_kb * 1024)
+                or (settings.max_tokens and current_tokens + tokens > settings.max_tokens))
+        if current and over:
+            groups.append(current)
+            current, current_bytes, current_tokens = [], 0, 0
+        current.append(item)
+        current_bytes += item.prepared_bytes
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def batch_prompt(prompt: str, count: int) -> str:
+    """多图请求的 Prompt：说明图片是按顺序排列的连续页面"""
+    if count <= 1:
+        return prompt
+    return (f"{prompt}\n\n（本次共输入 {count} 张图片，是同一章节按顺序排列的连续页面，"
+            f"请把它们作为一个整体生成草稿，内容仍须全部来自图片。）")
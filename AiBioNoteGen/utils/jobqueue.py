@@ -0,0 +1,402 @@
+"""本地任务队列模块
+
+该模块把一次运行拆成持久化在 SQLite（WAL 模式）中的任务，多个工作进程可以同时从队列中领取。
+主要功能包括：
+- 主题组: 一次入队中同一目录下的图片，Build / Gen 以组为单位
+- vision / build / gen 任务: 一组的 vision 任务全部结束后创建 build 任务，build 完成后创建 gen 任务
+- 租约: 领取时写入 lease_until 和租约编号，由心跳线程续约，过期的任务会被重新领取
+- 超过 max_attempts 次仍未完成的任务记为失败
+数据库需要放在本地磁盘上，SQLite 不支持网络文件系统上的 WAL。
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+current_dir = os.path.dirname(__file__)
+DEFAULT_QUEUE_PATH = os.path.join(current_dir, '..', 'queue', 'jobs.db')
+KINDS = ("vision", "build", "gen")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'vision',
+    duplicates TEXT NOT NULL DEFAULT '{}',
+    saved INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    group_id INTEGER NOT NULL REFERENCES groups(id),
+    image TEXT NOT NULL DEFAULT '',
+    route TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT NOT NULL DEFAULT '',
+    lease TEXT NOT NULL DEFAULT '',
+    lease_until REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (group_id, kind, image)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, kind, lease_until);
+CREATE INDEX IF NOT EXISTS jobs_group ON jobs (group_id, kind, state);
+"""
+
+# 领取顺序：先完成已经进行到后面阶段的主题组
+_CLAIM_ORDER = "CASE kind WHEN 'gen' THEN 0 WHEN 'build' THEN 1 ELSE 2 END, group_id, id"
+
+
+@dataclass
+class QueueSettings:
+    """任务队列参数
+
+    Attributes:
+        path (str): SQLite 数据库路径，为空时使用 queue/jobs.db
+        workers (int): work 子命令默认的工作线程数
+        lease_seconds (float): 租约时长，工作进程在此期间没有心跳时任务会被重新领取
+        heartbeat_seconds (float): 续约间隔，0 表示租约时长的三分之一
+        max_attempts (int): 每个任务最多领取的次数（含租约过期后的重新领取）
+        poll_interval (float): 队列为空时两次查询的间隔（秒）
+    """
+    path: str = ""
+    workers: int = 4
+    lease_seconds: float = 120.0
+    heartbeat_seconds: float = 0.0
+    max_attempts: int = 3
+    poll_interval: float = 2.0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "QueueSettings":
+        conf = conf or {}
+        return cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+
+    @property
+    def db_path(self) -> str:
+        return self.path or DEFAULT_QUEUE_PATH
+
+    @property
+    def heartbeat_interval(self) -> float:
+        return self.heartbeat_seconds or self.lease_seconds / 3
+
+
+@dataclass
+class Job:
+    """一个已领取的任务
+
+    Attributes:
+        id (int): 任务编号
+        kind (str): vision / build / gen
+        group_id (int): 主题组编号
+        image (str): vision 任务的图片路径，其他任务为空
+        route (str): vision 任务的难度路由（fast / deep），未路由时为空
+        attempts (int): 已领取的次数（含本次）
+        lease (str): 本次领取的租约编号
+    """
+    id: int
+    kind: str
+    group_id: int
+    image: str
+    route: str
+    attempts: int
+    lease: str
+
+
+def worker_name(index: int = 0) -> str:
+    """工作线程的名称：主机名-进程号-序号"""
+    return f"{socket.gethostname()}-{os.getpid()}-{index}"
+
+
+class JobQueue:
+    """SQLite 任务队列，每个线程使用自己的连接"""
+    def __init__(self, settings: Optional[QueueSettings] = None):
+        self.settings = settings or QueueSettings()
+        self.path = self.settings.db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 自行管理事务（isolation_level=None），写事务用 BEGIN IMMEDIATE 避免升级锁时死锁
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --- 入队 ---
+    def queued_images(self) -> set:
+        """还在处理中的图片（所在主题组尚未结束），重复入队时跳过"""
+        rows = self._connect().execute(
+            "SELECT jobs.image FROM jobs JOIN groups ON groups.id = jobs.group_id "
+            "WHERE jobs.kind = 'vision' AND groups.state NOT IN ('done', 'failed')").fetchall()
+        return {row["image"] for row in rows}
+
+    def enqueue(self, groups: Dict[str, List[str]], duplicates: Optional[Dict[str, str]] = None,
+                routes: Optional[Dict[str, str]] = None) -> List[int]:
+        """把图片按主题组加入队列
+
+        Args:
+            groups: {组名: 图片路径列表（按处理顺序）}
+            duplicates: 去重时跳过的图片 {重复图片: 代表图片}，随代表图片所在的组一起清理
+            routes: 难度路由结果 {图片路径: fast / deep}
+
+        Returns:
+            List[int]: 新建的主题组编号
+        """
+        duplicates = duplicates or {}
+        routes = routes or {}
+        now = time.time()
+        group_ids = []
+        with self._transaction() as conn:
+            for name, images in groups.items():
+                # 同一路径重复出现会违反 (group_id, kind, image) 唯一约束并回滚整个入队，只保留第一次
+                images = list(dict.fromkeys(images))
+                if not images:
+                    continue
+                members = set(images)
+                group_duplicates = {dup: kept for dup, kept in duplicates.items() if kept in members}
+                cursor = conn.execute("INSERT INTO groups (name, duplicates, created, updated) VALUES (?, ?, ?, ?)",
+                                      (name, json.dumps(group_duplicates, ensure_ascii=False), now, now))
+                group_id = cursor.lastrowid
+                conn.executemany(
+                    "INSERT INTO jobs (kind, group_id, image, route, created, updated) VALUES ('vision', ?, ?, ?, ?, ?)",
+                    [(group_id, image, routes.get(image, ""), now, now) for image in images])
+                group_ids.append(group_id)
+        return group_ids
+
+    # --- 领取与续约 ---
+    def claim(self, worker: str, max_images: int = 1) -> List[Job]:
+        """领取下一个任务，没有可领取的任务时返回空列表
+
+        vision 任务会连同同一组、同一路线中紧随其后的可领取图片一起领取，最多 max_images 张。
+        """
+        now = time.time()
+        claimable = "(state = 'pending' OR (state = 'running' AND lease_until < ?))"
+        with self._transaction() as conn:
+            self._expire(conn, now)
+            row = conn.execute(f"SELECT * FROM jobs WHERE {claimable} ORDER BY {_CLAIM_ORDER} LIMIT 1",
+                               (now,)).fetchone()
+            if row is None:
+                return []
+            rows = [row]
+            if row["kind"] == "vision" and max_images > 1:
+                rows += conn.execute(
+                    f"SELECT * FROM jobs WHERE {claimable} AND kind = 'vision' AND group_id = ? AND route = ? "
+                    f"AND id > ? ORDER BY id LIMIT ?",
+                    (now, row["group_id"], row["route"], row["id"], max_images - 1)).fetchall()
+            lease = uuid.uuid4().hex
+            until = now + self.settings.lease_seconds
+            conn.executemany(
+                "UPDATE jobs SET state = 'running', worker = ?, lease = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated = ? WHERE id = ?",
+                [(worker, lease, until, now, r["id"]) for r in rows])
+            if row["kind"] != "vision":
+                conn.execute("UPDATE groups SET state = ?, updated = ? WHERE id = ?", (row["kind"], now, row["group_id"]))
+        jobs = [Job(r["id"], r["kind"], r["group_id"], r["image"], r["route"], r["attempts"] + 1, lease) for r in rows]
+        for job in jobs:
+            if job.attempts > 1:
+                logging.warning(f"重新领取任务 {job.id}（{job.kind}，第 {job.attempts} 次）")
+        return jobs
+
+    def _expire(self, conn: sqlite3.Connection, now: float):
+        """租约过期且领取次数已用完的任务记为失败"""
+        rows = conn.execute("SELECT id, kind, group_id FROM jobs WHERE state = 'running' AND lease_until < ? "
+                            "AND attempts >= ?", (now, self.settings.max_attempts)).fetchall()
+        for row in rows:
+            logging.error(f"任务 {row['id']}（{row['kind']}）多次租约过期，记为失败")
+            conn.execute("UPDATE jobs SET state = 'failed', error = ?, updated = ? WHERE id = ?",
+                         ("租约过期次数过多", now, row["id"]))
+            self._advance(conn, row["kind"], row["group_id"], now)
+
+    def heartbeat(self, jobs: Iterable[Job]) -> int:
+        """为仍然持有的任务续约，返回续约成功的任务数"""
+        now = time.time()
+        until = now + self.settings.lease_seconds
+        renewed = 0
+        with self._transaction() as conn:
+            for job in jobs:
+                cursor = conn.execute("UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND lease = ? "
+                                      "AND state = 'running'", (until, now, job.id, job.lease))
+                renewed += cursor.rowcount
+        return renewed
+
+    # --- 完成 ---
+    def complete(self, job: Job, result: Optional[str] = None) -> bool:
+        """提交任务结果并推进主题组；租约已被其他工作进程接手时返回 False"""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET state = 'done', result = ?, error = '', updated = ? "
+                                  "WHERE id = ? AND lease = ? AND state = 'running'", (result, now, job.id, job.lease))
+            if not cursor.rowcount:
+                logging.warning(f"任务 {job.id} 的租约已失效，结果被丢弃")
+                return False
+            self._advance(conn, job.kind, job.group_id, now)
+        return True
+
+    def fail(self, job: Job, error: str):
+        """任务失败：领取次数未用完时放回队列，否则记为失败并推进主题组"""
+        now = time.time()
+        final = job.attempts >= self.settings.max_attempts
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET state = ?, error = ?, lease = '', lease_until = 0, updated = ? "
+                                  "WHERE id = ? AND lease = ? AND state = 'running'",
+                                  ("failed" if final else "pending", error[:2000], now, job.id, job.lease))
+            if cursor.rowcount and final:
+                self._advance(conn, job.kind, job.group_id, now)
+        if final:
+            logging.error(f"任务 {job.id}（{job.kind}）失败 {job.attempts} 次，不再重试: {error}")
+        else:
+            logging.warning(f"任务 {job.id}（{job.kind}）失败，放回队列: {error}")
+
+    def _advance(self, conn: sqlite3.Connection, kind: str, group_id: int, now: float):
+        """某个任务结束后推进主题组：vision 全部结束时创建 build，build 完成后创建 gen"""
+        if kind == "vision":
+            left = conn.execute("SELECT COUNT(*) FROM jobs WHERE group_id = ? AND kind = 'vision' "
+                                "AND state NOT IN ('done', 'failed')", (group_id,)).fetchone()[0]
+            if left:
+                return
+            drafts = conn.execute("SELECT COUNT(*) FROM jobs WHERE group_id = ? AND kind = 'vision' AND state = 'done' "
+                                  "AND result != ''", (group_id,)).fetchone()[0]
+            if not drafts:
+                logging.error(f"主题组 {group_id} 的图片均未能生成初稿，图片已保留")
+                self._set_group(conn, group_id, "failed", now)
+                return
+            self._add(conn, "build", group_id, now)
+        elif kind == "build":
+            state = conn.execute("SELECT state FROM jobs WHERE group_id = ? AND kind = 'build'",
+                                 (group_id,)).fetchone()[0]
+            if state == "done":
+                self._add(conn, "gen", group_id, now)
+            else:
+                self._set_group(conn, group_id, "failed", now)
+        elif kind == "gen":
+            state = conn.execute("SELECT state FROM jobs WHERE group_id = ? AND kind = 'gen'",
+                                 (group_id,)).fetchone()[0]
+            self._set_group(conn, group_id, "done" if state == "done" else "failed", now)
+
+    @staticmethod
+    def _add(conn: sqlite3.Connection, kind: str, group_id: int, now: float):
+        conn.execute("INSERT OR IGNORE INTO jobs (kind, group_id, created, updated) VALUES (?, ?, ?, ?)",
+                     (kind, group_id, now, now))
+
+    @staticmethod
+    def _set_group(conn: sqlite3.Connection, group_id: int, state: str, now: float):
+        conn.execute("UPDATE groups SET state = ?, updated = ? WHERE id = ?", (state, now, group_id))
+
+    # --- 查询 ---
+    def drafts(self, group_id: int) -> List[Tuple[str, Optional[str]]]:
+        """一组图片的 (图片路径, 初稿)，按入队顺序；失败的图片初稿为 None，合并请求中的其余图片为空字符串"""
+        rows = self._connect().execute("SELECT image, state, result FROM jobs WHERE group_id = ? AND kind = 'vision' "
+                                       "ORDER BY id", (group_id,)).fetchall()
+        return [(row["image"], row["result"] if row["state"] == "done" else None) for row in rows]
+
+    def result(self, group_id: int, kind: str) -> Optional[str]:
+        row = self._connect().execute("SELECT result FROM jobs WHERE group_id = ? AND kind = ? AND state = 'done'",
+                                      (group_id, kind)).fetchone()
+        return None if row is None else row["result"]
+
+    def group(self, group_id: int) -> dict:
+        row = self._connect().execute("SELECT * FROM groups WHERE id = ?", (group_id,)).fetchone()
+        group = dict(row)
+        group["duplicates"] = json.loads(group["duplicates"])
+        return group
+
+    def set_saved(self, group_id: int, saved: int):
+        with self._transaction() as conn:
+            conn.execute("UPDATE groups SET saved = ?, updated = ? WHERE id = ?", (saved, time.time(), group_id))
+
+    def idle(self) -> bool:
+        """队列中没有等待或正在处理的任务"""
+        row = self._connect().execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')").fetchone()
+        return not row[0]
+
+    def status(self) -> dict:
+        """队列概况：各类任务的状态计数、主题组进度、租约过期的任务和活跃的工作进程"""
+        conn = self._connect()
+        now = time.time()
+        jobs = {kind: {} for kind in KINDS}
+        for row in conn.execute("SELECT kind, state, COUNT(*) AS n FROM jobs GROUP BY kind, state"):
+            jobs.setdefault(row["kind"], {})[row["state"]] = row["n"]
+        groups = []
+        for row in conn.execute(
+                "SELECT groups.id, groups.name, groups.state, groups.saved, "
+                "SUM(jobs.kind = 'vision') AS images, "
+                "SUM(jobs.kind = 'vision' AND jobs.state = 'done') AS drafted, "
+                "SUM(jobs.kind = 'vision' AND jobs.state = 'failed') AS failed "
+                "FROM groups JOIN jobs ON jobs.group_id = groups.id GROUP BY groups.id ORDER BY groups.id"):
+            groups.append(dict(row))
+        expired = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running' AND lease_until < ?",
+                               (now,)).fetchone()[0]
+        workers = [row["worker"] for row in conn.execute(
+            "SELECT DISTINCT worker FROM jobs WHERE state = 'running' AND lease_until >= ? ORDER BY worker", (now,))]
+        return {"jobs": jobs, "groups": groups, "expired": expired, "workers": workers}
+
+
+class Heartbeat:
+    """后台续约线程：定期为所有正在处理的任务延长租约"""
+    def __init__(self, queue: JobQueue):
+        self.queue = queue
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="queue-heartbeat", daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def hold(self, jobs: List[Job]):
+        """处理 jobs 期间为其续约"""
+        with self._lock:
+            self._held.update((job.id, job) for job in jobs)
+        try:
+            yield jobs
+        finally:
+            with self._lock:
+                for job in jobs:
+                    self._held.pop(job.id, None)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.settings.heartbeat_interval):
+            with self._lock:
+                jobs = list(self._held.values())
+            if not jobs:
+                continue
+            try:
+                renewed = self.queue.heartbeat(jobs)
+            except sqlite3.Error as e:
+                logging.error(f"任务续约失败: {e}")
+                continue
+            if renewed < len(jobs):
+                logging.warning(f"{len(jobs) - renewed} 个任务的租约已失效，结果将被丢弃")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
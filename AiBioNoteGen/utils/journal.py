@@ -0,0 +1,132 @@
+"""运行日志（断点续跑）模块
+
+每次运行在 runs/<run_id>/ 下记录三个阶段的输入与输出，阶段完成后立即落盘：
+- manifest.json: 本次运行的图片列表、去重时跳过的重复图片与状态
+- drafts/<序号>.md: 每张图片的初稿（Vision 阶段）
+- build_input.md / build.md: Build 阶段的输入与输出
+- gen_input.md / gen.md: Gen 阶段的输入与输出
+使用 --resume <run_id> 重新运行时，已完成的部分直接从这里读取。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+current_dir = os.path.dirname(__file__)
+DEFAULT_RUNS_DIR = os.path.join(current_dir, '..', 'runs')
+
+
+def _atomic_write(path: str, text: str):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class RunJournal:
+    """单次运行的断点记录
+
+    Attributes:
+        run_id (str): 运行编号
+        path (str): 本次运行的记录目录
+        manifest (dict): 图片列表与运行状态
+    """
+    def __init__(self, run_id: str, root: str = DEFAULT_RUNS_DIR):
+        self.run_id = run_id
+        self.path = os.path.join(root, run_id)
+        self.manifest = {"run_id": run_id, "status": "running", "images": []}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, image_paths: List[str], root: str = DEFAULT_RUNS_DIR,
+               duplicates: Optional[Dict[str, str]] = None) -> "RunJournal":
+        """为新的运行创建记录目录
+
+        Args:
+            image_paths (List[str]): 本次运行处理的图片
+            root (str): 所有运行记录的根目录
+            duplicates (Optional[Dict[str, str]]): 去重时跳过的图片 {重复图片: 代表图片}
+        """
+        run_id = time.strftime("%Y%m%d-%H%M%S")
+        journal = cls(run_id, root)
+        suffix = 1
+        while os.path.exists(journal.path):
+            journal = cls(f"{run_id}-{suffix}", root)
+            suffix += 1
+        os.makedirs(os.path.join(journal.path, 'drafts'))
+        journal.manifest["images"] = list(image_paths)
+        journal.manifest["duplicates"] = dict(duplicates or {})
+        journal.manifest["created"] = time.time()
+        journal._save_manifest()
+        logging.info(f"创建运行记录: {journal.run_id}")
+        return journal
+
+    @classmethod
+    def load(cls, run_id: str, root: str = DEFAULT_RUNS_DIR) -> "RunJournal":
+        """加载已有的运行记录用于续跑
+
+        Raises:
+            FileNotFoundError: 运行记录不存在时抛出
+        """
+        journal = cls(run_id, root)
+        manifest = _read(os.path.join(journal.path, 'manifest.json'))
+        if manifest is None:
+            raise FileNotFoundError(f"找不到运行记录: {journal.path}")
+        journal.manifest = json.loads(manifest)
+        os.makedirs(os.path.join(journal.path, 'drafts'), exist_ok=True)
+        logging.info(f"续跑运行记录: {run_id}")
+        return journal
+
+    @property
+    def images(self) -> List[str]:
+        return self.manifest["images"]
+
+    @property
+    def duplicates(self) -> Dict[str, str]:
+        """去重时跳过的图片 {重复图片: 代表图片}"""
+        return self.manifest.get("duplicates", {})
+
+    def _save_manifest(self):
+        with self._lock:
+            _atomic_write(os.path.join(self.path, 'manifest.json'),
+                          json.dumps(self.manifest, ensure_ascii=False, indent=2))
+
+    def _draft_path(self, image_path: str) -> str:
+        index = self.images.index(image_path)
+        return os.path.join(self.path, 'drafts', f"{index:05d}.md")
+
+    def get_draft(self, image_path: str) -> Optional[str]:
+        """读取某张图片已完成的初稿，未完成时返回 None"""
+        return _read(self._draft_path(image_path))
+
+    def save_draft(self, image_path: str, draft: str):
+        """记录某张图片的初稿"""
+        _atomic_write(self._draft_path(image_path), draft)
+
+    def get_stage(self, stage: str) -> Optional[str]:
+        """读取 build / gen 阶段已完成的输出，未完成时返回 None"""
+        return _read(os.path.join(self.path, f"{stage}.md"))
+
+    def save_stage(self, stage: str, stage_input: str, output: str):
+        """记录 build / gen 阶段的输入与输出"""
+        _atomic_write(os.path.join(self.path, f"{stage}_input.md"), stage_input)
+        _atomic_write(os.path.join(self.path, f"{stage}.md"), output)
+
+    def set_status(self, status: str, **fields):
+        """更新运行状态，例如 written（笔记已写入）、done（图片已清理）"""
+        self.manifest["status"] = status
+        self.manifest.update(fields)
+        self._save_manifest()
@@ -0,0 +1,291 @@
+"""本地双链渲染模块
+
+用笔记库中所有笔记的文件名、别名（以及可选的唯一标题）构建 Aho-Corasick 自动机，
+对每篇笔记做一次线性扫描，把出现的名词替换为 [[链接]]：
+- 文件名: [[叶绿体]]
+- 别名: [[腺苷三磷酸|ATP]]
+- 标题: [[光合作用#光反应|光反应]]
+跳过 frontmatter、代码块（含 Mermaid）、公式、标题行、Callout 标题行、行内代码、已有链接、Markdown 链接和网址。
+同一位置有多个候选时取最靠左、最长的一个；默认每篇笔记中每个目标只链接第一次出现的位置。
+替代 Gen 阶段中主要用来补链接的那次模型调用，可以通过 skip_gen 跳过 Gen。
+"""
+
+import logging
+import os
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from . import notes
+except ImportError:  # 直接运行 utils 下的脚本时
+    import notes
+
+_FENCE_RE = re.compile(r'^\s*(```|~~~)')
+_HEADING_RE = re.compile(r'^\s{0,3}#{1,6}\s')
+_CALLOUT_RE = re.compile(r'^\s*(>\s*)+\[!')
+_PROTECTED_RE = re.compile(
+    r'`+[^`]*`+'                 # 行内代码
+    r'|!?\[\[[^\]]*\]\]'         # 已有链接与嵌入
+    r'|\[[^\]]*\]\([^)]*\)'      # Markdown 链接
+    r'|https?://\S+'             # 网址
+    r'|\$[^$\n]+\$'              # 行内公式
+    r'|<[^>\n]+>'                # HTML 标签
+)
+# 已有链接的目标笔记，以及 #标题 / ^块 部分（不含 | 之后的显示文字）
+_EXISTING_LINK_RE = re.compile(r'\[\[([^\]|#^]+)([#^][^\]|]*)?')
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isascii() and (ch.isalnum() or ch == '_')
+
+
+@dataclass
+class LinkerSettings:
+    """本地链接参数
+
+    Attributes:
+        enabled (bool): 写入笔记后是否运行本地链接
+        skip_gen (bool): 跳过 Gen 阶段的模型调用，直接写入 Build 的结果再本地链接
+        first_only (bool): 每篇笔记中每个目标只链接第一次出现的位置
+        headings (bool): 是否链接到其他笔记中唯一的标题（[[文件#标题]]）
+        min_length (int): 文件名、别名的最短字符数
+        min_heading_length (int): 标题的最短字符数
+    """
+    enabled: bool = True
+    skip_gen: bool = False
+    first_only: bool = True
+    headings: bool = True
+    min_length: int = 2
+    min_heading_length: int = 4
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "LinkerSettings":
+        conf = conf or {}
+        return cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+
+
+class Automaton:
+    """Aho-Corasick 多模式匹配自动机"""
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        # 每个状态结束的模式（含沿失败链继承的），存模式下标
+        self._out = [[]]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(index)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """产出所有匹配 (起点, 终点, 模式下标)"""
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for index in out[state]:
+                yield i + 1 - len(self.patterns[index]), i + 1, index
+
+
+class Linker:
+    """把文本中出现的笔记名替换为双链
+
+    Attributes:
+        targets (Dict[str, Tuple[str, str]]): {出现的文字: (目标笔记名, 链接内容)}
+    """
+    def __init__(self, targets: Dict[str, Tuple[str, str]], settings: Optional[LinkerSettings] = None):
+        self.settings = settings or LinkerSettings()
+        self.targets = targets
+        self._surfaces = list(targets)
+        self._automaton = Automaton(self._surfaces)
+
+    @classmethod
+    def from_index(cls, vault_index, settings: Optional[LinkerSettings] = None,
+                   extra_names: Iterable[str] = ()) -> "Linker":
+        """根据笔记库索引（以及本次输出的文件名）构建
+
+        文件名优先于别名，别名优先于标题；对应多篇笔记的别名和标题有歧义，不参与链接。
+        """
+        settings = settings or LinkerSettings()
+        titles, aliases, headings = {}, {}, {}
+        for entry in vault_index.notes.values():
+            titles[entry["title"]] = entry["title"]
+            for alias in entry["aliases"]:
+                aliases.setdefault(alias, set()).add(entry["title"])
+            if settings.headings:
+                for heading in entry["headings"]:
+                    headings.setdefault(heading, set()).add(entry["title"])
+        for name in extra_names:
+            key = notes.note_key(name)
+            titles.setdefault(key, key)
+
+        targets = {}
+        for heading, owners in headings.items():
+            if len(owners) == 1 and len(heading) >= settings.min_heading_length:
+                title = next(iter(owners))
+                targets[heading] = (title, f"{title}#{heading}|{heading}")
+        for alias, owners in aliases.items():
+            if len(owners) == 1:
+                title = next(iter(owners))
+                targets[alias] = (title, alias if alias == title else f"{title}|{alias}")
+            else:
+                targets.pop(alias, None)
+        for title in titles:
+            targets[title] = (title, title)
+        targets = {surface: target for surface, target in targets.items()
+                   if len(surface) >= settings.min_length and not any(c in surface for c in '[]|#\n')}
+        return cls(targets, settings)
+
+    def _select(self, text: str, blocked: set, linked: set) -> List[Tuple[int, int, str]]:
+        """选出最靠左、最长且互不重叠的匹配"""
+        candidates = []
+        for start, end, index in self._automaton.iter_matches(text):
+            surface = self._surfaces[index]
+            if _is_word_char(surface[0]) and start > 0 and _is_word_char(text[start - 1]):
+                continue
+            if _is_word_char(surface[-1]) and end < len(text) and _is_word_char(text[end]):
+                continue
+            candidates.append((start, -(end - start), surface))
+        candidates.sort()
+        chosen, last_end = [], 0
+        for start, neg_length, surface in candidates:
+            if start < last_end:
+                continue
+            title, body = self.targets[surface]
+            # 别名与文件名指向同一目标，标题链接单独计算
+            target = body.split('|')[0]
+            if title in blocked or (self.settings.first_only and target in linked):
+                continue
+            chosen.append((start, start - neg_length, surface))
+            last_end = start - neg_length
+            linked.add(target)
+        return chosen
+
+    def _link_segment(self, text: str, blocked: set, linked: set, in_table: bool) -> Tuple[str, int]:
+        matches = self._select(text, blocked, linked)
+        if not matches:
+            return text, 0
+        parts, pos = [], 0
+        for start, end, surface in matches:
+            body = self.targets[surface][1]
+            if in_table:
+                # 表格中的 | 需要转义
+                body = body.replace('|', '\\|')
+            parts.append(text[pos:start])
+            parts.append(f"[[{body}]]")
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts), len(matches)
+
+    def link(self, text: str, self_names: Iterable[str] = ()) -> Tuple[str, int]:
+        """为一篇笔记添加链接
+
+        Args:
+            text (str): 笔记内容
+            self_names (Iterable[str]): 笔记自身的名称（文件名、别名），不链接到自己
+
+        Returns:
+            Tuple[str, int]: (新内容, 新增的链接数)
+        """
+        blocked = {notes.note_key(name) for name in self_names}
+        blocked |= {self.targets[name][0] for name in self_names if name in self.targets}
+        # 已经链接过的目标不再重复链接；[[文件#标题]] 同时算作链接了文件本身和该标题
+        linked = set()
+        for target, anchor in _EXISTING_LINK_RE.findall(text):
+            target = target.rstrip('\\').strip()
+            linked.add(target)
+            if anchor:
+                linked.add(target + anchor.rstrip('\\').strip())
+        lines = text.split('\n')
+        added = 0
+        fence = None
+        in_math = False
+        in_frontmatter = bool(lines) and lines[0].strip() == '---'
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if in_frontmatter:
+                if i > 0 and stripped == '---':
+                    in_frontmatter = False
+                continue
+            match = _FENCE_RE.match(line)
+            if fence is not None:
+                if match and match.group(1) == fence:
+                    fence = None
+                continue
+            if match:
+                fence = match.group(1)
+                continue
+            if stripped == '$$':
+                in_math = not in_math
+                continue
+            if in_math or not stripped or _HEADING_RE.match(line) or _CALLOUT_RE.match(line):
+                continue
+            in_table = stripped.startswith('|')
+            pieces, pos = [], 0
+            for protected in _PROTECTED_RE.finditer(line):
+                segment, count = self._link_segment(line[pos:protected.start()], blocked, linked, in_table)
+                pieces.append(segment)
+                pieces.append(protected.group(0))
+                added += count
+                pos = protected.end()
+            segment, count = self._link_segment(line[pos:], blocked, linked, in_table)
+            pieces.append(segment)
+            added += count
+            lines[i] = ''.join(pieces)
+        return '\n'.join(lines), added
+
+
+def link_notes(vault_index, filenames: Iterable[str], settings: Optional[LinkerSettings] = None) -> int:
+    """对本次写入的笔记运行本地链接，链接目标包括整个笔记库
+
+    Args:
+        vault_index: utils.vault.VaultIndex，会先刷新以包含本次写入的笔记
+        filenames (Iterable[str]): 本次写入的笔记（相对笔记库的路径）
+        settings (Optional[LinkerSettings]): 链接参数
+
+    Returns:
+        int: 新增的链接总数
+    """
+    filenames = [filename for filename in dict.fromkeys(filenames) if notes.is_safe_filename(filename)]
+    if not filenames:
+        return 0
+    vault_index.refresh()
+    linker = Linker.from_index(vault_index, settings, filenames)
+    total = 0
+    for filename in filenames:
+        path = os.path.join(vault_index.vault_dir, filename)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except OSError as e:
+            logging.warning(f"本地链接时无法读取 {filename}: {e}")
+            continue
+        entry = vault_index.notes.get(filename.replace(os.sep, '/'), {})
+        linked_text, added = linker.link(text, [filename] + entry.get("aliases", []))
+        if added:
+            notes.save_note(filename, linked_text, vault_index.vault_dir)
+            total += added
+    logging.info(f"本地链接: {len(filenames)} 篇笔记，新增 {total} 个链接")
+    return total
@@ -0,0 +1,241 @@
+"""日志模块
+
+该模块统一配置程序的日志，由后台线程写入文件，每条日志带有运行编号、阶段和图片（run_id / stage / image）。
+主要功能包括：
+- 根 logger 只挂一个 QueueHandler，由 QueueListener 的后台线程写入文件
+- 按大小（max_mb / backups）或按时间（when）轮转日志文件，可选输出 JSON Lines
+- 通过 payload() 截断或摘要较长的提示词和回答
+配置见 logging 段；没有配置时写入 log/main.log。
+"""
+
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+
+current_dir = os.path.dirname(__file__)
+BASE_DIR = os.path.join(current_dir, '..')
+LOG_DIR = os.path.join(BASE_DIR, 'log')
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - [%(run_id)s|%(stage)s|%(image)s] %(message)s'
+# 每条日志都带有的结构化字段
+FIELDS = ("run_id", "stage", "image")
+PAYLOAD_MODES = ("truncate", "digest", "full")
+
+
+@dataclass
+class LogSettings:
+    """日志参数（配置 logging 段）
+
+    Attributes:
+        level (str): 日志级别
+        path (str): 日志文件路径，相对路径相对于程序目录，为空时使用 log/main.log
+        format (str): text 为原来的文本格式，json 为每行一个 JSON 对象
+        max_mb (float): 按大小轮转时单个文件的上限（MB），0 表示不按大小轮转
+        when (str): 按时间轮转的间隔（TimedRotatingFileHandler 的 when，如 "midnight"、"H"），设置后不再按大小轮转
+        backups (int): 保留的旧日志文件数
+        payload (str): 提示词和回答的记录方式：truncate / digest / full
+        payload_chars (int): truncate 时保留的字符数
+    """
+    level: str = "INFO"
+    path: str = ""
+    format: str = "text"
+    max_mb: float = 20.0
+    when: str = ""
+    backups: int = 5
+    payload: str = "truncate"
+    payload_chars: int = 200
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "LogSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        if settings.payload not in PAYLOAD_MODES:
+            logging.warning(f"未知的日志 payload 方式 {settings.payload}，使用 truncate")
+            settings.payload = "truncate"
+        settings.payload_chars = max(0, settings.payload_chars)
+        settings.backups = max(0, settings.backups)
+        return settings
+
+    @property
+    def file_path(self) -> str:
+        if not self.path:
+            return os.path.join(LOG_DIR, 'main.log')
+        return self.path if os.path.isabs(self.path) else os.path.join(BASE_DIR, self.path)
+
+
+# 当前线程（或协程）的结构化字段；线程池中的线程不会继承，需要用 bound() 传递
+_context = contextvars.ContextVar("log_context", default={})
+# 整个进程共用的字段（运行编号）
+_bound = {}
+
+
+def bind(**fields):
+    """设置进程内所有线程共用的字段，值为 None 时清除"""
+    for key, value in fields.items():
+        if value is None:
+            _bound.pop(key, None)
+        else:
+            _bound[key] = value
+
+
+@contextmanager
+def context(**fields):
+    """在当前线程（或协程）中临时设置字段，退出时恢复"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bound(func: Callable, **fields) -> Callable:
+    """把当前的字段（以及 fields）带到线程池或新线程中执行的函数上"""
+    captured = {**_context.get(), **fields}
+
+    def call(*args, **kwargs):
+        with context(**captured):
+            return func(*args, **kwargs)
+
+    return call
+
+
+def image_label(paths: Iterable[str], limit: int = 3) -> str:
+    """日志中 image 字段的值：图片文件名，多张图片时只列出前 limit 张"""
+    names = [os.path.basename(path) for path in paths]
+    label = ",".join(names[:limit])
+    if len(names) > limit:
+        label += f",+{len(names) - limit}"
+    return label
+
+
+class ContextFilter(logging.Filter):
+    """把 run_id / stage / image 写到每条日志上，在发出日志的线程中执行"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = {**_bound, **_context.get()}
+        for key in FIELDS:
+            if not hasattr(record, key):
+                setattr(record, key, fields.get(key) or "-")
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            **{key: getattr(record, key, "-") for key in FIELDS},
+            "message": record.getMessage(),
+        }
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """只在配置日志的进程中使用队列；fork 出的图片预处理进程中没有 QueueListener，直接写文件"""
+    def __init__(self, log_queue, fallback: logging.Handler):
+        super().__init__(log_queue)
+        self.pid = os.getpid()
+        self.fallback = fallback
+
+    def emit(self, record: logging.LogRecord):
+        if os.getpid() != self.pid:
+            self.fallback.handle(record)
+        else:
+            super().emit(record)
+
+
+_settings = LogSettings()
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def _file_handler(settings: LogSettings) -> logging.Handler:
+    path = settings.file_path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if settings.when:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=settings.when, backupCount=settings.backups,
+                                                            encoding='utf-8')
+    elif settings.max_mb > 0:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=int(settings.max_mb * 1024 * 1024),
+                                                       backupCount=settings.backups, encoding='utf-8')
+    else:
+        handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(JsonFormatter() if settings.format == "json" else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def setup(settings: Optional[LogSettings] = None) -> LogSettings:
+    """配置根 logger，替换之前的配置（包括 basicConfig 添加的处理器）
+
+    重复调用且参数相同时不做任何事；参数不同时先写完队列中已有的日志再切换到新的文件。
+    """
+    global _settings, _handler, _listener
+    settings = settings or LogSettings()
+    with _lock:
+        if _listener is not None and settings == _settings:
+            return _settings
+        _stop()
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+        file_handler = _file_handler(settings)
+        log_queue = queue.SimpleQueue()
+        _handler = _QueueHandler(log_queue, file_handler)
+        _handler.addFilter(ContextFilter())
+        root.addHandler(_handler)
+        root.setLevel(settings.level.upper())
+        _listener = logging.handlers.QueueListener(log_queue, file_handler)
+        _listener.start()
+        _settings = settings
+    return settings
+
+
+def configure(conf: Optional[dict]) -> LogSettings:
+    """按配置 logging 段重新配置日志"""
+    return setup(LogSettings.from_config(conf))
+
+
+def _stop():
+    global _handler, _listener
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _handler = _listener = None
+
+
+def shutdown():
+    """写完队列中剩余的日志并关闭日志文件，程序退出时自动调用"""
+    with _lock:
+        _stop()
+
+
+atexit.register(shutdown)
+
+
+def payload(text: Optional[str]) -> str:
+    """按配置记录一段提示词或回答：截断、摘要或全文"""
+    if text is None:
+        return ""
+    mode = _settings.payload
+    if mode == "full":
+        return text
+    if mode == "truncate" and len(text) <= _settings.payload_chars:
+        return text
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    if mode == "digest":
+        return f"<{len(text)} 字, sha256:{digest}>"
+    return f"{text[:_settings.payload_chars]}…<共 {len(text)} 字, sha256:{digest}>"
@@ -0,0 +1,418 @@
+"""调用指标模块
+
+记录每次 LLM 调用（LLM.chat / stream / ask 及其异步版本）的延迟和 token 数据：
+- 模型、角色、接口、请求字节数、图片数
+- 首 token 时间（含思考过程）、首个回答 token 时间、总耗时、排队等待时间
+- 思考过程与回答的字符数和 token 数（接口返回 usage 时使用真实值，否则估算）、重试次数
+- 输入中命中接口侧前缀缓存的 token 数（见 utils/prompts.py）
+每条记录追加到 JSONL 指标文件（默认 log/metrics.jsonl），可选同时写出 Prometheus textfile。
+每次运行结束时汇总各阶段耗时、各接口的 p50/p95 延迟和实际达到的并发数，
+用来判断运行慢在 Vision、Build 还是 Gen。
+启用 Vision 难度路由（utils/routing.py）时，每张图片的路由决定也写入 JSONL，汇总中按路线统计图片数和调用延迟。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+try:
+    from . import logs
+except ImportError:  # 直接运行 utils 下的脚本时
+    import logs
+
+current_dir = os.path.dirname(__file__)
+DEFAULT_METRICS_PATH = os.path.join(current_dir, '..', 'log', 'metrics.jsonl')
+
+
+@dataclass
+class MetricsSettings:
+    """指标参数
+
+    Attributes:
+        enabled (bool): 是否记录调用指标
+        path (str): JSONL 指标文件路径，为空时使用 log/metrics.jsonl
+        prometheus (str): Prometheus textfile 路径（node_exporter textfile collector），为空表示不写出
+        stream_usage (bool): 流式请求是否要求接口在最后返回 usage（stream_options.include_usage），
+            默认关闭：不支持 stream_options 的接口会拒绝请求
+    """
+    enabled: bool = True
+    path: str = ""
+    prometheus: str = ""
+    stream_usage: bool = False
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "MetricsSettings":
+        conf = conf or {}
+        return cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+
+    @property
+    def jsonl_path(self) -> str:
+        return self.path or DEFAULT_METRICS_PATH
+
+
+@dataclass
+class CallRecord:
+    """一次 LLM 调用的指标（多次重试合并为一条）
+
+    时间均为秒；ttft / ttfa 从最后一次尝试发出请求开始计时，duration 从第一次排队开始计时。
+
+    Attributes:
+        role (str): 调用方角色（vision / build / gen 等）
+        model (str): 模型名
+        base_url (str): 接口地址
+        request_bytes (int): 请求消息序列化后的字节数（含 base64 图片）
+        images (int): 请求中的图片数
+        started (float): 开始时间（Unix 时间戳）
+        sent (float): 最后一次尝试发出请求的时间（Unix 时间戳）
+        queued (float): 在限流器中等待的总时间
+        ttft (Optional[float]): 首个 token（思考过程或回答）的时间
+        ttfa (Optional[float]): 首个回答 token 的时间（思考过程之后）
+        duration (float): 总耗时
+        reasoning_chars (int): 思考过程字符数
+        answer_chars (int): 回答字符数
+        prompt_tokens (int): 输入 token 数
+        cached_tokens (int): 输入中命中接口侧前缀缓存的 token 数（接口在 usage 中返回时才有）
+        reasoning_tokens (int): 思考过程 token 数
+        answer_tokens (int): 回答 token 数
+        usage (bool): token 数是否来自接口返回的 usage（否则为估算）
+        retries (int): 重试次数（含故障转移）
+        failovers (int): 改用接口池中其他接口的次数（见 endpoints.EndpointPool）
+        hedged (bool): 是否发出过对冲请求（见 hedge.Race）
+        hedge_won (bool): 结果是否来自对冲请求
+        hedge_saved (float): 对冲请求胜出时按历史延迟估算节省的秒数
+        ok (bool): 是否成功
+        error (str): 失败时的异常类型
+        limit (str): 超出过的生成预算或超时（见 budget.BudgetExceeded，多次时为最后一次），没有时为空
+        degraded (bool): 是否因超出限制而使用了部分回答
+    """
+    role: str
+    model: str
+    base_url: str
+    request_bytes: int = 0
+    images: int = 0
+    started: float = 0.0
+    sent: float = 0.0
+    queued: float = 0.0
+    ttft: Optional[float] = None
+    ttfa: Optional[float] = None
+    duration: float = 0.0
+    reasoning_chars: int = 0
+    answer_chars: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    reasoning_tokens: int = 0
+    answer_tokens: int = 0
+    usage: bool = False
+    retries: int = 0
+    failovers: int = 0
+    hedged: bool = False
+    hedge_won: bool = False
+    hedge_saved: float = 0.0
+    ok: bool = True
+    error: str = ""
+    limit: str = ""
+    degraded: bool = False
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.role} {self.model}@{self.base_url}"
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩法计算分位数，q 取 0~100，结果保留到毫秒"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return round(ordered[int(rank) - 1], 3)
+
+
+def achieved_concurrency(records: List[CallRecord]) -> dict:
+    """根据调用的 [发出, 结束] 区间计算实际并发：峰值同时在途数和平均在途数"""
+    events = []
+    busy = 0.0
+    for rec in records:
+        end = rec.started + rec.duration
+        events.append((rec.sent, 1))
+        events.append((end, -1))
+        busy += max(0.0, end - rec.sent)
+    if not events:
+        return {"peak": 0, "mean": 0.0}
+    # 同一时刻先结束再开始，首尾相接的调用不算重叠
+    events.sort(key=lambda e: (e[0], e[1]))
+    peak = current = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    span = events[-1][0] - events[0][0]
+    return {"peak": peak, "mean": round(busy / span, 2) if span > 0 else float(peak)}
+
+
+class MetricsRecorder:
+    """线程安全的指标记录器：逐条写出调用记录，并在运行结束时汇总
+
+    Attributes:
+        settings (MetricsSettings): 指标参数
+        run_id (str): 当前运行编号，写入每条记录
+        calls (List[CallRecord]): 本次运行的调用记录
+        stages (Dict[str, float]): 本次运行各阶段的墙钟耗时（秒）
+    """
+    def __init__(self, settings: Optional[MetricsSettings] = None):
+        self.settings = settings or MetricsSettings()
+        self.run_id = ""
+        self.calls = []
+        self.stages = {}
+        self.routes = []
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def begin_run(self, run_id: str):
+        """开始一次新的运行，清空上一次运行的记录；之后的日志都带有这个运行编号"""
+        logs.bind(run_id=run_id)
+        with self._lock:
+            self.run_id = run_id
+            self.calls = []
+            self.stages = {}
+            self.routes = []
+            self._started = time.time()
+
+    def record(self, rec: CallRecord):
+        """记录一次调用并追加到 JSONL 文件"""
+        if not self.settings.enabled:
+            return
+        with self._lock:
+            self.calls.append(rec)
+            self._append({"type": "call", "run_id": self.run_id, **asdict(rec)})
+
+    def record_route(self, decision: dict):
+        """记录一张图片的难度路由决定（utils.routing.RouteDecision 的字段加上 role）"""
+        if not self.settings.enabled:
+            return
+        with self._lock:
+            self.routes.append(decision)
+            self._append({"type": "route", "run_id": self.run_id, **decision})
+
+    @contextmanager
+    def stage(self, name: str):
+        """统计一个阶段的墙钟耗时，同名阶段多次进入时累加；阶段内当前线程的日志以阶段名作为 stage 字段"""
+        start = time.perf_counter()
+        try:
+            with logs.context(stage=name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def _append(self, entry: dict):
+        path = self.settings.jsonl_path
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logging.error(f"写入指标文件失败 {path}: {e}")
+
+    def summary(self) -> dict:
+        """汇总本次运行：阶段耗时，以及每个接口的调用数、延迟分位数、token 数和实际并发"""
+        with self._lock:
+            calls = list(self.calls)
+            stages = dict(self.stages)
+            routes = list(self.routes)
+            wall = time.time() - self._started
+        groups = {}
+        for rec in calls:
+            groups.setdefault(rec.endpoint, []).append(rec)
+        endpoints = {}
+        for endpoint, records in groups.items():
+            durations = [rec.duration for rec in records if rec.ok]
+            ttfts = [rec.ttft for rec in records if rec.ttft is not None]
+            ttfas = [rec.ttfa for rec in records if rec.ttfa is not None]
+            first = min(rec.started for rec in records)
+            last = max(rec.started + rec.duration for rec in records)
+            endpoints[endpoint] = {
+                "role": records[0].role,
+                "model": records[0].model,
+                "base_url": records[0].base_url,
+                "calls": len(records),
+                "errors": sum(1 for rec in records if not rec.ok),
+                "retries": sum(rec.retries for rec in records),
+                "failovers": sum(rec.failovers for rec in records),
+                "hedged": sum(1 for rec in records if rec.hedged),
+                "limited": sum(1 for rec in records if rec.limit),
+                "degraded": sum(1 for rec in records if rec.degraded),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttfa_p50": percentile(ttfas, 50),
+                "ttfa_p95": percentile(ttfas, 95),
+                "queued": round(sum(rec.queued for rec in records), 3),
+                "active": round(last - first, 3),
+                "request_bytes": sum(rec.request_bytes for rec in records),
+                "images": sum(rec.images for rec in records),
+                "prompt_tokens": sum(rec.prompt_tokens for rec in records),
+                "cached_tokens": sum(rec.cached_tokens for rec in records),
+                "cache_ratio": _ratio(sum(rec.cached_tokens for rec in records),
+                                      sum(rec.prompt_tokens for rec in records if rec.usage)),
+                "reasoning_tokens": sum(rec.reasoning_tokens for rec in records),
+                "answer_tokens": sum(rec.answer_tokens for rec in records),
+                "concurrency": achieved_concurrency(records),
+            }
+        summary = {"run_id": self.run_id, "wall": round(wall, 3),
+                   "stages": {name: round(seconds, 3) for name, seconds in stages.items()},
+                   "endpoints": endpoints}
+        if routes:
+            summary["routes"] = _route_summary(routes, calls)
+        hedges = _hedge_summary(calls)
+        if hedges:
+            summary["hedges"] = hedges
+        return summary
+
+    def report(self) -> Optional[dict]:
+        """汇总本次运行并写入日志、JSONL 文件和（可选的）Prometheus textfile"""
+        if not self.settings.enabled:
+            return None
+        summary = self.summary()
+        for name, seconds in summary["stages"].items():
+            logging.info(f"阶段耗时 {name}: {seconds:.1f} 秒")
+        for endpoint, stats in summary["endpoints"].items():
+            p50, p95 = stats["p50"], stats["p95"]
+            logging.info(f"调用统计 {endpoint}: {stats['calls']} 次（失败 {stats['errors']}，重试 {stats['retries']}），"
+                         f"延迟 p50 {_fmt(p50)} / p95 {_fmt(p95)}，首个回答 token p50 {_fmt(stats['ttfa_p50'])}，"
+                         f"并发 峰值 {stats['concurrency']['peak']} / 平均 {stats['concurrency']['mean']}"
+                         + (f"，超出限制 {stats['limited']} 次（降级 {stats['degraded']}）" if stats['limited'] else "")
+                         + (f"，故障转移 {stats['failovers']} 次" if stats['failovers'] else "")
+                         + (f"，前缀缓存命中 {stats['cached_tokens']} / {stats['prompt_tokens']} 输入 token"
+                            f"（{stats['cache_ratio']:.0%}）" if stats['cached_tokens'] else ""))
+        for route, stats in summary.get("routes", {}).items():
+            logging.info(f"难度路由 {route}: {stats['images']} 张图片（{stats['role']}），平均分数 {stats['score_mean']}，"
+                         f"{stats['calls']} 次调用，延迟 p50 {_fmt(stats['p50'])} / p95 {_fmt(stats['p95'])}，"
+                         f"首个回答 token p50 {_fmt(stats['ttfa_p50'])}")
+        for role, stats in summary.get("hedges", {}).items():
+            logging.info(f"对冲请求 {role}: {stats['calls']} 次调用中对冲 {stats['hedged']} 次（{stats['ratio']:.1%}），"
+                         f"对冲胜出 {stats['wins']} 次，估算节省 {stats['saved']:.1f} 秒")
+        with self._lock:
+            self._append({"type": "summary", **summary})
+        if self.settings.prometheus:
+            write_prometheus(self.settings.prometheus, summary)
+        return summary
+
+
+def _route_summary(routes: List[dict], calls: List[CallRecord]) -> dict:
+    """按路线统计图片数、分数和对应角色的调用延迟，用来比较两条路线的耗时"""
+    result = {}
+    for decision in routes:
+        stats = result.setdefault(decision["route"], {"role": decision["role"], "images": 0, "scores": []})
+        stats["images"] += 1
+        if decision.get("score") is not None:
+            stats["scores"].append(decision["score"])
+    for stats in result.values():
+        records = [rec for rec in calls if rec.role == stats["role"]]
+        durations = [rec.duration for rec in records if rec.ok]
+        ttfas = [rec.ttfa for rec in records if rec.ttfa is not None]
+        scores = stats.pop("scores")
+        stats.update({
+            "score_mean": round(sum(scores) / len(scores), 3) if scores else None,
+            "calls": len(records),
+            "p50": percentile(durations, 50),
+            "p95": percentile(durations, 95),
+            "ttfa_p50": percentile(ttfas, 50),
+            "duration": round(sum(durations), 3),
+        })
+    return result
+
+
+def _hedge_summary(calls: List[CallRecord]) -> dict:
+    """按角色统计对冲：调用数、对冲数、对冲比例、对冲胜出数和估算节省的秒数"""
+    result = {}
+    for rec in calls:
+        if rec.hedged:
+            stats = result.setdefault(rec.role, {"hedged": 0, "wins": 0, "saved": 0.0})
+            stats["hedged"] += 1
+            stats["wins"] += int(rec.hedge_won)
+            stats["saved"] += rec.hedge_saved
+    for role, stats in result.items():
+        calls_count = sum(1 for rec in calls if rec.role == role)
+        stats.update({"calls": calls_count, "ratio": round(stats["hedged"] / calls_count, 4),
+                      "saved": round(stats["saved"], 3)})
+    return result
+
+
+def _ratio(part: int, total: int) -> Optional[float]:
+    return round(part / total, 4) if total else None
+
+
+def _fmt(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds:.2f}s"
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def write_prometheus(path: str, summary: dict):
+    """把运行汇总写成 Prometheus textfile 格式，先写临时文件再替换，避免采集到写了一半的文件"""
+    lines = [
+        "# HELP aibionote_stage_seconds Wall time of each pipeline stage in the last run",
+        "# TYPE aibionote_stage_seconds gauge",
+    ]
+    for name, seconds in summary["stages"].items():
+        lines.append(f'aibionote_stage_seconds{{stage="{_label(name)}"}} {seconds}')
+
+    def labels(stats, **extra):
+        pairs = {"role": stats["role"], "model": stats["model"], "base_url": stats["base_url"], **extra}
+        return ",".join(f'{key}="{_label(value)}"' for key, value in pairs.items())
+
+    # 数值只对应最近一次运行，下次运行会变小，因此都是 gauge
+    gauges = (
+        ("calls", "LLM calls in the last run"),
+        ("errors", "Failed LLM calls in the last run"),
+        ("retries", "LLM call retries in the last run"),
+        ("failovers", "LLM calls moved to another endpoint of the pool in the last run"),
+        ("hedged", "LLM calls that sent a hedged duplicate request in the last run"),
+        ("prompt_tokens", "Prompt tokens in the last run"),
+        ("cached_tokens", "Prompt tokens served from the provider prefix cache in the last run"),
+        ("reasoning_tokens", "Reasoning tokens in the last run"),
+        ("answer_tokens", "Answer tokens in the last run"),
+    )
+    for name, help_text in gauges:
+        lines.append(f"# HELP aibionote_llm_{name} {help_text}")
+        lines.append(f"# TYPE aibionote_llm_{name} gauge")
+        for stats in summary["endpoints"].values():
+            lines.append(f'aibionote_llm_{name}{{{labels(stats)}}} {stats[name]}')
+    lines.append("# HELP aibionote_llm_latency_seconds LLM call latency quantiles in the last run")
+    lines.append("# TYPE aibionote_llm_latency_seconds gauge")
+    for stats in summary["endpoints"].values():
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+            if stats[key] is not None:
+                lines.append(f'aibionote_llm_latency_seconds{{{labels(stats, quantile=quantile)}}} {stats[key]}')
+    lines.append("# HELP aibionote_llm_peak_concurrency Peak in-flight LLM calls in the last run")
+    lines.append("# TYPE aibionote_llm_peak_concurrency gauge")
+    for stats in summary["endpoints"].values():
+        lines.append(f'aibionote_llm_peak_concurrency{{{labels(stats)}}} {stats["concurrency"]["peak"]}')
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"写入 Prometheus 指标失败 {path}: {e}")
+
+
+_recorder = MetricsRecorder()
+
+
+def configure(conf: Optional[dict]) -> MetricsRecorder:
+    """根据配置中的 metrics 段设置全局记录器"""
+    _recorder.settings = MetricsSettings.from_config(conf)
+    return _recorder
+
+
+def get_recorder() -> MetricsRecorder:
+    return _recorder
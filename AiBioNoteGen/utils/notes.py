@@ -0,0 +1,263 @@
+"""笔记文本工具模块
+
+处理模型输出中约定的多文件格式：
+FILENAME: 文件1.md
+...内容...
+###-###-END-OF-FILE-###-###
+并提供单篇笔记的保存，以及按主题（共享文件名）分组、按token预算打包草稿的工具。
+"""
+
+import logging
+import os
+from typing import Callable, Iterator, List, Optional, Tuple
+
+try:
+    from . import notewriter
+except ImportError:  # 直接运行 utils 下的脚本时
+    import notewriter
+
+FILE_SEPARATOR = "###-###-END-OF-FILE-###-###"
+FILENAME_PREFIX = "FILENAME:"
+# LLM.format_chinese_response 添加的装饰性边框字符
+_BORDER_CHAR = "━"
+
+
+def _is_border(line: str) -> bool:
+    line = line.strip()
+    return bool(line) and set(line) == {_BORDER_CHAR}
+
+
+class FileBlockParser:
+    """多文件格式的增量解析器
+
+    逐段喂入模型的流式输出，跨分段识别 FILENAME: 标题行和文件分隔符，
+    每个文件一结束就回调 on_file，不需要等待整个回答生成完毕。
+    只缓存当前未完成的一行和当前文件的内容，占用的内存以单个文件为上限。
+    缺少分隔符时，下一个 FILENAME: 标题行同样视为上一个文件的结束。
+
+    Attributes:
+        files (int): 已回调的文件数
+    """
+    def __init__(self, on_file: Callable[[str, str], None], on_invalid: Optional[Callable[[str], None]] = None):
+        """
+        Args:
+            on_file: 每解析出一个完整文件时调用，参数为 (文件名, 内容)
+            on_invalid: 遇到没有 FILENAME: 标题的文本块时调用，参数为该文本块
+        """
+        self.on_file = on_file
+        self.on_invalid = on_invalid
+        self.files = 0
+        self._partial = []
+        self._filename = None
+        self._lines = []
+
+    def feed(self, chunk: str):
+        """喂入一段流式输出"""
+        if '\n' not in chunk:
+            self._partial.append(chunk)
+            return
+        pieces = chunk.split('\n')
+        self._partial.append(pieces[0])
+        self._line(''.join(self._partial))
+        for line in pieces[1:-1]:
+            self._line(line)
+        self._partial = [pieces[-1]]
+
+    def close(self):
+        """输入结束，处理剩余内容（最后一个文件可能没有分隔符）"""
+        if self._partial:
+            self._line(''.join(self._partial))
+            self._partial = []
+        self._finish()
+
+    def _line(self, line: str):
+        while FILE_SEPARATOR in line:
+            before, line = line.split(FILE_SEPARATOR, 1)
+            if before.strip():
+                self._lines.append(before)
+            self._finish()
+        stripped = line.strip()
+        if stripped.startswith(FILENAME_PREFIX):
+            self._finish()
+            self._filename = stripped[len(FILENAME_PREFIX):].strip()
+            return
+        if not self._lines and not stripped:
+            return
+        self._lines.append(line)
+
+    def _finish(self):
+        lines = self._lines
+        while lines and (_is_border(lines[-1]) or not lines[-1].strip()):
+            lines.pop()
+        while lines and _is_border(lines[0]):
+            lines.pop(0)
+        content = '\n'.join(lines).strip()
+        filename = self._filename
+        self._filename, self._lines = None, []
+        if filename is not None:
+            self.files += 1
+            self.on_file(filename, content)
+        elif content and self.on_invalid is not None:
+            self.on_invalid(content)
+
+
+def iter_file_blocks(text: str) -> Iterator[Tuple[Optional[str], str]]:
+    """按分隔符拆分多文件文本
+
+    Args:
+        text (str): 模型输出
+
+    Yields:
+        Tuple[Optional[str], str]: (文件名, 内容)；格式不正确的块文件名为 None，内容为整个块
+    """
+    blocks = []
+    parser = FileBlockParser(lambda filename, content: blocks.append((filename, content)),
+                             lambda content: blocks.append((None, content)))
+    parser.feed(text)
+    parser.close()
+    yield from blocks
+
+
+def format_file_block(filename: str, content: str) -> str:
+    """把单个文件格式化为约定的多文件格式"""
+    return f"{FILENAME_PREFIX} {filename}\n{content}\n{FILE_SEPARATOR}"
+
+
+def join_file_blocks(blocks: List[Tuple[str, str]]) -> str:
+    """把若干 (文件名, 内容) 拼接为约定的多文件格式"""
+    return "\n".join(format_file_block(filename, content) for filename, content in blocks)
+
+
+def is_safe_filename(filename: str) -> bool:
+    """文件名非空，且不是绝对路径、不包含 .."""
+    return bool(filename) and '..' not in filename and not os.path.isabs(filename)
+
+
+def save_note(filename: str, content: str, output_dir: str) -> bool:
+    """保存单篇笔记（原子替换，内容没有变化时不写入，见 utils/notewriter.py）
+
+    Returns:
+        bool: 是否保存成功，内容没有变化也算成功
+    """
+    if not is_safe_filename(filename):
+        logging.error(f"检测到不安全或无效的文件名，已跳过: {filename}")
+        return False
+
+    return notewriter.get_writer().write(os.path.join(output_dir, filename), content) != notewriter.FAILED
+
+
+def note_key(filename: str) -> str:
+    """用于比较的笔记名：去掉目录和 .md 扩展名"""
+    name = os.path.basename(filename.strip())
+    if name.lower().endswith('.md'):
+        name = name[:-3]
+    return name.strip()
+
+
+def draft_topics(draft: str) -> set:
+    """提取草稿中出现的所有笔记名"""
+    topics = set()
+    for line in draft.split('\n'):
+        line = line.strip()
+        if line.startswith(FILENAME_PREFIX):
+            key = note_key(line[len(FILENAME_PREFIX):])
+            if key:
+                topics.add(key)
+    return topics
+
+
+def group_by_topic(drafts: List[str]) -> List[List[int]]:
+    """把含有相同笔记名的草稿归为一组（传递闭包）
+
+    Returns:
+        List[List[int]]: 每组草稿的下标，组和组内均按原顺序排列
+    """
+    parent = list(range(len(drafts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner = {}
+    for i, draft in enumerate(drafts):
+        for topic in draft_topics(draft):
+            if topic in owner:
+                ri, rj = find(i), find(owner[topic])
+                if ri != rj:
+                    parent[max(ri, rj)] = min(ri, rj)
+            else:
+                owner[topic] = i
+
+    groups = {}
+    for i in range(len(drafts)):
+        groups.setdefault(find(i), []).append(i)
+    return sorted(groups.values(), key=lambda g: g[0])
+
+
+def pack_batches(drafts: List[str], budget: int, estimate: Callable[[str], int]) -> List[List[str]]:
+    """按主题分组后，把草稿依次打包为不超过token预算的批次
+
+    同一主题的草稿尽量放在同一批次；单个主题超出预算时按顺序拆开，
+    单份草稿超出预算时单独成批。
+
+    Args:
+        drafts (List[str]): 草稿列表
+        budget (int): 每批次的token预算
+        estimate (Callable[[str], int]): token估算函数
+
+    Returns:
+        List[List[str]]: 批次列表
+    """
+    batches = []
+    current, current_tokens = [], 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            batches.append(current)
+        current, current_tokens = [], 0
+
+    for group in group_by_topic(drafts):
+        sizes = [estimate(drafts[i]) for i in group]
+        group_tokens = sum(sizes)
+        if current_tokens + group_tokens <= budget:
+            current.extend(drafts[i] for i in group)
+            current_tokens += group_tokens
+            continue
+        flush()
+        for i, size in zip(group, sizes):
+            if current and current_tokens + size > budget:
+                flush()
+            current.append(drafts[i])
+            current_tokens += size
+    flush()
+    return batches
+
+
+def settle_merge(key: str, versions: List[Tuple[str, str]], merged: Optional[Tuple[str, str]],
+                 existing: Optional[Tuple[str, str]] = None) -> Tuple[str, str]:
+    """确定同名文件合并后的最终版本
+
+    Args:
+        key (str): 笔记名
+        versions (List[Tuple[str, str]]): 参与合并的全部版本
+        merged (Optional[Tuple[str, str]]): 模型合并的结果，失败时为 None
+        existing (Optional[Tuple[str, str]]): 笔记库中已有的版本，其路径总是保留
+        各版本和合并结果都必须是模型的原始回答（LLM.chat(raw=True)），结果会直接写入笔记库
+
+    Returns:
+        Tuple[str, str]: (文件名, 内容)
+    """
+    if existing is not None:
+        if merged is not None:
+            return existing[0], merged[1]
+        # 不能丢失已有笔记的内容：把新内容追加在后面
+        logging.warning(f"已有笔记 {key} 合并失败，把新内容追加到原文之后")
+        additions = [content for filename, content in versions if (filename, content) != existing]
+        return existing[0], "\n\n".join([existing[1].rstrip()] + additions)
+    if merged is not None:
+        return merged
+    logging.warning(f"同名文件 {key} 合并失败，保留最长的版本")
+    return max(versions, key=lambda item: len(item[1]))
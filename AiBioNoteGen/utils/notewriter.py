@@ -0,0 +1,257 @@
+"""笔记写入模块
+
+该模块提供线程安全的笔记写入器，只写入内容有变化的笔记，并以原子替换的方式写入。
+主要功能包括：
+- 按 sha256 比较内容，摘要记录在清单 index/notes.json 中，内容相同的笔记不写入
+- 先写入同目录下的临时文件，fsync 后用 os.replace 替换目标文件
+- 由 sync() 统一 fsync 本批写入涉及的目录并保存清单
+- 按新建 / 更新 / 未变化统计写入次数
+"""
+
+import atexit
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+current_dir = os.path.dirname(__file__)
+DEFAULT_MANIFEST_PATH = os.path.join(current_dir, '..', 'index', 'notes.json')
+CREATED = "created"
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+# 临时文件与目标文件权限一致：按进程的 umask 计算（模块导入时读取，避免在多线程中修改 umask）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@dataclass
+class WriterSettings:
+    """笔记写入参数（配置 writer 段）
+
+    Attributes:
+        manifest (bool): 是否使用清单记录已写入笔记的摘要，关闭时每次都读取现有文件比较
+        manifest_path (str): 清单路径，为空时使用 index/notes.json
+        fsync (bool): 是否在替换前 fsync 文件、在 sync() 时 fsync 目录
+        workers (int): 并发写入的线程数
+        parallel_threshold (int): 一次写入的笔记数达到该值时并发写入
+    """
+    manifest: bool = True
+    manifest_path: str = ""
+    fsync: bool = True
+    workers: int = 4
+    parallel_threshold: int = 8
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "WriterSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        settings.workers = max(1, settings.workers)
+        return settings
+
+
+def encode_note(content: str) -> bytes:
+    """笔记写入磁盘的字节：与原来以文本模式写入相同，换行符按平台转换"""
+    if os.linesep != '\n':
+        content = content.replace('\n', os.linesep)
+    return content.encode('utf-8')
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class NoteWriter:
+    """线程安全的笔记写入器，所有输出目录共用一个清单
+
+    Attributes:
+        settings (WriterSettings): 写入参数
+        counts (Dict[str, int]): 上次 reset_counts 以来新建 / 更新 / 未变化 / 失败的笔记数
+    """
+    def __init__(self, settings: Optional[WriterSettings] = None):
+        self.settings = settings or WriterSettings()
+        self.counts = {CREATED: 0, UPDATED: 0, UNCHANGED: 0, FAILED: 0}
+        self._manifest = None
+        self._manifest_dirty = False
+        self._dirty_dirs = set()
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self) -> str:
+        return self.settings.manifest_path or DEFAULT_MANIFEST_PATH
+
+    def _entries(self) -> Dict[str, dict]:
+        """清单内容 {笔记绝对路径: {"sha256", "size", "mtime_ns"}}，第一次使用时读取，调用方持有锁"""
+        if self._manifest is None:
+            self._manifest = {}
+            if self.settings.manifest and os.path.exists(self.manifest_path):
+                try:
+                    with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                        self._manifest = json.load(f).get("notes", {})
+                except (OSError, ValueError, AttributeError) as e:
+                    logging.warning(f"读取笔记清单失败，将按文件内容比较: {e}")
+        return self._manifest
+
+    def _existing_digest(self, path: str, size: int) -> Tuple[bool, Optional[str]]:
+        """现有文件的状态：(是否存在, 摘要)；大小与新内容不同时不读取文件，摘要为 None"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False, None
+        if self.settings.manifest:
+            with self._lock:
+                entry = self._entries().get(path)
+            if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+                return True, entry.get("sha256")
+        if stat.st_size != size:
+            return True, None
+        with open(path, 'rb') as f:
+            return True, _digest(f.read())
+
+    def _remember(self, path: str, digest: str):
+        if not self.settings.manifest:
+            return
+        stat = os.stat(path)
+        entry = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        with self._lock:
+            entries = self._entries()
+            if entries.get(path) != entry:
+                entries[path] = entry
+                self._manifest_dirty = True
+
+    def _replace(self, path: str, data: bytes):
+        """写入同目录下的临时文件，fsync 后原子替换目标文件"""
+        directory = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                if self.settings.fsync:
+                    os.fsync(f.fileno())
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o666 & ~_UMASK
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._dirty_dirs.add(directory)
+
+    def write(self, path: str, content: str) -> str:
+        """写入一篇笔记，内容没有变化时不写入
+
+        Returns:
+            str: created / updated / unchanged / failed
+        """
+        path = os.path.abspath(path)
+        data = encode_note(content)
+        digest = _digest(data)
+        try:
+            exists, existing = self._existing_digest(path, len(data))
+            if existing == digest:
+                status = UNCHANGED
+                self._remember(path, digest)
+            else:
+                self._replace(path, data)
+                self._remember(path, digest)
+                status = UPDATED if exists else CREATED
+        except Exception as e:
+            logging.error(f"写入笔记 {path} 时发生错误: {e}")
+            status = FAILED
+        with self._lock:
+            self.counts[status] += 1
+        if status == UNCHANGED:
+            logging.info(f"笔记内容没有变化，跳过写入: {path}")
+        elif status != FAILED:
+            logging.info(f"成功{'创建' if status == CREATED else '更新'}文件: {path}")
+        return status
+
+    def write_many(self, items: Iterable[Tuple[str, str]]) -> List[str]:
+        """写入多篇笔记 [(路径, 内容)]，数量达到 parallel_threshold 时并发写入，返回各篇的状态"""
+        items = list(items)
+        if len(items) < max(2, self.settings.parallel_threshold) or self.settings.workers < 2:
+            return [self.write(path, content) for path, content in items]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.settings.workers, len(items)),
+                                                   thread_name_prefix="note-writer") as executor:
+            return list(executor.map(lambda item: self.write(*item), items))
+
+    def sync(self):
+        """fsync 本批写入涉及的目录（使替换持久化），并保存清单"""
+        with self._lock:
+            directories, self._dirty_dirs = self._dirty_dirs, set()
+            manifest = dict(self._manifest) if self._manifest_dirty else None
+            self._manifest_dirty = False
+        if self.settings.fsync:
+            for directory in directories:
+                _fsync_dir(directory)
+        if manifest is not None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+                path = os.path.abspath(self.manifest_path)
+                self._replace(path, json.dumps({"notes": manifest}, ensure_ascii=False).encode('utf-8'))
+                with self._lock:
+                    self._dirty_dirs.discard(os.path.dirname(path))
+            except OSError as e:
+                logging.error(f"保存笔记清单失败: {e}")
+
+    def reset_counts(self) -> Dict[str, int]:
+        """返回并清零写入统计"""
+        with self._lock:
+            counts = dict(self.counts)
+            for key in self.counts:
+                self.counts[key] = 0
+        return counts
+
+
+def _fsync_dir(directory: str):
+    # Windows 不能打开目录做 fsync，os.replace 本身已经足够
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError as e:
+        logging.warning(f"无法打开目录 {directory} 进行 fsync: {e}")
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logging.warning(f"目录 {directory} fsync 失败: {e}")
+    finally:
+        os.close(fd)
+
+
+def summarize(counts: Dict[str, int]) -> str:
+    text = f"新建 {counts[CREATED]} 篇，更新 {counts[UPDATED]} 篇，未变化 {counts[UNCHANGED]} 篇"
+    if counts[FAILED]:
+        text += f"，失败 {counts[FAILED]} 篇"
+    return text
+
+
+_writer = NoteWriter()
+
+
+def configure(conf: Optional[dict]) -> NoteWriter:
+    """根据配置中的 writer 段设置全局写入器"""
+    global _writer
+    _writer.sync()
+    _writer = NoteWriter(WriterSettings.from_config(conf))
+    return _writer
+
+
+def get_writer() -> NoteWriter:
+    return _writer
+
+
+atexit.register(lambda: _writer.sync())
@@ -0,0 +1,388 @@
+"""asyncio 流水线引擎
+
+三个阶段各自有独立的并发上限（信号量），阶段之间通过 asyncio.Queue 传递结果，没有全局屏障：
+- Vision: 每批图片一个协程（默认一张一批，可合并同一目录下相邻的多张图片），完成后把初稿放入队列；
+  启用难度路由时先在进程池中为图片打分，以文字为主的图片交给 vision_fast 模型
+- Build: 队列中积累的初稿达到 token 预算就立即启动一个批次，不等待最慢的图片
+- Gen: 每个 Build 批次完成后，其中的笔记立即逐篇渲染并写入（skip_gen 时不调用模型，直接写入）
+多个批次产生同名笔记时，先渲染先到的版本，所有批次结束后合并同名版本并重新渲染覆盖。
+笔记库中已有的同名笔记作为一个版本参与合并，这些笔记在所有批次结束、合并之后才渲染。
+所有请求都在一个线程的事件循环中完成，不需要为每个并发请求占用一个系统线程。
+各阶段的 Prompt 由 utils/prompts.py 预编译，主模板位于所有 Agent 共用的系统提示中。
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+
+from . import Ai
+from . import cache as result_cache
+from . import image
+from . import logs
+from . import notes
+from . import prompts as stage_prompts
+from . import routing
+from . import vault
+
+BUILD_SLOT = stage_prompts.DRAFT_SLOT
+MERGE_SLOT = stage_prompts.MERGE_SLOT
+GEN_SLOT = stage_prompts.GEN_SLOT
+
+
+class AsyncPipeline:
+    """Vision → Build → Gen 的异步流水线
+
+    Attributes:
+        saved_files (set): 写入过的笔记文件名
+        failed_notes (int): Gen 渲染失败、退回 Build 版本的笔记数
+    """
+    def __init__(self, agents: Dict[str, Ai.AsyncLLM], prompts: stage_prompts.PromptSet, output_dir: str,
+                 cache: Optional[result_cache.ResponseCache] = None, journal=None,
+                 limits: Optional[Dict[str, int]] = None, batch_tokens: int = 24000,
+                 image_settings: Optional[image.ImageSettings] = None, image_pool=None,
+                 batch_settings: Optional[image.BatchSettings] = None,
+                 vault_index: Optional[vault.VaultIndex] = None, skip_gen: bool = False,
+                 routing_settings: Optional[routing.RoutingSettings] = None):
+        """
+        Args:
+            agents: {"vision", "build", "gen"} 三个阶段使用的 AsyncLLM，merge 使用 build 的模型；
+                启用难度路由时还有 "vision_fast"
+            prompts: 预编译的各阶段 Prompt，Agent 的系统提示应为 prompts.system
+            output_dir: 笔记输出目录
+            cache: 结果缓存
+            journal: 运行记录（utils.journal.RunJournal）
+            limits: 各阶段的并发上限 {"vision", "build", "gen"}
+            batch_tokens: 每个 Build 批次的 token 预算，0 表示所有初稿完成后一次调用
+            image_settings: 图片预处理参数
+            image_pool: 执行图片预处理的进程池，为 None 时在默认线程池中执行
+            batch_settings: 多图合并请求参数，默认每次请求一张图片
+            vault_index: 笔记库索引（已刷新），为 None 时不参考已有笔记
+            skip_gen: 不调用 Gen 模型，直接写入 Build 的结果（链接交给 utils/linker.py）
+            routing_settings: Vision 难度路由参数，为 None 或未启用时所有图片使用 vision 模型
+        """
+        limits = limits or {}
+        self.agents = agents
+        self.prompts = prompts
+        self.output_dir = output_dir
+        self.cache = cache
+        self.journal = journal
+        self.batch_tokens = batch_tokens
+        self.image_settings = image_settings or image.ImageSettings(enabled=False)
+        self.image_pool = image_pool
+        self.batch_settings = batch_settings or image.BatchSettings()
+        self.vault_index = vault_index
+        self.skip_gen = skip_gen
+        self.routing_settings = routing_settings or routing.RoutingSettings()
+        self._existing = {}
+        self.semaphores = {stage: asyncio.Semaphore(limits.get(stage, 4)) for stage in ("vision", "build", "gen")}
+        self.saved_files = set()
+        self.failed_notes = 0
+        self._versions = {}
+        self._rendered = {}
+        self._gen_tasks = []
+
+    async def _cached(self, stage: str, key: str, call, lookup: bool = True):
+        if self.cache is not None and lookup:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logging.info(f"阶段 {stage} 命中缓存，跳过模型调用。")
+                return cached
+        answer = await call()
+        if self.cache is not None and answer:
+            self.cache.put(key, answer, stage=stage)
+        return answer
+
+    # --- Vision ---
+    async def _prepare(self, image_path: str) -> image.PreparedImage:
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(self.image_pool, image.prepare_image, image_path, self.image_settings)
+        image.log_saving(prepared)
+        return prepared
+
+    async def _vision_key(self, image_paths: List[str], agent: Ai.AsyncLLM) -> str:
+        digests = [await asyncio.to_thread(result_cache.file_digest, path) for path in image_paths]
+        return result_cache.make_key("vision", result_cache.RAW_ANSWER, *digests, agent.model_name, agent.system_prompt,
+                                     image.batch_prompt(self.prompts.render("vision"), len(image_paths)),
+                                     self.image_settings.cache_tag())
+
+    async def _vision_single(self, image_path: str, agent: Ai.AsyncLLM,
+                             prepared: Optional[image.PreparedImage] = None) -> Optional[str]:
+        image_name = os.path.basename(image_path)
+        logging.info(f"[async] 开始生成初稿: {image_name}")
+        try:
+            async def call():
+                item = prepared or await self._prepare(image_path)
+                # 初稿在 Build 和 Gen 都失败时会直接写入笔记，使用未格式化的回答
+                return await agent.chat(self.prompts.render("vision"), [item.data_url], raw=True)
+
+            draft = await self._cached("vision", await self._vision_key([image_path], agent), call)
+        except Exception as e:
+            logging.error(f"[async] 生成初稿失败 for {image_name}: {e}")
+            return None
+        if not draft or not draft.strip():
+            logging.error(f"[async] 生成初稿失败 for {image_name}")
+            return None
+        logging.info(f"[async] 成功为 {image_name} 生成初稿。")
+        return draft
+
+    async def _vision_batch(self, batch: List[str], agent: Ai.AsyncLLM) -> Dict[str, str]:
+        """为一批图片生成初稿
+
+        一次请求的初稿记在其中第一张图片上，其余图片记为空字符串；
+        预处理后按体积和 token 上限再拆分，某次请求失败时逐张退回单图请求，仍然失败的图片不出现在结果中。
+        """
+        results = {}
+
+        async def single(image_path, prepared=None):
+            with logs.context(image=logs.image_label([image_path])):
+                draft = await self._vision_single(image_path, agent, prepared)
+            if draft is not None:
+                results[image_path] = draft
+
+        def record(paths, draft):
+            results[paths[0]] = draft
+            results.update((path, "") for path in paths[1:])
+
+        if len(batch) == 1:
+            await single(batch[0])
+            return results
+
+        names = "、".join(os.path.basename(path) for path in batch)
+        logging.info(f"[async] 开始为 {len(batch)} 张图片生成合并初稿: {names}")
+        try:
+            batch_key = await self._vision_key(batch, agent)
+            cached = self.cache.get(batch_key) if self.cache is not None else None
+            if cached is not None:
+                logging.info("阶段 vision 命中缓存，跳过模型调用。")
+                record(batch, cached)
+                return results
+            prepared_list = await asyncio.gather(*(self._prepare(path) for path in batch))
+        except Exception as e:
+            logging.error(f"[async] 合并请求准备失败，逐张生成初稿: {e}")
+            for path in batch:
+                await single(path)
+            return results
+
+        for group in image.split_batch(prepared_list, self.batch_settings):
+            paths = [prepared.path for prepared in group]
+            if len(group) == 1:
+                await single(paths[0], group[0])
+                continue
+
+            async def call(group=group):
+                return await agent.chat(image.batch_prompt(self.prompts.render("vision"), len(group)),
+                                        [prepared.data_url for prepared in group], raw=True)
+
+            try:
+                # 整批的缓存在预处理前已经查过
+                key = batch_key if paths == batch else await self._vision_key(paths, agent)
+                draft = await self._cached("vision", key, call, lookup=paths != batch)
+            except Exception as e:
+                logging.error(f"[async] 合并请求异常: {e}")
+                draft = None
+            if draft and draft.strip():
+                logging.info(f"[async] 成功为 {len(group)} 张图片生成合并初稿。")
+                record(paths, draft)
+                continue
+            logging.warning(f"[async] {len(group)} 张图片的合并请求失败，逐张重新生成初稿")
+            for prepared in group:
+                await single(prepared.path, prepared)
+        return results
+
+    async def _vision(self, batch: List[str], queue: asyncio.Queue, agent: Ai.AsyncLLM):
+        results = {}
+        try:
+            with logs.context(image=logs.image_label(batch)):
+                async with self.semaphores["vision"]:
+                    results = await self._vision_batch(batch, agent)
+        except Exception as e:
+            logging.error(f"[async] 生成初稿失败 for {[os.path.basename(path) for path in batch]}: {e}")
+        for image_path in batch:
+            draft = results.get(image_path)
+            if draft is not None and self.journal is not None:
+                # 每张图片都必须放入一项，_run_vision_and_build 按图片数等待；写入失败只影响续跑
+                try:
+                    self.journal.save_draft(image_path, draft)
+                except Exception as e:
+                    logging.error(f"[async] 保存初稿到运行记录失败 {os.path.basename(image_path)}: {e}")
+            await queue.put((image_path, draft))
+
+    # --- Build ---
+    async def _build(self, batch: List[str]):
+        text = "\n".join(batch)
+        agent = self.agents["build"]
+        values = {BUILD_SLOT: text}
+        if self.vault_index is not None:
+            values[vault.CONTEXT_SLOT] = self.vault_index.context([text], Ai.estimate_tokens)
+        prompt = self.prompts.render("build", values)
+        cache_key = result_cache.make_key("build", result_cache.RAW_ANSWER, agent.model_name, agent.system_prompt,
+                                          prompt)
+        async with self.semaphores["build"]:
+            output = await self._cached("build", cache_key, lambda: agent.chat(prompt, raw=True))
+        if not output:
+            logging.error(f"Build 批次（{len(batch)} 份初稿）失败，使用原始草稿")
+            output = text
+        self._accept_notes(output)
+
+    def _accept_notes(self, build_output: str, merge_existing: bool = True):
+        """登记一个 Build 批次产出的笔记，首次出现的笔记立即开始渲染
+
+        merge_existing 为 False 时不再与笔记库中的已有笔记合并（运行记录中的 Build 结果已经合并过）。
+        """
+        for filename, content in notes.iter_file_blocks(build_output):
+            if filename is None:
+                continue
+            key = notes.note_key(filename)
+            if merge_existing and key not in self._versions and self.vault_index is not None:
+                existing = self.vault_index.existing_block(key)
+                if existing is not None:
+                    logging.info(f"笔记 {key} 已存在于笔记库中，将与已有内容合并")
+                    self._existing[key] = existing
+                    self._versions[key] = [existing]
+            versions = self._versions.setdefault(key, [])
+            versions.append((filename, content))
+            if len(versions) == 1:
+                self._gen_tasks.append(asyncio.create_task(self._gen(key, (filename, content))))
+
+    async def _merge(self, keys: List[str]):
+        agent = self.agents["build"]
+        units = [notes.join_file_blocks(self._versions[key]) for key in keys]
+        batches = notes.pack_batches(units, self.batch_tokens, Ai.estimate_tokens) if self.batch_tokens else [units]
+
+        async def merge(batch):
+            prompt = self.prompts.render("merge", {MERGE_SLOT: "\n".join(batch)})
+            cache_key = result_cache.make_key("merge", result_cache.RAW_ANSWER, agent.model_name,
+                                              agent.system_prompt, prompt)
+            async with self.semaphores["build"]:
+                # 合并结果会写回笔记库中的已有笔记，必须使用未格式化的回答
+                return await self._cached("merge", cache_key, lambda: agent.chat(prompt, raw=True))
+
+        merged = {}
+        for output in await asyncio.gather(*(merge(batch) for batch in batches)):
+            for filename, content in notes.iter_file_blocks(output or ""):
+                if filename is not None:
+                    merged[notes.note_key(filename)] = (filename, content)
+        for key in keys:
+            self._versions[key] = [notes.settle_merge(key, self._versions[key], merged.get(key), self._existing.get(key))]
+
+    # --- Gen ---
+    async def _gen(self, key: str, block):
+        if self.skip_gen:
+            if notes.save_note(*block, self.output_dir):
+                self.saved_files.add(block[0])
+            self._rendered[key] = notes.format_file_block(*block)
+            return
+        agent = self.agents["gen"]
+        names = "、".join(self._versions)
+        unit = notes.format_file_block(*block) + f"\n\n（本批次的全部文件：{names}）"
+        if self.vault_index is not None:
+            existing_names = self.vault_index.related_names([block[1]], exclude=[block[0]])
+            if existing_names:
+                unit += f"\n（可以链接的已有笔记：{'、'.join(existing_names)}）"
+        prompt = self.prompts.render("gen", {GEN_SLOT: unit})
+        saved = 0
+
+        def on_file(filename, content):
+            nonlocal saved
+            if notes.save_note(filename, content, self.output_dir):
+                saved += 1
+                self.saved_files.add(filename)
+
+        async with self.semaphores["gen"]:
+            cache_key = result_cache.make_key("gen", agent.model_name, agent.system_prompt, prompt)
+            cached = self.cache.get(cache_key) if self.cache is not None else None
+            if cached is not None:
+                output = cached
+                for filename, content in notes.iter_file_blocks(cached):
+                    if filename is not None:
+                        on_file(filename, content)
+            else:
+                parser = notes.FileBlockParser(on_file)
+                # 缓存和运行记录都不需要时不保留完整回答，内存占用以单篇笔记为上限
+                keep = self.cache is not None or self.journal is not None
+                output = await agent.stream(prompt, parser.feed, keep_answer=keep)
+                parser.close()
+                if self.cache is not None and output and saved:
+                    self.cache.put(cache_key, output, stage="gen")
+
+        if output is None or not saved:
+            logging.error(f"笔记 {block[0]} 渲染失败，使用 Build 阶段的版本")
+            self.failed_notes += 1
+            output = notes.format_file_block(*block)
+            if notes.save_note(*block, self.output_dir):
+                self.saved_files.add(block[0])
+        self._rendered[key] = output
+
+    # --- 流程 ---
+    async def run(self, image_paths: List[str], drafts: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+        """运行整条流水线
+
+        Args:
+            image_paths: 本次运行的全部图片
+            drafts: 已有的初稿（来自运行记录），没有的为 None
+
+        Returns:
+            Dict[str, Optional[str]]: 每张图片最终的初稿，失败的为 None，合并请求中除第一张以外的图片为空字符串
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        refined = self.journal.get_stage("build") if self.journal is not None else None
+        if refined is not None:
+            logging.info("--- Build: 使用运行记录中已完成的结果 ---")
+            self._accept_notes(refined, merge_existing=False)
+        else:
+            drafts = await self._run_vision_and_build(image_paths, drafts)
+
+        if self._gen_tasks:
+            await asyncio.gather(*self._gen_tasks)
+        duplicates = [key for key, versions in self._versions.items() if len(versions) > 1]
+        if duplicates:
+            logging.info(f"合并 {len(duplicates)} 个同名文件并重新渲染")
+            await self._merge(duplicates)
+            await asyncio.gather(*(self._gen(key, self._versions[key][0]) for key in duplicates))
+
+        if self.journal is not None and self._versions:
+            final_blocks = [versions[0] for versions in self._versions.values()]
+            if refined is None:
+                self.journal.save_stage("build", "\n".join(d for d in drafts.values() if d),
+                                        notes.join_file_blocks(final_blocks))
+            if not self.failed_notes:
+                self.journal.save_stage("gen", notes.join_file_blocks(final_blocks),
+                                        "\n".join(self._rendered[key] for key in self._versions))
+        return drafts
+
+    async def _run_vision_and_build(self, image_paths, drafts):
+        drafts = dict(drafts)
+        queue = asyncio.Queue()
+        pending = [img_path for img_path in image_paths if drafts.get(img_path) is None]
+        for img_path in image_paths:
+            if drafts.get(img_path) is not None:
+                queue.put_nowait((img_path, drafts[img_path]))
+        routes = {}
+        if self.routing_settings.enabled and "vision_fast" in self.agents:
+            routes = await asyncio.to_thread(routing.route_images, pending, self.routing_settings, self.image_pool)
+        vision_agents = {routing.DEEP: self.agents["vision"], routing.FAST: self.agents.get("vision_fast")}
+        # 合并请求只在同一条路线内分组
+        batches = [(route, batch) for route, paths in routing.split_routes(pending, routes).items()
+                   for batch in image.plan_batches(paths, self.batch_settings.max_images)]
+        logging.info(f"--- Vision: {len(pending)} 张图片需要生成初稿，共 {len(batches)} 批 ---")
+        vision_tasks = [asyncio.create_task(self._vision(batch, queue, vision_agents[route])) for route, batch in batches]
+
+        build_tasks = []
+        waiting, waiting_tokens = [], 0
+        for _ in range(len(image_paths)):
+            img_path, draft = await queue.get()
+            drafts[img_path] = draft
+            if not draft:
+                continue
+            waiting.append(draft)
+            waiting_tokens += Ai.estimate_tokens(draft)
+            if self.batch_tokens and waiting_tokens >= self.batch_tokens:
+                for batch in notes.pack_batches(waiting, self.batch_tokens, Ai.estimate_tokens):
+                    build_tasks.append(asyncio.create_task(self._build(batch)))
+                waiting, waiting_tokens = [], 0
+        if waiting:
+            build_tasks.append(asyncio.create_task(self._build(waiting)))
+        await asyncio.gather(*vision_tasks)
+        await asyncio.gather(*build_tasks)
+        return drafts
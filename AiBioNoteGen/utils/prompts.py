@@ -0,0 +1,93 @@
+"""Prompt 组装模块
+
+该模块在启动时预编译各阶段的包装 Prompt（vision.txt / build.txt / merge.txt / gen.txt），使请求开头的前缀保持不变，便于接口侧的前缀缓存命中。
+主要功能包括：
+- 主模板 master_prompt.txt 放进所有阶段共用、逐字节相同的系统提示中
+- 阶段模板去掉【主模板】一节，拆成固定文本和占位符片段，固定的任务说明在前
+- 草稿、已有笔记等可变内容填入占位符，位于用户消息的末尾，填入的内容不会被再次替换
+"""
+
+import hashlib
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+# 各阶段模板中的占位符
+MASTER_SLOT = "[此处由程序粘贴 master_prompt.txt 的全部内容]"
+DRAFT_SLOT = "[此处由程序粘贴 Vision 阶段生成的草稿]"
+MERGE_SLOT = "[此处由程序粘贴 需要合并的同名文件]"
+GEN_SLOT = "[此处由程序粘贴 Build 阶段生成的草稿]"
+SYSTEM_ROLE = "你是一位知识库架构师大师"
+STAGES = ("vision", "build", "merge", "gen")
+
+_SLOT_PATTERN = re.compile(r"\[此处由程序粘贴 [^\]\n]+\]")
+# 阶段模板中主模板一节的分隔线
+_SECTION_RULE = "\n---\n"
+
+
+@dataclass(frozen=True)
+class StagePrompt:
+    """预编译的阶段模板
+
+    Attributes:
+        stage (str): 阶段名
+        parts (Tuple[str, ...]): 固定文本与占位符交替排列，偶数下标为固定文本，奇数下标为占位符
+    """
+    stage: str
+    parts: Tuple[str, ...]
+
+    @classmethod
+    def compile(cls, stage: str, template: str) -> "StagePrompt":
+        """去掉模板中的【主模板】一节（连同它前面的分隔线），其余部分拆成片段"""
+        index = template.find(MASTER_SLOT)
+        if index >= 0:
+            start = template.rfind(_SECTION_RULE, 0, index)
+            start = index if start < 0 else start
+            template = template[:start] + template[index + len(MASTER_SLOT):]
+        template = template.strip()
+        parts = []
+        last = 0
+        for match in _SLOT_PATTERN.finditer(template):
+            parts.append(template[last:match.start()])
+            parts.append(match.group(0))
+            last = match.end()
+        parts.append(template[last:])
+        return cls(stage, tuple(parts))
+
+    @property
+    def slots(self) -> Tuple[str, ...]:
+        return self.parts[1::2]
+
+    def render(self, values: Optional[Dict[str, str]] = None) -> str:
+        """填入占位符，没有提供的占位符替换为空字符串"""
+        values = values or {}
+        return "".join(part if i % 2 == 0 else values.get(part, "") for i, part in enumerate(self.parts))
+
+
+class PromptSet:
+    """所有阶段共用的系统提示和预编译的阶段模板
+
+    Attributes:
+        system (str): 系统提示（角色说明 + 主模板），所有阶段、所有请求逐字节相同
+        digest (str): 系统提示的摘要，参与结果缓存的键，主模板变化时缓存随之失效
+    """
+    def __init__(self, system: str, stages: Dict[str, StagePrompt]):
+        self.system = system
+        self.stages = stages
+        self.digest = hashlib.sha256(system.encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def compile(cls, templates: Dict[str, str]) -> "PromptSet":
+        """
+        Args:
+            templates: main.load_settings 读取的模板 {"master", "vision", "build", "merge", "gen"}
+        """
+        system = f"{SYSTEM_ROLE}\n\n---\n# 【主模板】\n\n{templates['master'].strip()}\n"
+        stages = {stage: StagePrompt.compile(stage, templates[stage]) for stage in STAGES if stage in templates}
+        return cls(system, stages)
+
+    def __getitem__(self, stage: str) -> StagePrompt:
+        return self.stages[stage]
+
+    def render(self, stage: str, values: Optional[Dict[str, str]] = None) -> str:
+        return self.stages[stage].render(values)
@@ -0,0 +1,299 @@
+"""接口限流与重试模块
+
+每个接口 (base_url, api_key) 共享一个 EndpointLimiter：
+- 两个令牌桶分别限制每分钟请求数 (rpm) 和每分钟 token 数 (tpm)
+- 并发上限按 AIMD 自适应：遇到限流 (429) 时减半，之后每次成功缓慢回升
+- RetryPolicy 提供带抖动的指数退避，并优先遵循服务端返回的 Retry-After
+同步线程和 asyncio 协程都可以使用。
+"""
+
+import asyncio
+import collections
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+# 估算 tpm 时每张图片按固定 token 数计算
+IMAGE_TOKEN_ESTIMATE = 1000
+
+
+class TokenBucket:
+    """线程安全的令牌桶
+
+    Attributes:
+        rate (float): 每秒补充的令牌数
+        capacity (float): 桶容量（允许的突发量）
+    """
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """预留令牌，返回需要等待的秒数（0 表示立即可用）
+
+        超过容量的请求按容量计算，避免单个大请求永远无法通过。
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class AdaptiveConcurrency:
+    """AIMD 自适应并发上限
+
+    限流时上限减半（乘性减），每次成功上限增加 1/上限（加性增，约每一轮增加 1），
+    上限不会超过 max_limit，也不会低于 1。
+    同步调用方在条件变量上等待；异步调用方各自等待一个 future，有空位时按先后顺序唤醒，
+    不轮询，也不会一次唤醒所有等待者。
+    """
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self._waiters.append(waiter)
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self._cond:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    elif waiter[1].done() and not waiter[1].cancelled():
+                        # 已被唤醒却取消了，把空位让给下一个等待者
+                        self._wake()
+                raise
+
+    def _wake(self):
+        """唤醒与空位数量相同的异步等待者，调用方持有锁"""
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            loop, future = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._resume, future)
+            except RuntimeError:  # 事件循环已关闭
+                continue
+            free -= 1
+
+    def _resume(self, future: "asyncio.Future"):
+        if not future.done():
+            future.set_result(None)
+        else:
+            # 等待者在唤醒前被取消，空位交给下一个
+            with self._cond:
+                self._wake()
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            self._wake()
+
+    def on_success(self):
+        with self._cond:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self._cond.notify_all()
+                self._wake()
+
+    def on_throttle(self):
+        with self._cond:
+            old = int(self.limit)
+            self.limit = max(1.0, self.limit / 2)
+            if int(self.limit) != old:
+                logging.warning(f"触发限流，并发上限 {old} -> {int(self.limit)}")
+
+
+class RetryPolicy:
+    """带抖动的指数退避
+
+    Attributes:
+        max_retries (int): 最大重试次数
+        base_delay (float): 第一次重试的基础等待秒数
+        max_delay (float): 单次等待上限
+    """
+    def __init__(self, max_retries: int = 3, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """第 attempt 次重试（从 0 开始）前的等待秒数"""
+        if retry_after is not None:
+            return min(self.max_delay, retry_after + random.uniform(0, self.base_delay))
+        backoff = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # full jitter
+        return random.uniform(0, backoff)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """从异常携带的响应头中读取 Retry-After（秒）"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_throttle(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def is_retryable(error: Exception) -> bool:
+    """限流、超时、连接错误和 5xx 可以重试，其余（如 400/401）直接失败"""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status == 408 or status >= 500
+    name = type(error).__name__
+    return name in ("APIConnectionError", "APITimeoutError") or isinstance(error, (ConnectionError, TimeoutError))
+
+
+class EndpointLimiter:
+    """单个接口的限流器：rpm / tpm 令牌桶 + AIMD 并发 + 重试策略"""
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None, max_concurrency: int = 10,
+                 retry: Optional[RetryPolicy] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.retry = retry or RetryPolicy()
+        self.throttled = 0
+        self.retries = 0
+
+    @classmethod
+    def from_config(cls, conf: Optional[dict], max_concurrency: int = 10) -> "EndpointLimiter":
+        """根据角色配置中的 rate_limit 段创建
+
+        Args:
+            conf (Optional[dict]): {"rpm", "tpm", "max_concurrency", "max_retries", "base_delay", "max_delay"}，均可省略
+            max_concurrency (int): 配置中没有 max_concurrency 时使用的并发上限
+        """
+        conf = conf or {}
+        retry = RetryPolicy(conf.get("max_retries", 3), conf.get("base_delay", 1.0), conf.get("max_delay", 60.0))
+        return cls(conf.get("rpm"), conf.get("tpm"), conf.get("max_concurrency", max_concurrency), retry)
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def acquire(self, tokens: int):
+        """同步获取一次请求的配额（可能阻塞）"""
+        wait = self._wait_time(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        self.concurrency.acquire()
+
+    async def acquire_async(self, tokens: int):
+        """异步获取一次请求的配额"""
+        wait = self._wait_time(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.concurrency.acquire_async()
+
+    def release(self, error: Optional[Exception] = None):
+        """释放并发配额，并按结果调整并发上限"""
+        self.concurrency.release()
+        if error is None:
+            self.concurrency.on_success()
+        elif is_throttle(error):
+            self.throttled += 1
+            self.concurrency.on_throttle()
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency_limit": int(self.concurrency.limit),
+            "throttled": self.throttled,
+            "retries": self.retries,
+        }
+
+
+_limiters = {}
+# 创建各限流器时使用的 rate_limit 段，用来提示后来的角色配置不同的情况
+_limiter_confs = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(base_url: str, api_key: str, conf: Optional[dict] = None, max_concurrency: int = 10) -> EndpointLimiter:
+    """获取（必要时创建）某个接口共享的限流器
+
+    限流器按 (base_url, api_key) 共享，配置只在第一次创建时生效：共用同一个密钥的角色（如 vision / review / formatting）
+    使用第一个创建的角色的 rate_limit 段，其他角色写了不同的 rate_limit 段时记录一条警告。
+    """
+    key = (base_url, api_key)
+    conf = conf or {}
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = EndpointLimiter.from_config(conf, max_concurrency)
+            _limiter_confs[key] = conf
+        elif conf and _limiter_confs.get(key) is not None and _limiter_confs[key] != conf:
+            logging.warning(f"接口 {base_url} 的同一个密钥已经按 rate_limit {_limiter_confs[key]} 创建了限流器，"
+                            f"忽略另一个角色的 rate_limit {conf}（限流按密钥生效，而不是按角色）")
+            # 每个接口只提示一次
+            _limiter_confs[key] = None
+        return limiter
+
+
+def limiter_stats() -> dict:
+    """所有接口的限流统计 {base_url: {"concurrency_limit", "throttled", "retries"}}
+
+    同一 base_url 的多个密钥会合并统计，并发上限取最小值。
+    """
+    with _limiters_lock:
+        items = list(_limiters.items())
+    result = {}
+    for (base_url, _), limiter in items:
+        snap = limiter.snapshot()
+        total = result.get(base_url)
+        if total is None:
+            result[base_url] = snap
+            continue
+        total["throttled"] += snap["throttled"]
+        total["retries"] += snap["retries"]
+        total["concurrency_limit"] = min(total["concurrency_limit"], snap["concurrency_limit"])
+    return result
@@ -0,0 +1,212 @@
+"""Vision 难度路由模块
+
+conf["vision"] 通常是较慢的推理模型（如 qvq-max），纯文字的页面交给更快、更便宜的视觉模型一样能处理好。
+这里在上传之前用几个廉价的本地特征（只用 CPU）给每张图片打一个"图表程度"分数：
+- 边缘密度: 梯度幅值超过阈值的像素比例，插图、照片、显微图的边缘更多
+- 色彩熵: 量化颜色直方图的熵（归一化到 0~1），纯文字页面基本只有纸色和墨色
+- 文本行规整度: 墨迹按行投影后的自相关峰值，整页文字的行距是周期性的
+分数 = 各项加权平均（规整度取 1 - 规整度），不低于 threshold 的图片走 deep（conf["vision"]），
+其余走 fast（配置中 fast 指定的段）。每张图片的特征和去向写入日志和指标文件，
+两条路线的延迟见运行汇总中 vision / vision-fast 两个角色的统计，用来调整阈值和权重。
+解码缩略图交给进程池并行执行。依赖 Pillow 和 NumPy；任一未安装时所有图片都走 deep。
+"""
+
+import concurrent.futures
+import logging
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow / NumPy 为可选依赖
+    np = None
+    Image = None
+    ImageOps = None
+
+try:
+    from . import metrics
+except ImportError:  # 直接运行 utils 下的脚本时
+    import metrics
+
+FAST = "fast"
+DEEP = "deep"
+# 两条路线的 Agent 在调用指标中使用的角色名
+ROLES = {FAST: "vision-fast", DEEP: "vision"}
+# 视为边缘的梯度幅值（0~255 灰度，水平与垂直差分的绝对值之和）
+_EDGE_STEP = 48
+# 边缘密度达到该值时边缘项记满分
+_EDGE_FULL = 0.2
+# 颜色量化的位数（每个通道），直方图共 2 ** (3 * _COLOR_BITS) 个桶
+_COLOR_BITS = 3
+# 文本行周期的下限（缩略图像素）
+_MIN_LINE_PERIOD = 4
+
+
+@dataclass
+class RoutingSettings:
+    """难度路由参数
+
+    Attributes:
+        enabled (bool): 是否启用路由（未安装 Pillow 或 NumPy 时自动关闭）
+        fast (str): 快速视觉模型所在的配置段，接口、模型、限流和 limits 的写法与 vision 段相同
+        threshold (float): 分数不低于该值的图片走 deep
+        edge (int): 计算特征的缩略图长边（像素）
+        edge_weight (float): 边缘密度的权重
+        color_weight (float): 色彩熵的权重
+        text_weight (float): 文本行不规整程度（1 - 规整度）的权重
+        workers (int): 解码图片的进程数，0 表示由系统决定（未传入进程池时使用）
+    """
+    enabled: bool = False
+    fast: str = "vision_fast"
+    threshold: float = 0.5
+    edge: int = 384
+    edge_weight: float = 0.2
+    color_weight: float = 0.4
+    text_weight: float = 0.4
+    workers: int = 0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "RoutingSettings":
+        conf = conf or {}
+        settings = cls(**{k: v for k, v in conf.items() if k in cls.__dataclass_fields__})
+        if settings.enabled and np is None:
+            logging.warning("未安装 Pillow 或 NumPy，跳过 Vision 难度路由，所有图片使用 vision 模型")
+            settings.enabled = False
+        if settings.edge_weight + settings.color_weight + settings.text_weight <= 0:
+            logging.warning("难度路由的权重之和必须大于 0，改用默认权重")
+            settings.edge_weight, settings.color_weight, settings.text_weight = 0.2, 0.4, 0.4
+        return settings
+
+    def score(self, edge_density: float, color_entropy: float, text_regularity: float) -> float:
+        """按权重合成 0~1 的图表程度分数"""
+        total = self.edge_weight + self.color_weight + self.text_weight
+        value = (self.edge_weight * min(1.0, edge_density / _EDGE_FULL)
+                 + self.color_weight * color_entropy
+                 + self.text_weight * (1.0 - text_regularity))
+        return value / total
+
+
+@dataclass
+class RouteDecision:
+    """一张图片的路由结果
+
+    Attributes:
+        image (str): 图片文件名
+        route (str): fast / deep
+        score (Optional[float]): 图表程度分数，无法读取图片时为 None（走 deep）
+        edge_density (float): 边缘密度
+        color_entropy (float): 归一化的色彩熵
+        text_regularity (float): 文本行规整度
+    """
+    image: str
+    route: str
+    score: Optional[float] = None
+    edge_density: float = 0.0
+    color_entropy: float = 0.0
+    text_regularity: float = 0.0
+
+
+def load_features(path: str, edge: int) -> Optional[tuple]:
+    """解码一张图片的缩略图，返回 (边缘密度, 色彩熵, 文本行规整度)，无法读取时返回 None
+
+    JPEG 使用 draft 模式按比例解码，不需要解出全尺寸图片。该函数只依赖参数，可以在子进程中执行。
+    """
+    try:
+        with Image.open(path) as img:
+            img.draft('RGB', (edge, edge))
+            rgb = ImageOps.exif_transpose(img).convert('RGB')
+            rgb.thumbnail((edge, edge), Image.BILINEAR)
+            pixels = np.asarray(rgb, dtype=np.uint8)
+    # 损坏的图片抛出 OSError，EXIF 或颜色模式异常抛出 ValueError，超大图片抛出 DecompressionBombError
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning(f"无法读取图片，使用 vision 模型 {path}: {e}")
+        return None
+    gray = pixels.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return _edge_density(gray), _color_entropy(pixels), _text_regularity(gray)
+
+
+def _edge_density(gray) -> float:
+    if gray.shape[0] < 2 or gray.shape[1] < 2:
+        return 0.0
+    magnitude = np.abs(np.diff(gray, axis=1))[:-1, :] + np.abs(np.diff(gray, axis=0))[:, :-1]
+    return float((magnitude > _EDGE_STEP).mean())
+
+
+def _color_entropy(pixels) -> float:
+    shift = 8 - _COLOR_BITS
+    quantized = pixels >> shift
+    codes = ((quantized[..., 0].astype(np.int32) << (2 * _COLOR_BITS))
+             | (quantized[..., 1].astype(np.int32) << _COLOR_BITS) | quantized[..., 2])
+    counts = np.bincount(codes.ravel(), minlength=1 << (3 * _COLOR_BITS))
+    probs = counts[counts > 0] / codes.size
+    return float(-(probs * np.log2(probs)).sum() / (3 * _COLOR_BITS))
+
+
+def _text_regularity(gray) -> float:
+    """墨迹按行投影后的自相关峰值：行距固定的整页文字接近 1，插图或空白页接近 0
+
+    只在自相关第一次降到 0 以下之后找峰值，大块插图的投影很平滑，小间隔上的自相关也很高，但没有周期。
+    """
+    height = gray.shape[0]
+    if height < _MIN_LINE_PERIOD * 4:
+        return 0.0
+    ink = gray < gray.mean() - 0.5 * gray.std()
+    profile = ink.mean(axis=1)
+    centered = profile - profile.mean()
+    energy = float((centered * centered).sum())
+    if energy <= 0:
+        return 0.0
+    autocorr = np.correlate(centered, centered, 'full')[height - 1:height // 4 + height] / energy
+    negative = np.nonzero(autocorr < 0)[0]
+    if not len(negative) or negative[0] >= len(autocorr) - 1:
+        return 0.0
+    peak = float(autocorr[max(negative[0], _MIN_LINE_PERIOD):].max())
+    return max(0.0, min(1.0, peak))
+
+
+def route_images(paths: List[str], settings: RoutingSettings, pool=None) -> Dict[str, str]:
+    """为每张图片选择 fast 或 deep，并把决定写入日志和指标文件
+
+    Args:
+        paths (List[str]): 图片路径
+        settings (RoutingSettings): 路由参数
+        pool: 解码图片使用的进程池，为 None 时临时创建
+
+    Returns:
+        Dict[str, str]: {图片路径: fast / deep}，未启用路由时为空（调用方全部按 deep 处理）
+    """
+    if not settings.enabled or not paths:
+        return {}
+    if pool is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=settings.workers or None) as own_pool:
+            return route_images(paths, settings, own_pool)
+
+    features = list(pool.map(load_features, paths, [settings.edge] * len(paths), chunksize=16))
+    recorder = metrics.get_recorder()
+    routes = {}
+    for path, item in zip(paths, features):
+        name = os.path.basename(path)
+        if item is None:
+            decision = RouteDecision(name, DEEP)
+        else:
+            edge_density, color_entropy, text_regularity = item
+            score = settings.score(edge_density, color_entropy, text_regularity)
+            decision = RouteDecision(name, DEEP if score >= settings.threshold else FAST, round(score, 4),
+                                     round(edge_density, 4), round(color_entropy, 4), round(text_regularity, 4))
+            logging.info(f"难度路由 {name} -> {decision.route}: 分数 {score:.3f}（边缘密度 {edge_density:.3f}，"
+                         f"色彩熵 {color_entropy:.3f}，文本行规整度 {text_regularity:.3f}）")
+        routes[path] = decision.route
+        recorder.record_route({**asdict(decision), "role": ROLES[decision.route]})
+    fast = sum(1 for route in routes.values() if route == FAST)
+    logging.info(f"难度路由: {fast} 张图片使用快速模型，{len(routes) - fast} 张使用 vision 模型（阈值 {settings.threshold}）")
+    return routes
+
+
+def split_routes(paths: List[str], routes: Dict[str, str]) -> Dict[str, List[str]]:
+    """按路由结果拆分图片，保持原有顺序；没有路由结果的图片归入 deep"""
+    groups = {FAST: [], DEEP: []}
+    for path in paths:
+        groups[routes.get(path, DEEP)].append(path)
+    return groups
@@ -0,0 +1,280 @@
+"""笔记库索引模块
+
+为输出目录（Obsidian 笔记库）维护一份本地索引，记录每篇笔记的文件名、标题、别名和出链 [[链接]]：
+- 索引保存在 index/vault.json，每次运行按修改时间和大小增量更新，内容哈希不变的文件不重新解析
+- Build 阶段只收到与当前草稿相关的已有笔记的名称、别名和标题，Prompt 大小取决于新材料而不是笔记库大小
+- 与已有笔记同名的新笔记会和已有内容合并，而不是直接覆盖
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import notes
+
+current_dir = os.path.dirname(__file__)
+DEFAULT_INDEX_PATH = os.path.join(current_dir, '..', 'index', 'vault.json')
+# Build Prompt 中粘贴相关已有笔记的位置
+CONTEXT_SLOT = "[此处由程序粘贴 知识库中已有的相关笔记]"
+INDEX_VERSION = 1
+
+_LINK_RE = re.compile(r'\[\[([^\]|#]+)(?:#[^\]|]*)?(?:\|[^\]]*)?\]\]')
+_HEADING_RE = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+# 每篇笔记在 Build 上下文中最多列出的标题数
+_MAX_HEADINGS = 20
+
+
+def _name_key(name: str) -> str:
+    return notes.note_key(name).casefold()
+
+
+def _parse_aliases(frontmatter: str) -> List[str]:
+    """从 YAML frontmatter 中读取 aliases / alias，支持行内列表、单个值和块列表"""
+    aliases = []
+    lines = frontmatter.split('\n')
+    for i, line in enumerate(lines):
+        match = re.match(r'^(aliases|alias)\s*:\s*(.*)$', line.strip())
+        if not match:
+            continue
+        value = match.group(2).strip()
+        if value.startswith('['):
+            aliases.extend(item.strip().strip('"\'') for item in value.strip('[]').split(','))
+        elif value:
+            aliases.append(value.strip('"\''))
+        else:
+            for item in lines[i + 1:]:
+                item = item.strip()
+                if not item.startswith('-'):
+                    break
+                aliases.append(item[1:].strip().strip('"\''))
+    return [alias for alias in aliases if alias]
+
+
+def parse_note(text: str) -> dict:
+    """解析一篇笔记的别名、标题和出链"""
+    aliases = []
+    body = text
+    if text.startswith('---\n'):
+        end = text.find('\n---', 4)
+        if end != -1:
+            aliases = _parse_aliases(text[4:end])
+            body = text[end + 4:]
+    headings = []
+    in_code = False
+    for line in body.split('\n'):
+        if line.lstrip().startswith('```'):
+            in_code = not in_code
+            continue
+        if in_code:
+            continue
+        match = _HEADING_RE.match(line)
+        if match:
+            headings.append(match.group(2))
+    links = []
+    for target in _LINK_RE.findall(body):
+        key = notes.note_key(target)
+        if key and key not in links:
+            links.append(key)
+    return {"aliases": aliases, "headings": headings, "links": links}
+
+
+def link_targets(text: str) -> List[str]:
+    """文本中 [[链接]] 指向的笔记名"""
+    return [notes.note_key(target) for target in _LINK_RE.findall(text)]
+
+
+class VaultIndex:
+    """笔记库的增量索引
+
+    Attributes:
+        vault_dir (str): 笔记库目录
+        index_path (str): 索引文件路径
+        enabled (bool): 是否启用，关闭时不提供任何已有笔记
+        context_tokens (int): Build Prompt 中相关已有笔记的 token 上限，0 表示不限制
+        notes (Dict[str, dict]): {相对路径: 条目}
+    """
+    def __init__(self, vault_dir: str, index_path: str = DEFAULT_INDEX_PATH, enabled: bool = True,
+                 context_tokens: int = 4000):
+        self.vault_dir = vault_dir
+        self.index_path = index_path
+        self.enabled = enabled
+        self.context_tokens = context_tokens
+        self.notes = {}
+        self._by_name = {}
+        self._snapshot = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, vault_dir: str, conf: Optional[dict] = None) -> "VaultIndex":
+        """根据配置中的 vault 段创建
+
+        Args:
+            vault_dir (str): 笔记库目录
+            conf (Optional[dict]): {"enabled", "index", "context_tokens"}，均可省略
+        """
+        conf = conf or {}
+        return cls(vault_dir, conf.get("index") or DEFAULT_INDEX_PATH, conf.get("enabled", True),
+                   conf.get("context_tokens", 4000))
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"笔记库索引损坏，重新建立: {e}")
+            return
+        if data.get("version") == INDEX_VERSION and data.get("vault") == os.path.abspath(self.vault_dir):
+            self.notes = data.get("notes", {})
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        data = {"version": INDEX_VERSION, "vault": os.path.abspath(self.vault_dir), "notes": self.notes}
+        tmp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _scan(self) -> Dict[str, os.stat_result]:
+        found = {}
+        stack = [self.vault_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith('.md'):
+                            found[os.path.relpath(entry.path, self.vault_dir).replace(os.sep, '/')] = entry.stat()
+            except OSError:
+                continue
+        return found
+
+    def refresh(self) -> Tuple[int, int, int]:
+        """按修改时间和大小增量更新索引，并清空上一次运行读取的笔记内容
+
+        Returns:
+            Tuple[int, int, int]: (新增, 更新, 删除) 的笔记数
+        """
+        if not self.enabled:
+            return 0, 0, 0
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._snapshot = {}
+            found = self._scan()
+            added = updated = touched = 0
+            removed = [path for path in self.notes if path not in found]
+            for path in removed:
+                del self.notes[path]
+            for path, stat in found.items():
+                entry = self.notes.get(path)
+                if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                    continue
+                try:
+                    with open(os.path.join(self.vault_dir, path), 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    logging.warning(f"无法读取笔记 {path}: {e}")
+                    continue
+                digest = hashlib.sha256(data).hexdigest()
+                if entry and entry["sha256"] == digest:
+                    entry["mtime_ns"], entry["size"] = stat.st_mtime_ns, stat.st_size
+                    touched += 1
+                    continue
+                parsed = parse_note(data.decode('utf-8', errors='replace'))
+                self.notes[path] = {"title": notes.note_key(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                                    "sha256": digest, **parsed}
+                if entry:
+                    updated += 1
+                else:
+                    added += 1
+            self._rebuild_names()
+            if added or updated or touched or removed or not os.path.exists(self.index_path):
+                self._save()
+        logging.info(f"笔记库索引: 共 {len(self.notes)} 篇，新增 {added}，更新 {updated}，删除 {len(removed)}")
+        return added, updated, len(removed)
+
+    def _rebuild_names(self):
+        by_name = {}
+        for path, entry in self.notes.items():
+            for alias in entry["aliases"]:
+                by_name.setdefault(_name_key(alias), path)
+        # 文件名优先于别名
+        for path, entry in self.notes.items():
+            by_name[_name_key(entry["title"])] = path
+        self._by_name = by_name
+
+    def find(self, name: str) -> Optional[str]:
+        """按文件名或别名查找笔记，返回相对路径"""
+        if not self.enabled:
+            return None
+        return self._by_name.get(_name_key(name))
+
+    def related(self, texts: List[str]) -> List[str]:
+        """与若干草稿相关的已有笔记：草稿中的文件名或 [[链接]] 命中了笔记的文件名或别名
+
+        Returns:
+            List[str]: 相对路径，按在草稿中首次出现的顺序排列
+        """
+        if not self.enabled or not self.notes:
+            return []
+        result = []
+        for text in texts:
+            for name in list(notes.draft_topics(text)) + link_targets(text):
+                path = self.find(name)
+                if path is not None and path not in result:
+                    result.append(path)
+        return result
+
+    def related_names(self, texts: List[str], exclude=()) -> List[str]:
+        """与若干草稿相关的已有笔记名，供 Gen 阶段添加指向已有笔记的链接"""
+        excluded = {self.find(name) for name in exclude}
+        return [self.notes[path]["title"] for path in self.related(texts) if path not in excluded]
+
+    def context(self, texts: List[str], estimate: Callable[[str], int], budget: Optional[int] = None) -> str:
+        """Build Prompt 中的相关已有笔记：每篇列出名称、别名和标题，总量不超过 budget"""
+        budget = self.context_tokens if budget is None else budget
+        lines, used = [], 0
+        for path in self.related(texts):
+            entry = self.notes[path]
+            line = f"- {path}"
+            if entry["aliases"]:
+                line += f"（别名：{'、'.join(entry['aliases'])}）"
+            if entry["headings"]:
+                line += f"\n  标题：{' / '.join(entry['headings'][:_MAX_HEADINGS])}"
+            cost = estimate(line)
+            if budget and used + cost > budget:
+                logging.info(f"相关已有笔记超出 {budget} token，只列出前 {len(lines)} 篇")
+                break
+            lines.append(line)
+            used += cost
+        return "\n".join(lines) if lines else "（无）"
+
+    def existing_block(self, name: str) -> Optional[Tuple[str, str]]:
+        """与 name 同名（或别名相同）的已有笔记 (相对路径, 内容)
+
+        内容在本次运行中第一次读取时保存下来，之后写入同名文件也不会影响合并时看到的原始内容。
+        """
+        path = self.find(name)
+        if path is None:
+            return None
+        with self._lock:
+            if path not in self._snapshot:
+                try:
+                    with open(os.path.join(self.vault_dir, path), 'r', encoding='utf-8') as f:
+                        self._snapshot[path] = f.read()
+                except OSError as e:
+                    logging.warning(f"无法读取已有笔记 {path}: {e}")
+                    return None
+            return path, self._snapshot[path]